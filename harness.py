@@ -0,0 +1,1129 @@
+"""أدوات محلية لقياس أداء البوت بدون اتصال بتيليجرام
+
+الاستخدام:
+    python harness.py bench-render --iterations 200
+    python harness.py bench-stream --reports 500
+    python harness.py webhook-selftest --users 20
+    python harness.py stress --users 50 --visits 20
+    python harness.py bench-flow --users 100 --max-p95 250
+    python harness.py bench-quick --users 50 --visits 12
+    python harness.py storage-selftest --users 20
+    python harness.py ratelimit-selftest --users 40
+    python harness.py scheduler-selftest --users 2000
+    python harness.py bench-startup --runs 5
+    python harness.py shard-selftest --workers 4 --users 40
+
+كل الأوامر تعمل داخل مجلد مؤقت حتى لا تلمس قاعدة البيانات أو التقارير الحقيقية.
+"""
+import argparse
+import asyncio
+import atexit
+import gc
+import io
+import itertools
+import json
+import os
+import random
+import re
+import socket
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+from collections import Counter
+from datetime import date, datetime, timedelta
+from urllib.parse import parse_qs
+
+import httpx
+import uvicorn
+from telegram.request import BaseRequest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# عمليات العمال (spawn) تعيد استيراد هذا الملف، فتستخدم نفس المجلد بدلاً من إنشاء مجلد جديد
+WORKDIR = os.environ.get("MEDMAP_HARNESS_DIR")
+if not WORKDIR:
+    WORKDIR = os.environ["MEDMAP_HARNESS_DIR"] = tempfile.mkdtemp(prefix="medmap-harness-")
+    atexit.register(shutil.rmtree, WORKDIR, ignore_errors=True)
+os.chdir(WORKDIR)
+# القياسات تقيس زمن المعالجة نفسه، فتُلغى حدود الإرسال ما لم تُحدد صراحة
+# (ratelimit-selftest ينشئ limiter بحدوده الخاصة)
+os.environ.setdefault("RATE_CHAT_PER_SECOND", "0")
+os.environ.setdefault("RATE_GLOBAL_PER_SECOND", "0")
+# التذكير والإرسال التلقائي لا يعملان أثناء القياسات (scheduler-selftest ينشئ جدولاً خاصاً)
+os.environ.setdefault("REMINDER_TIME", "")
+os.environ.setdefault("AUTO_SEND_TIME", "")
+
+from openpyxl import load_workbook  # noqa: E402
+from telegram import Update  # noqa: E402
+
+from main import (  # noqa: E402  (بعد الانتقال للمجلد المؤقت)
+    SECTION_SIZES,
+    ExcelHandler,
+    ReportScheduler,
+    TelegramRateLimiter,
+    S3Storage,
+    ShardDispatcher,
+    ShardedWebhookApp,
+    StreamingReportRenderer,
+    WebhookApp,
+    atomic_save,
+    build_application,
+    parse_quick_visits,
+    report_archiver,
+    report_day,
+    report_writer,
+    shard_for,
+    storage_sync,
+    user_store,
+    user_timezone,
+    visit_store,
+)
+
+
+def measure(func, iterations):
+    """قياس زمن التنفيذ وأقصى ذاكرة مستهلكة لكل استدعاء"""
+    func()  # تسخين
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+
+    # قياس الذاكرة في دورة منفصلة لأن tracemalloc يبطئ التنفيذ
+    peaks = []
+    blocks = []
+    tracemalloc.start()
+    for _ in range(min(iterations, 50)):
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        func()
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        after = tracemalloc.take_snapshot()
+        blocks.append(sum(stat.count_diff for stat in after.compare_to(before, "filename")
+                          if stat.count_diff > 0))
+    tracemalloc.stop()
+
+    timings.sort()
+    return {
+        "mean_ms": statistics.fmean(timings),
+        "p50_ms": timings[len(timings) // 2],
+        "p95_ms": timings[int(len(timings) * 0.95) - 1],
+        "peak_kib": statistics.fmean(peaks) / 1024,
+        "blocks": statistics.fmean(blocks),
+    }
+
+
+def print_result(label, result):
+    print(
+        f"{label:<28} mean {result['mean_ms']:7.3f} ms | "
+        f"p50 {result['p50_ms']:7.3f} ms | p95 {result['p95_ms']:7.3f} ms | "
+        f"peak {result['peak_kib']:8.1f} KiB | live blocks {result['blocks']:8.0f}"
+    )
+
+
+def bench_render(args):
+    """مقارنة بناء التقرير خلية بخلية مع نسخه من القالب"""
+    report_date = "2026-01-04"
+    ExcelHandler.get_template()
+    print_result(
+        "build_template (per cell)",
+        measure(ExcelHandler.build_template, args.iterations)
+    )
+    print_result(
+        "new_workbook (template)",
+        measure(lambda: ExcelHandler.new_workbook("Rep Name", report_date), args.iterations)
+    )
+
+
+def synthetic_records(reports):
+    """سجلات زيارات وهمية بنفس شكل VisitStore.iter_report_visits"""
+    for user_id in range(1, reports + 1):
+        for section, size in SECTION_SIZES.items():
+            for slot in range(size):
+                yield {
+                    "user_id": user_id,
+                    "report_date": "2026-01-04",
+                    "first_name": "Rep",
+                    "full_name": f"Rep {user_id}",
+                    "section": section,
+                    "slot": slot,
+                    "name": f"Dr {slot}",
+                    "place": "Cairo",
+                    "specialty": "GP",
+                    "products": "A, B",
+                    "comment": "",
+                }
+
+
+def bench_stream(args):
+    """التأكد من أن ذاكرة الرسم المتدفق ثابتة مع زيادة عدد التقارير"""
+    renderer = StreamingReportRenderer()
+    with tempfile.TemporaryDirectory() as out_dir:
+        tracemalloc.start()
+        started = time.perf_counter()
+        for done, filepath in enumerate(
+                renderer.render_all(synthetic_records(args.reports), out_dir), start=1):
+            os.remove(filepath)
+            if done in (10, args.reports // 2, args.reports):
+                gc.collect()
+                current, peak = tracemalloc.get_traced_memory()
+                print(f"{done:>6} reports | current {current / 1024:8.1f} KiB | "
+                      f"peak {peak / 1024:8.1f} KiB")
+        elapsed = time.perf_counter() - started
+        tracemalloc.stop()
+    print(f"{args.reports / elapsed:.1f} reports/s (with tracemalloc)")
+
+
+# --- محاكاة تيليجرام ---
+class FakeTelegramRequest(BaseRequest):
+    """بديل محلي لـ Bot API: يرد على كل طلب ويسجله بدون أي اتصال بالشبكة"""
+
+    def __init__(self):
+        self.calls = []
+        self._message_ids = itertools.count(1000)
+
+    @property
+    def read_timeout(self):
+        return 1.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        return 200, await self.respond(api_method, params)
+
+    async def respond(self, api_method, params):
+        self.calls.append((api_method, params))
+        if api_method == "getUpdates":
+            # لا توجد تحديثات في وضع المحاكاة، مع انتظار قصير بدلاً من التكرار المستمر
+            await asyncio.sleep(0.05)
+            result = []
+        else:
+            result = self._result(api_method, params)
+        return json.dumps({"ok": True, "result": result}).encode()
+
+    def _result(self, api_method, params):
+        if api_method == "getMe":
+            return {
+                "id": 1, "is_bot": True, "first_name": "MedMap", "username": "medmap_bot",
+                "can_join_groups": False, "can_read_all_group_messages": False,
+                "supports_inline_queries": False,
+            }
+        if api_method in ("sendMessage", "sendDocument"):
+            message_id = next(self._message_ids)
+            message = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": int(params["chat_id"]), "type": "private"},
+                "text": params.get("text", ""),
+            }
+            if api_method == "sendDocument":
+                message["document"] = {
+                    "file_id": f"file-{message_id}",
+                    "file_unique_id": f"unique-{message_id}",
+                }
+            return message
+        return True
+
+    def count(self, api_method):
+        return sum(1 for name, _ in self.calls if name == api_method)
+
+
+class FakeBotAPI:
+    """نفس ردود FakeTelegramRequest لكن كخادم HTTP (ASGI) تتصل به عمليات العمال عبر TELEGRAM_API_URL"""
+
+    def __init__(self):
+        self.fake = FakeTelegramRequest()
+
+    def count(self, api_method):
+        return self.fake.count(api_method)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        content_type = dict(scope["headers"]).get(b"content-type", b"").decode()
+        if content_type.startswith("multipart/"):
+            # يكفي استخراج الحقول النصية (مثل chat_id)، محتوى الملف نفسه غير مهم هنا
+            params = dict(re.findall(r'name="(\w+)"\r\n(?:[^\r\n]+\r\n)*\r\n([^\r]*)', body.decode("latin-1")))
+        else:
+            params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+        result = await self.fake.respond(scope["path"].rsplit("/", 1)[-1], params)
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"application/json")],
+        })
+        await send({"type": "http.response.body", "body": result})
+
+
+_update_ids = itertools.count(1)
+
+
+def make_update(user_id, text):
+    """تحديث تيليجرام برسالة نصية من مستخدم في محادثة خاصة"""
+    update_id = next(_update_ids)
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"Rep{user_id}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+def visit_flow():
+    """رسائل مندوب واحد: إنشاء تقرير، زيارات A.M/P.M/صيدلية، ثم إرسال التقرير"""
+    return [
+        "/start",
+        "📊 إنشاء تقرير جديد", "Ahmed", "Hassan",
+        "✅ تسجيل زيارة جديدة", "🌅 A.M Visit", "Dr Samy", "Kasr Al Ainy", "Cardio", "A, B", "⏭️ تخطي",
+        "✅ تسجيل زيارة جديدة", "🌆 P.M Visit", "Dr Mona", "Dokki", "GP", "C", "ok",
+        "✅ تسجيل زيارة جديدة", "💊 Pharmacy Visit", "El Ezaby", "Tahrir St", "A, C", "⏭️ تخطي",
+        "📤 إرسال التقرير",
+    ]
+
+
+async def asgi_post(app, path, payload, secret=""):
+    """إرسال طلب HTTP مباشرة لتطبيق ASGI بدون خادم حقيقي"""
+    body = json.dumps(payload).encode()
+    headers = [(b"content-type", b"application/json")]
+    if secret:
+        headers.append((b"x-telegram-bot-api-secret-token", secret.encode()))
+    scope = {"type": "http", "method": "POST", "path": path, "headers": headers}
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    return sent[0]["status"]
+
+
+async def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+
+async def webhook_selftest(args):
+    """تشغيل المسار الكامل عبر تطبيق الـ webhook لعدة مندوبين مع Bot API وهمي"""
+    request = FakeTelegramRequest()
+    application = build_application(token="123456:FAKE", request=request)
+    webapp = WebhookApp(application, path="/telegram", secret="harness-secret")
+    users = range(1, args.users + 1)
+
+    async with application:
+        await application.start()
+        assert await asgi_post(webapp, "/telegram", make_update(1, "/start"), "wrong") == 403
+        assert await asgi_post(webapp, "/telegram", make_update(1, "/start")) == 403
+        # بدون secret مضبوط يُرفض كل طلب بدلاً من قبوله بلا تحقق
+        assert await asgi_post(WebhookApp(application, path="/telegram", secret=""), "/telegram",
+                               make_update(1, "/start")) == 403
+        started = time.perf_counter()
+        flows = [visit_flow() for _ in users]
+        # رسائل المندوبين متداخلة كما تصل في الواقع
+        for step in range(len(flows[0])):
+            for user_id, flow in zip(users, flows):
+                status = await asgi_post(webapp, "/telegram", make_update(user_id, flow[step]),
+                                         "harness-secret")
+                assert status == 200, status
+        done = await wait_for(lambda: request.count("sendDocument") >= args.users, args.timeout)
+        elapsed = time.perf_counter() - started
+        await application.stop()
+
+    updates = args.users * len(visit_flow())
+    print(f"users {args.users} | updates {updates} | {elapsed:.2f} s | "
+          f"{updates / elapsed:.0f} updates/s")
+    print(f"sendMessage {request.count('sendMessage')} | "
+          f"sendDocument {request.count('sendDocument')} | "
+          f"deleteMessage {request.count('deleteMessage')}")
+    if not done:
+        print("❌ لم تصل كل التقارير قبل انتهاء المهلة")
+        sys.exit(1)
+    print("✅ كل المندوبين استلموا تقاريرهم")
+
+
+# --- قياس أداء المحادثة الكاملة ---
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class StageTimer:
+    """قياس الوقت داخل دوال ExcelHandler أثناء القياس فقط ثم إرجاعها كما كانت"""
+
+    STAGES = ("create_new_report", "add_visit", "render_cached")
+
+    def __init__(self):
+        self.timings = {stage: [] for stage in self.STAGES}
+        self._originals = {}
+
+    def _wrap(self, stage, func):
+        timings = self.timings[stage]
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings.append((time.perf_counter() - started) * 1000)
+        return staticmethod(timed)
+
+    def __enter__(self):
+        for stage in self.STAGES:
+            original = ExcelHandler.__dict__[stage]
+            self._originals[stage] = original
+            setattr(ExcelHandler, stage, self._wrap(stage, original.__func__))
+        return self
+
+    def __exit__(self, *exc):
+        for stage, original in self._originals.items():
+            setattr(ExcelHandler, stage, original)
+
+
+FLOW_STEPS = [
+    "start", "menu:create", "first_name", "last_name",
+    "menu:visit", "am:type", "am:doctor", "am:location", "am:specialty", "am:products", "am:comment",
+    "menu:visit", "pm:type", "pm:doctor", "pm:location", "pm:specialty", "pm:products", "pm:comment",
+    "menu:visit", "ph:type", "ph:name", "ph:address", "ph:products", "ph:comment",
+    "menu:send",
+]
+
+
+async def bench_flow(args):
+    """تشغيل ConversationHandler الحقيقي لعدة مندوبين متزامنين وقياس زمن كل خطوة"""
+    request = FakeTelegramRequest()
+    application = build_application(token="123456:FAKE", request=request)
+    step_latency = {step: [] for step in FLOW_STEPS + ["menu:resend"]}
+    all_latency = []
+
+    steps = list(zip(FLOW_STEPS, visit_flow()))
+    # إعادة إرسال نفس التقرير بدون تغيير (مثلاً لأكثر من مشرف)
+    steps += [("menu:resend", "📤 إرسال التقرير")] * args.resends
+
+    async def rep(user_id):
+        for step, text in steps:
+            update = Update.de_json(make_update(user_id, text), application.bot)
+            started = time.perf_counter()
+            await application.process_update(update)
+            elapsed = (time.perf_counter() - started) * 1000
+            step_latency[step].append(elapsed)
+            all_latency.append(elapsed)
+
+    async with application:
+        with StageTimer() as stages:
+            started = time.perf_counter()
+            await asyncio.gather(*(rep(user_id) for user_id in range(1, args.users + 1)))
+            wall = time.perf_counter() - started
+
+    updates = len(all_latency)
+    print(f"users {args.users} | updates {updates} | wall {wall:.2f} s | "
+          f"{updates / wall:.0f} updates/s | {args.users * 3 / wall:.0f} visits/s")
+    print(f"handler latency: p50 {percentile(all_latency, 50):.1f} ms | "
+          f"p95 {percentile(all_latency, 95):.1f} ms | p99 {percentile(all_latency, 99):.1f} ms")
+    print()
+    print(f"{'step':<14}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for step in dict.fromkeys(step for step, _ in steps):
+        values = step_latency[step]
+        print(f"{step:<14}{percentile(values, 50):>10.1f}{percentile(values, 95):>10.1f}"
+              f"{percentile(values, 99):>10.1f}")
+    print()
+    print(f"{'ExcelHandler':<20}{'calls':>8}{'total ms':>12}{'mean ms':>10}{'p95 ms':>10}")
+    for stage, values in stages.timings.items():
+        total = sum(values)
+        mean = total / len(values) if values else 0.0
+        print(f"{stage:<20}{len(values):>8}{total:>12.1f}{mean:>10.2f}{percentile(values, 95):>10.2f}")
+    uploads = sum(1 for name, params in request.calls
+                  if name == "sendDocument" and not str(params.get("document", "")).startswith("file-"))
+    print(f"Bot API calls: {len(request.calls)} | sendDocument {request.count('sendDocument')} "
+          f"(uploads {uploads}, file_id reuse {request.count('sendDocument') - uploads})")
+
+    p95 = percentile(all_latency, 95)
+    if args.max_p95 and p95 > args.max_p95:
+        print(f"❌ p95 {p95:.1f} ms أعلى من الحد {args.max_p95} ms")
+        sys.exit(1)
+
+
+# --- الإدخال السريع ---
+GUIDED_VISITS = [
+    ["🌅 A.M Visit", "Dr Samy", "Kasr Al Ainy", "Cardio", "A, B", "⏭️ تخطي"],
+    ["🌆 P.M Visit", "Dr Mona", "Dokki", "GP", "C", "ok"],
+    ["💊 Pharmacy Visit", "El Ezaby", "Tahrir St", "A, C", "⏭️ تخطي"],
+]
+QUICK_LINES = [
+    "AM | Dr Samy | Kasr Al Ainy | Cardio | A, B",
+    "PM | Dr Mona | Dokki | GP | C | ok",
+    "PH | El Ezaby | Tahrir St | A, C",
+]
+
+
+async def bench_quick(args):
+    """نفس الزيارات بالمحادثة خطوة بخطوة ثم برسالة إدخال سريع واحدة: الزمن وعدد طلبات Bot API"""
+    request = FakeTelegramRequest()
+    application = build_application(token="123456:FAKE", request=request)
+    guided_users = range(1, args.users + 1)
+    quick_users = range(100001, 100001 + args.users)
+
+    async def send(user_id, text):
+        await application.process_update(Update.de_json(make_update(user_id, text), application.bot))
+
+    async def create(user_id):
+        for text in ("/start", "📊 إنشاء تقرير جديد", "Ahmed", "Hassan"):
+            await send(user_id, text)
+
+    async def guided(user_id):
+        for i in range(args.visits):
+            await send(user_id, "✅ تسجيل زيارة جديدة")
+            for text in GUIDED_VISITS[i % len(GUIDED_VISITS)]:
+                await send(user_id, text)
+
+    async def quick(user_id):
+        await send(user_id, "\n".join(QUICK_LINES[i % len(QUICK_LINES)] for i in range(args.visits)))
+
+    async def measure_mode(users, run):
+        await asyncio.gather(*(create(user_id) for user_id in users))
+        calls = len(request.calls)
+        started = time.perf_counter()
+        await asyncio.gather(*(run(user_id) for user_id in users))
+        return time.perf_counter() - started, len(request.calls) - calls
+
+    async with application:
+        results = {
+            "guided": await measure_mode(guided_users, guided),
+            "quick": await measure_mode(quick_users, quick),
+        }
+        # سطر خاطئ في الرسالة يعني عدم حفظ أي زيارة منها
+        await send(quick_users[0], "AM | Dr X | Hospital | Cardio | A\nPM | Dr Y")
+
+    report_date = ExcelHandler.get_report_date()
+    visits = args.users * args.visits
+    print(f"users {args.users} | visits per rep {args.visits}")
+    print(f"{'mode':<10}{'wall s':>10}{'ms/visit':>10}{'API calls':>12}{'calls/visit':>13}")
+    for mode, (wall, calls) in results.items():
+        print(f"{mode:<10}{wall:>10.2f}{wall * 1000 / visits:>10.2f}{calls:>12}{calls / visits:>13.2f}")
+    (guided_wall, guided_calls), (quick_wall, quick_calls) = results.values()
+    print(f"speedup x{guided_wall / quick_wall:.1f} | API calls x{guided_calls / quick_calls:.1f}")
+
+    saved = {
+        mode: sum(len(visit_store.get_visits(user_id, report_date)) for user_id in users)
+        for mode, users in (("guided", guided_users), ("quick", quick_users))
+    }
+    if saved["guided"] != visits or saved["quick"] != visits:
+        print(f"❌ الزيارات المحفوظة {saved} والمتوقع {visits} لكل طريقة")
+        sys.exit(1)
+    print("✅ نفس عدد الزيارات في الطريقتين، والرسالة الخاطئة لم يُحفظ منها شيء")
+
+
+# --- حدود الإرسال ---
+class FloodingTelegramRequest(FakeTelegramRequest):
+    """Bot API وهمي يطبق حدود تيليجرام: 429 مع retry_after لو تجاوزت المحادثة أو البوت الحد في آخر ثانية
+
+    flood_rate نسبة طلبات عشوائية ترد بـ 429 حتى تحت الحد، وupload_latency زمن رفع كل ملف.
+    """
+
+    def __init__(self, chat_limit=5, global_limit=30, flood_rate=0.0, upload_latency=0.0):
+        super().__init__()
+        self.chat_limit = chat_limit
+        self.global_limit = global_limit
+        self.flood_rate = flood_rate
+        self.upload_latency = upload_latency
+        self.rejected = 0
+        self._sent = []  # (الوقت، chat_id) للرسائل المقبولة
+        self._random = random.Random(7)
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        status, body = await super().do_request(url, method, request_data)
+        return (429 if b'"error_code": 429' in body else status), body
+
+    async def respond(self, api_method, params):
+        if api_method.startswith("send"):
+            now = time.monotonic()
+            self._sent = [(at, chat) for at, chat in self._sent if now - at < 1]
+            chat_id = int(params["chat_id"])
+            in_chat = sum(1 for _, chat in self._sent if chat == chat_id)
+            if (len(self._sent) >= self.global_limit or in_chat >= self.chat_limit
+                    or self._random.random() < self.flood_rate):
+                self.rejected += 1
+                return json.dumps({
+                    "ok": False, "error_code": 429,
+                    "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1},
+                }).encode()
+            self._sent.append((now, chat_id))
+            if api_method == "sendDocument":
+                await asyncio.sleep(self.upload_latency)
+        return await super().respond(api_method, params)
+
+
+async def ratelimit_selftest(args):
+    """دفعة نهاية الوردية: كل المندوبين يرسلون تقاريرهم معاً، بدون حدود إرسال ثم مع TelegramRateLimiter"""
+    quick_block = "\n".join(QUICK_LINES)
+    results = {}
+    for mode, limiter in (
+        ("no limiter", None),
+        ("limiter", TelegramRateLimiter(global_rate=args.global_rate, backoff=0.1)),
+    ):
+        request = FloodingTelegramRequest(flood_rate=args.flood_rate, upload_latency=args.upload_latency)
+        application = build_application(token="123456:FAKE", request=request, limiter=limiter)
+        offset = len(results) * 100000
+        users = range(offset + 1, offset + args.users + 1)
+
+        async def rep(user_id):
+            for text in ("/start", "📊 إنشاء تقرير جديد", "Ahmed", "Hassan", quick_block, "🔙 رجوع",
+                         "📤 إرسال التقرير"):
+                update = Update.de_json(make_update(user_id, text), application.bot)
+                await application.process_update(update)
+
+        async with application:
+            started = time.perf_counter()
+            await asyncio.gather(*(rep(user_id) for user_id in users))
+            wall = time.perf_counter() - started
+        delivered = {int(params["chat_id"]) for name, params in request.calls if name == "sendDocument"}
+        placeholders = sum(1 for name, params in request.calls
+                           if name == "sendMessage" and str(params.get("text", "")).startswith("⏳"))
+        results[mode] = (wall, request.rejected, len(delivered), placeholders)
+
+    print(f"users {args.users} | fake limits: 5 msg/s per chat, 30 msg/s global | "
+          f"random 429 {args.flood_rate:.0%} | upload {args.upload_latency}s")
+    print(f"{'mode':<12}{'wall s':>8}{'429s':>8}{'delivered':>11}{'placeholders':>14}")
+    for mode, (wall, rejected, delivered, placeholders) in results.items():
+        print(f"{mode:<12}{wall:>8.2f}{rejected:>8}{delivered:>11}{placeholders:>14}")
+    if results["limiter"][2] != args.users:
+        print("❌ بعض المندوبين لم يستلموا تقاريرهم رغم الـ limiter")
+        sys.exit(1)
+    print("✅ كل التقارير وصلت مع الـ limiter بدون أخطاء ظاهرة للمندوب")
+
+
+# --- التذكير والإرسال التلقائي ---
+SCHEDULER_TIMEZONES = ["Africa/Cairo", "Asia/Riyadh", "Asia/Dubai", "Europe/London", "America/New_York", "UTC"]
+
+
+async def scheduler_selftest(args):
+    """يوم كامل بساعة وهمية لمندوبين في مناطق زمنية مختلفة: تذكير من لم يسجل، وإرسال تلقائي لمن لم يُرسل"""
+    request = FakeTelegramRequest()
+    application = build_application(token="123456:FAKE", request=request)
+    scheduler = ReportScheduler(times={"remind": "13:00", "autosend": "21:00"}, shard=0, shards=1, catchup=0)
+    visits, _ = parse_quick_visits("\n".join(QUICK_LINES))
+    users = range(1, args.users + 1)
+    started_at = time.time()
+
+    # المجموعات حسب user_id % 4: 0 بزيارات، 1 بتقرير فارغ، 2 بدون تقرير، 3 بزيارات أُرسلت بالفعل
+    def register(user_id):
+        user_store.save(user_id, f"Rep{user_id}", f"Rep{user_id} Harness")
+        user_store.set_timezone(user_id, SCHEDULER_TIMEZONES[user_id % len(SCHEDULER_TIMEZONES)])
+
+    # كل خامس مندوب يسجل بعد بدء الجدولة
+    joined = [user_id for user_id in users if user_id % 5 == 0]
+    for user_id in users:
+        if user_id % 5:
+            register(user_id)
+    scheduler.load(now=started_at)
+    for user_id in joined:
+        register(user_id)
+        scheduler.add_user(user_id)
+    # تغيير المنطقة الزمنية بعد الجدولة لا يجب أن يكرر المواعيد أو يؤخرها
+    moved = [user_id for user_id in users if user_id % 7 == 0]
+    for user_id in moved:
+        user_store.set_timezone(user_id, "Asia/Tokyo" if user_id % 2 else "America/Los_Angeles")
+        scheduler.schedule_user(user_id, now=started_at)
+
+    # تقرير ليوم كل موعد (التذكير والإرسال قد يقعان في يومين مختلفين حسب وقت البدء)
+    event_days = {}
+    expected_at = {}
+    for user_id in users:
+        tz = user_timezone(user_id)
+        for kind in scheduler.times:
+            expected_at[kind, user_id] = scheduler.next_time(user_id, kind, started_at)
+        event_days[user_id] = {
+            kind: report_day(user_id, datetime.fromtimestamp(scheduler.next_time(user_id, kind, started_at), tz))
+            .isoformat()
+            for kind in scheduler.times
+        }
+        if user_id % 4 == 2:
+            continue
+        for day in set(event_days[user_id].values()):
+            visit_store.create_report(user_id, day, f"Rep{user_id}", f"Rep{user_id} Harness")
+            if user_id % 4 != 1:
+                visit_store.add_visits(user_id, day, visits)
+            if user_id % 4 == 3:
+                visit_store.mark_sent(user_id, day, visit_store.get_report(user_id, day)["version"])
+
+    tick_seconds = []
+    results = Counter()
+    late_events = []
+    async with application:
+        clock = started_at
+        while clock < started_at + 86400:
+            clock += args.tick
+            tick_started = time.perf_counter()
+            events = scheduler.due(now=clock)
+            tick_seconds.append(time.perf_counter() - tick_started)
+            if events:
+                await scheduler.run_events(application.bot, events)
+                results.update(kind for kind, _, _ in events)
+                # كل موعد يُنفذ في أول فحص بعد وقته المحلي، لا بعده بساعات
+                late_events += [(kind, user_id) for kind, user_id, _ in events
+                                if not 0 <= clock - expected_at[kind, user_id] < args.tick]
+        # يوم بدون تغيير: إعادة الإرسال التلقائي لا ترسل نفس النسخة مرة أخرى
+        resent = [await scheduler.autosend(application.bot, user_id, event_days[user_id]["autosend"])
+                  for user_id in users if user_id % 4 == 0]
+
+    reminded = Counter(int(params["chat_id"]) for name, params in request.calls
+                       if name == "sendMessage" and str(params.get("text", "")).startswith("⏰"))
+    delivered = Counter(int(params["chat_id"]) for name, params in request.calls if name == "sendDocument")
+    expected_reminded = {user_id for user_id in users if user_id % 4 in (1, 2)}
+    expected_delivered = {user_id for user_id in users if user_id % 4 == 0}
+
+    print(f"users {args.users} | heap {len(scheduler)} events | simulated ticks {len(tick_seconds)} "
+          f"every {args.tick:.0f}s | due events {dict(results)}")
+    print(f"tick cost: mean {statistics.fmean(tick_seconds) * 1e6:.1f} us | "
+          f"max {max(tick_seconds) * 1e3:.2f} ms | reminders {sum(reminded.values())} | "
+          f"auto-sent {sum(delivered.values())} | joined later {len(joined)} | tz changes {len(moved)}")
+    failures = []
+    if set(reminded) != expected_reminded:
+        failures.append("التذكير لم يصل لمن لم يسجل زيارات فقط")
+    if set(delivered) != expected_delivered:
+        failures.append("الإرسال التلقائي لم يصل للتقارير غير المرسلة فقط")
+    if any(count > 1 for count in (*reminded.values(), *delivered.values())):
+        failures.append("رسائل مكررة لنفس المندوب")
+    if results["remind"] != args.users or results["autosend"] != args.users:
+        failures.append("عدد المواعيد المستحقة لا يساوي موعداً واحداً لكل مندوب")
+    if late_events:
+        failures.append(f"{len(late_events)} موعد لم يُنفذ في وقته، مثلاً {late_events[0]}")
+    if any(result != "skipped" for result in resent):
+        failures.append("إعادة الإرسال التلقائي أرسلت نسخة مرسلة بالفعل")
+    # تشغيل البوت بعد موعد الإرسال بعشر دقائق: الإرسال الفائت يُنفذ فوراً والتذكير لا
+    late = ReportScheduler(times={"remind": "13:00", "autosend": "21:00"}, shards=1)
+    autosend_at = scheduler.next_time(1, "autosend", started_at)
+    late.load(now=autosend_at + 600)
+    if [kind for kind, user_id, _ in late.due(now=autosend_at + 600) if user_id == 1] != ["autosend"]:
+        failures.append("الإرسال التلقائي الفائت لم يُنفذ عند التشغيل")
+    for failure in failures:
+        print(f"❌ {failure}")
+    if failures:
+        sys.exit(1)
+    print("✅ تذكير وإرسال تلقائي مرة واحدة لكل مندوب حسب منطقته الزمنية")
+
+
+# --- زمن بدء التشغيل ---
+# يعمل في عملية Python جديدة تماماً (بدون استيراد harness) لقياس البدء البارد كما في Railway
+STARTUP_PROBE = r"""
+import asyncio, json, sys, time
+started = time.time()
+from telegram import Update
+from telegram.request import BaseRequest
+import main
+imported = time.time()
+
+class Request(BaseRequest):
+    read_timeout = 1.0
+    def __init__(self):
+        self.sent = {}
+    async def initialize(self):
+        pass
+    async def shutdown(self):
+        pass
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.sent.setdefault(api_method, time.time())
+        if api_method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "MedMap", "username": "medmap_bot"}
+        elif api_method.startswith("send"):
+            result = {"message_id": 1, "date": int(time.time()),
+                      "chat": {"id": int(params["chat_id"]), "type": "private"}}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+def update(update_id, text):
+    message = {"message_id": update_id, "date": int(time.time()), "text": text,
+               "chat": {"id": 7, "type": "private"}, "from": {"id": 7, "is_bot": False, "first_name": "R"}}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return {"update_id": update_id, "message": message}
+
+async def probe():
+    request = Request()
+    application = main.build_application(token="123456:FAKE", request=request)
+    async with application:
+        await main.post_init(application)
+        await application.start()
+        ready = time.time()
+        texts = ["/start", "📊 إنشاء تقرير جديد", "Ahmed", "Hassan",
+                 "AM | Dr Samy | Kasr Al Ainy | Cardio | A, B", "🔙 رجوع", "📤 إرسال التقرير"]
+        for update_id, text in enumerate(texts, 1):
+            await application.process_update(Update.de_json(update(update_id, text), application.bot))
+        await application.stop()
+    await main.post_shutdown(application)
+    print(json.dumps({"started": started, "imported": imported, "ready": ready,
+                      "first_reply": request.sent["sendMessage"], "first_report": request.sent["sendDocument"],
+                      "modules": sorted(name for name in ("openpyxl", "pandas", "numpy", "uvicorn")
+                                        if name in sys.modules)}))
+
+asyncio.run(probe())
+"""
+
+
+def bench_startup(args):
+    """زمن البدء البارد حتى أول رد وأول تقرير، في عمليات جديدة كل مرة وبمجلد فارغ"""
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)), BOT_TOKEN="123456:FAKE")
+    stages = {"python start": [], "import main": [], "ready": [], "first reply": [], "first report": []}
+    modules = []
+    for run in range(args.runs):
+        workdir = os.path.join(WORKDIR, f"startup-{run}")
+        os.makedirs(workdir)
+        launched = time.time()
+        output = subprocess.run([sys.executable, "-c", STARTUP_PROBE], cwd=workdir, env=env,
+                                capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        stages["python start"].append(result["started"] - launched)
+        stages["import main"].append(result["imported"] - launched)
+        stages["ready"].append(result["ready"] - launched)
+        stages["first reply"].append(result["first_reply"] - launched)
+        stages["first report"].append(result["first_report"] - launched)
+        modules = result["modules"]
+
+    print(f"runs {args.runs} | time since process launch (median / min):")
+    for stage, values in stages.items():
+        print(f"  {stage:<14}{statistics.median(values) * 1000:>8.0f} ms{min(values) * 1000:>8.0f} ms")
+    print(f"heavy modules loaded by the end: {', '.join(modules) or '-'}")
+
+
+# --- التخزين الدائم ---
+class FakeS3:
+    """بديل محلي لـ S3/MinIO عبر httpx.MockTransport: يحفظ الكائنات في الذاكرة ويدعم multipart"""
+
+    def __init__(self, bucket, access_key, latency=0.0):
+        self.bucket = bucket
+        self.access_key = access_key
+        self.latency = latency
+        self.objects = {}
+        self.uploads = {}
+        self.requests = []
+        self._upload_ids = itertools.count(1)
+
+    def __call__(self, request):
+        self.requests.append((request.method, request.url.path, dict(request.url.params)))
+        auth = request.headers.get("authorization", "")
+        if not auth.startswith(f"AWS4-HMAC-SHA256 Credential={self.access_key}/"):
+            return httpx.Response(403, content=b"<Error><Code>AccessDenied</Code></Error>")
+        time.sleep(self.latency)
+        params = request.url.params
+        path = request.url.path.removeprefix(f"/{self.bucket}")
+        key = path.removeprefix("/")
+        
+        if not key and request.method == "GET":
+            prefix = params.get("prefix", "")
+            keys = sorted(k for k in self.objects if k.startswith(prefix) and "/" not in k[len(prefix):])
+            body = "".join(f"<Contents><Key>{k}</Key></Contents>" for k in keys)
+            return httpx.Response(200, content=f"<ListBucketResult>{body}</ListBucketResult>".encode())
+        if request.method == "POST" and "uploads" in params:
+            upload_id = str(next(self._upload_ids))
+            self.uploads[upload_id] = {}
+            return httpx.Response(200, content=(
+                f"<InitiateMultipartUploadResult><UploadId>{upload_id}</UploadId>"
+                "</InitiateMultipartUploadResult>").encode())
+        if request.method == "PUT" and "partNumber" in params:
+            self.uploads[params["uploadId"]][int(params["partNumber"])] = request.content
+            return httpx.Response(200, headers={"ETag": f'"part-{params["partNumber"]}"'})
+        if request.method == "POST" and "uploadId" in params:
+            parts = self.uploads.pop(params["uploadId"])
+            self.objects[key] = b"".join(parts[n] for n in sorted(parts))
+            return httpx.Response(200, content=b"<CompleteMultipartUploadResult/>")
+        if request.method == "PUT":
+            self.objects[key] = request.content
+            return httpx.Response(200)
+        if request.method == "GET":
+            if key not in self.objects:
+                return httpx.Response(404, content=b"<Error><Code>NoSuchKey</Code></Error>")
+            return httpx.Response(200, content=self.objects[key])
+        if request.method == "DELETE":
+            if "uploadId" in params:
+                self.uploads.pop(params["uploadId"], None)
+            else:
+                self.objects.pop(key, None)
+            return httpx.Response(204)
+        return httpx.Response(400)
+
+
+async def storage_selftest(args):
+    """المسار الكامل مع S3 وهمي: الرفع في الخلفية، القراءة عبر الكاش، multipart والأرشيف"""
+    fake = FakeS3("medmap", "harness", latency=args.latency)
+    storage_sync.backend = S3Storage(
+        endpoint="http://minio.local:9000", bucket="medmap", access_key="harness",
+        secret_key="harness-secret", part_size=64 * 1024, transport=httpx.MockTransport(fake),
+    )
+    request = FakeTelegramRequest()
+    application = build_application(token="123456:FAKE", request=request)
+    failures = []
+
+    async def rep(user_id):
+        for text in visit_flow():
+            await application.process_update(Update.de_json(make_update(user_id, text), application.bot))
+
+    async with application:
+        await storage_sync.start()
+        started = time.perf_counter()
+        await asyncio.gather(*(rep(user_id) for user_id in range(1, args.users + 1)))
+        elapsed = time.perf_counter() - started
+        queued = storage_sync.pending()
+        await storage_sync.stop()
+    
+    # كل تقرير مرسوم محلياً موجود بنفس البايتات في S3
+    reports = sorted(os.listdir("reports"))
+    for name in reports:
+        with open(os.path.join("reports", name), "rb") as f:
+            if fake.objects.get(f"reports/{name}") != f.read():
+                failures.append(f"missing upload reports/{name}")
+    
+    # القراءة عبر الكاش بعد فقدان الملف المحلي (مثل إعادة النشر)
+    lost = os.path.join("reports", reports[0])
+    os.remove(lost)
+    if not storage_sync.fetch(lost):
+        failures.append("read-through did not restore the report")
+    else:
+        with open(lost, "rb") as f:
+            if f.read() != fake.objects[f"reports/{reports[0]}"]:
+                failures.append("read-through returned different bytes")
+    
+    # ملف كبير يُرفع multipart
+    big = os.path.join(WORKDIR, "big.bin")
+    with open(big, "wb") as f:
+        f.write(os.urandom(300 * 1024))
+    storage_sync.backend.upload("exports/big.bin", big)
+    parts = sum(1 for method, _, params in fake.requests if method == "PUT" and "partNumber" in params)
+    with open(big, "rb") as f:
+        if fake.objects.get("exports/big.bin") != f.read() or parts < 2:
+            failures.append("multipart upload mismatch")
+    
+    # الأرشيف: ملف الشهر يُرفع، وبعد فقدانه محلياً يُنزل ثم يُكمل عليه
+    month_day = date.today().replace(day=1) - timedelta(days=20)
+    for offset, user_id in enumerate((900, 901)):
+        report_date = (month_day + timedelta(days=offset)).strftime("%Y-%m-%d")
+        ExcelHandler.create_new_report(user_id, "Arch", "Arch Rep", report_date)
+        ExcelHandler.add_visit(user_id, "Arch", "AM", {"Dr": "X", "Hospital": "H"}, report_date)
+        report_archiver.run_once()
+        await storage_sync.drain()
+        shutil.rmtree(report_archiver.archive_dir)
+    bundle = f"archive/{month_day:%Y-%m}.zip"
+    members = zipfile.ZipFile(io.BytesIO(fake.objects.get(bundle, b""))).namelist()
+    if len(members) != 2:
+        failures.append(f"bundle has {members}")
+    
+    print(f"users {args.users} | flow {elapsed:.2f} s with storage latency {args.latency * 1000:.0f} ms | "
+          f"queued after flow {queued}")
+    print(f"S3 requests {len(fake.requests)} | objects {len(fake.objects)} | multipart parts {parts} | "
+          f"bundle entries {len(members)}")
+    if failures:
+        print("❌ " + "\n❌ ".join(failures))
+        sys.exit(1)
+    print("✅ التخزين الدائم يعمل (رفع في الخلفية، قراءة عبر الكاش، multipart، أرشيف)")
+
+
+# --- التوزيع على عدة عمليات ---
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def shard_selftest(args):
+    """موزع + عدة عمليات عمال على نفس الجهاز مع Bot API وهمي عبر HTTP"""
+    api = FakeBotAPI()
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(api, host="127.0.0.1", port=port,
+                                           lifespan="off", log_level="warning"))
+    serving = asyncio.create_task(server.serve())
+    await wait_for(lambda: server.started, 10)
+    # العمال يقرؤون العنوان من البيئة عند استيراد main
+    os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{port}"
+    
+    users = range(1, args.users + 1)
+    dispatcher = ShardDispatcher(args.workers, token="123456:FAKE")
+    dispatcher.start()
+    webapp = ShardedWebhookApp(dispatcher, path="/telegram", secret="harness-secret")
+    try:
+        started = time.perf_counter()
+        flows = [visit_flow() for _ in users]
+        for step in range(len(flows[0])):
+            for user_id, flow in zip(users, flows):
+                status = await asgi_post(webapp, "/telegram", make_update(user_id, flow[step]),
+                                         "harness-secret")
+                assert status == 200, status
+        done = await wait_for(lambda: api.count("sendDocument") >= args.users, args.timeout)
+        elapsed = time.perf_counter() - started
+    finally:
+        await asyncio.to_thread(dispatcher.stop)
+        server.should_exit = True
+        await serving
+    
+    documents = Counter(int(params["chat_id"]) for name, params in api.fake.calls if name == "sendDocument")
+    shards = Counter(shard_for(user_id, args.workers) for user_id in users)
+    updates = args.users * len(visit_flow())
+    print(f"workers {args.workers} | users {args.users} | updates {updates} | {elapsed:.2f} s | "
+          f"{updates / elapsed:.0f} updates/s")
+    print("users per worker: " + ", ".join(f"#{shard} {count}" for shard, count in sorted(shards.items())))
+    # لو وصلت رسائل مندوب لأكثر من عامل تنكسر محادثته ولا يصل تقريره
+    if not done or sorted(documents) != list(users) or max(documents.values()) != 1:
+        print(f"❌ وصلت {len(documents)} تقارير من {args.users}")
+        sys.exit(1)
+    print("✅ كل مندوب خُدم من عامل واحد واستلم تقريره")
+
+
+# --- اختبار التحميل المتزامن ---
+async def stress(args):
+    """إرسال زيارات مزدوجة متزامنة من مندوبين كثيرين والتأكد من عدم ضياع أي زيارة"""
+    users = range(1, args.users + 1)
+    sections = list(SECTION_SIZES)
+    report_date = ExcelHandler.get_report_date()
+    await asyncio.gather(*(
+        report_writer.create_new_report(user_id, "Rep", f"Rep {user_id}") for user_id in users
+    ))
+
+    async def hammer(user_id):
+        for i in range(args.visits):
+            section = sections[i % len(sections)]
+            data = {"Dr": f"Dr {i}", "Pharmacy": f"Ph {i}", "Products": "A"}
+            # نفس الزيارة من جهازين في نفس اللحظة + إرسال التقرير أثناء الكتابة
+            await asyncio.gather(
+                report_writer.add_visit(user_id, "Rep", section, data),
+                report_writer.add_visit(user_id, "Rep", section, data),
+                report_writer.render_report(user_id) if i % 5 == 0 else asyncio.sleep(0),
+            )
+
+    started = time.perf_counter()
+    await asyncio.gather(*(hammer(user_id) for user_id in users))
+    elapsed = time.perf_counter() - started
+
+    expected = 2 * args.visits
+    lost = 0
+    broken_slots = 0
+    for user_id in users:
+        visits = visit_store.get_visits(user_id, report_date)
+        lost += expected - len(visits)
+        for section in sections:
+            slots = [v["slot"] for v in visits if v["section"] == section]
+            broken_slots += slots != list(range(len(slots)))
+        filepath = await report_writer.render_report(user_id)
+        ws = load_workbook(filepath).active
+        names = sum(1 for row in ws.iter_rows(min_row=8, min_col=2, max_col=2, values_only=True)
+                    if row[0] and row[0] not in ("Pharmacy Name",))
+        lost += expected - names if names < expected else 0
+
+    # حفظ متقطع في المنتصف يجب ألا يفسد آخر نسخة سليمة من الملف
+    class CrashingWorkbook:
+        def save(self, f):
+            f.write(b"PK\x03\x04 partial")
+            raise OSError("simulated crash during save")
+
+    try:
+        atomic_save(CrashingWorkbook(), filepath)
+    except OSError:
+        pass
+    load_workbook(filepath)
+
+    writes = args.users * expected
+    print(f"users {args.users} | visits {writes} | {elapsed:.2f} s | {writes / elapsed:.0f} visits/s")
+    print(f"lost visits {lost} | broken slot sequences {broken_slots} | interrupted save: file intact")
+    if lost or broken_slots:
+        sys.exit(1)
+    print("✅ لا توجد زيارات مفقودة")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MedMap bot local harness")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    render = commands.add_parser("bench-render", help="قياس زمن إنشاء التقرير")
+    render.add_argument("--iterations", type=int, default=200)
+    render.set_defaults(func=bench_render)
+
+    stream = commands.add_parser("bench-stream", help="قياس ذاكرة الرسم المتدفق")
+    stream.add_argument("--reports", type=int, default=500)
+    stream.set_defaults(func=bench_stream)
+
+    webhook = commands.add_parser("webhook-selftest", help="تشغيل المسار الكامل عبر الـ webhook")
+    webhook.add_argument("--users", type=int, default=20)
+    webhook.add_argument("--timeout", type=float, default=60)
+    webhook.set_defaults(func=lambda args: asyncio.run(webhook_selftest(args)))
+
+    hammer = commands.add_parser("stress", help="زيارات متزامنة كثيرة للتأكد من عدم ضياع البيانات")
+    hammer.add_argument("--users", type=int, default=50)
+    hammer.add_argument("--visits", type=int, default=20)
+    hammer.set_defaults(func=lambda args: asyncio.run(stress(args)))
+
+    flow = commands.add_parser("bench-flow", help="قياس زمن المحادثة الكاملة لعدة مندوبين")
+    flow.add_argument("--users", type=int, default=100)
+    flow.add_argument("--resends", type=int, default=1, help="عدد مرات إعادة إرسال نفس التقرير")
+    flow.add_argument("--max-p95", type=float, default=0,
+                      help="الخروج بخطأ لو تجاوز p95 هذا الحد بالـ ms (0 = بدون حد)")
+    flow.set_defaults(func=lambda args: asyncio.run(bench_flow(args)))
+
+    quick = commands.add_parser("bench-quick", help="الإدخال السريع مقابل المحادثة خطوة بخطوة")
+    quick.add_argument("--users", type=int, default=50)
+    quick.add_argument("--visits", type=int, default=12, help="عدد الزيارات لكل مندوب")
+    quick.set_defaults(func=lambda args: asyncio.run(bench_quick(args)))
+
+    limits = commands.add_parser("ratelimit-selftest", help="حدود الإرسال وإعادة المحاولة أمام Bot API يرد بـ 429")
+    limits.add_argument("--users", type=int, default=40)
+    limits.add_argument("--global-rate", type=float, default=25, help="حد الـ limiter العام (رسالة/ثانية)")
+    limits.add_argument("--flood-rate", type=float, default=0.01, help="نسبة ردود 429 العشوائية")
+    limits.add_argument("--upload-latency", type=float, default=0.0, help="زمن رفع كل ملف بالثواني")
+    limits.set_defaults(func=lambda args: asyncio.run(ratelimit_selftest(args)))
+
+    scheduler = commands.add_parser("scheduler-selftest", help="التذكير والإرسال التلقائي ليوم كامل بساعة وهمية")
+    scheduler.add_argument("--users", type=int, default=2000)
+    scheduler.add_argument("--tick", type=float, default=30, help="الفاصل بين كل فحص بالثواني")
+    scheduler.set_defaults(func=lambda args: asyncio.run(scheduler_selftest(args)))
+
+    startup = commands.add_parser("bench-startup", help="زمن البدء البارد حتى أول رد وأول تقرير")
+    startup.add_argument("--runs", type=int, default=5)
+    startup.set_defaults(func=bench_startup)
+
+    storage = commands.add_parser("storage-selftest", help="التخزين الدائم مقابل S3 وهمي")
+    storage.add_argument("--users", type=int, default=20)
+    storage.add_argument("--latency", type=float, default=0.05, help="زمن كل طلب S3 بالثواني")
+    storage.set_defaults(func=lambda args: asyncio.run(storage_selftest(args)))
+
+    shard = commands.add_parser("shard-selftest", help="موزع وعدة عمليات عمال على نفس الجهاز")
+    shard.add_argument("--workers", type=int, default=4)
+    shard.add_argument("--users", type=int, default=40)
+    shard.add_argument("--timeout", type=float, default=120)
+    shard.set_defaults(func=lambda args: asyncio.run(shard_selftest(args)))
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,57 @@
 import logging
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram import Bot, Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
 from telegram.ext import (
     Application,
+    BasePersistence,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     ConversationHandler,
     ContextTypes,
+    PersistenceInput,
     filters,
 )
-from openpyxl import Workbook, load_workbook
-from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+import asyncio
+import contextlib
+import copy
+import argparse
+import bisect
+import functools
+import hashlib
+import heapq
+import hmac
+import io
+import itertools
 import os
 import json
-from dotenv import load_dotenv
+import re
+import shutil
+import signal
+import multiprocessing
+import sqlite3
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from urllib.parse import quote, urlsplit
+from xml.etree import ElementTree
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+import httpx  # تستخدمه python-telegram-bot نفسها، فلا فائدة من تأجيله
 
-# 1. تحميل متغيرات البيئة
-load_dotenv()
+# openpyxl وpandas وuvicorn تُستورد داخل الدوال التي تحتاجها فقط حتى يبدأ البوت أسرع،
+# وقالب التقرير يُجهز في الخلفية بعد بدء البوت (انظر prewarm)
+
+# 1. تحميل متغيرات البيئة من .env عند تشغيل الملف مباشرة فقط (قبل قراءة الإعدادات بالأسفل)؛
+# العمليات الفرعية ترث البيئة من العملية الأم، والـ harness لا يجب أن يقرأ .env الحقيقي
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
 
 # 2. جلب التوكن من النظام
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -32,77 +67,1715 @@ logger = logging.getLogger(__name__)
 MAIN_MENU, VISIT_TYPE, DOCTOR_NAME, LOCATION, SPECIALTY, PRODUCTS, COMMENT = range(7)
 PHARMACY_NAME, PHARMACY_ADDRESS, PHARMACY_PRODUCTS, PHARMACY_COMMENT = range(7, 11)
 FIRST_NAME_INPUT, LAST_NAME_INPUT = 11, 12
+QUICK_ENTRY = 13
 
-REPORTS_DIR = "reports"
-if not os.path.exists(REPORTS_DIR):
-    os.makedirs(REPORTS_DIR)
+REPORTS_DIR = "reports"  # يُنشأ عند أول كتابة (atomic_write)
 
 USERS_DATA_FILE = "users_data.json"
 
+# وضع التشغيل: polling للتطوير أو webhook للإنتاج
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # الرابط العام مثل https://medmap.up.railway.app
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+
+# عنوان Bot API (يمكن توجيهه لخادم Bot API محلي أو بديل للاختبار)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+
+# عدد عمليات العمال: 1 = عملية واحدة كالسابق، أكثر = موزع يوجه كل مندوب لعامل ثابت
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+
+# عدد التحديثات التي تُعالج في نفس الوقت (لمستخدمين مختلفين)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+
+# حدود الإرسال لتيليجرام: رسائل في الثانية لكل محادثة وللبوت كله، مع رصيد للدفعات القصيرة (0 = بدون حد)
+RATE_CHAT_PER_SECOND = float(os.getenv("RATE_CHAT_PER_SECOND", "1"))
+RATE_CHAT_BURST = int(os.getenv("RATE_CHAT_BURST", "3"))
+RATE_GLOBAL_PER_SECOND = float(os.getenv("RATE_GLOBAL_PER_SECOND", "25"))
+RATE_GLOBAL_BURST = int(os.getenv("RATE_GLOBAL_BURST", "5"))
+
+# عدد مرات إعادة المحاولة بعد RetryAfter، وأساس الانتظار الإضافي (يتضاعف مع كل محاولة)
+RATE_MAX_RETRIES = int(os.getenv("RATE_MAX_RETRIES", "3"))
+RATE_RETRY_BACKOFF = float(os.getenv("RATE_RETRY_BACKOFF", "0.5"))
+
+# رسالة "جاري الإرسال" تظهر فقط لو تأخر الإرسال أكثر من هذه المدة بالثواني
+PLACEHOLDER_DELAY = float(os.getenv("PLACEHOLDER_DELAY", "1.5"))
+
+# البوت يتعامل مع الرسائل النصية والأوامر فقط
+ALLOWED_UPDATES = [Update.MESSAGE]
+
+# قاعدة البيانات المحلية (يفضل وضعها على volume دائم)
+DB_FILE = os.getenv("DB_FILE", "medmap.db")
+
+# كل كم ثانية يحفظ البوت حالة المحادثات (الكتابة مجمعة في transaction واحدة)
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", "5"))
+
+# المشرفين المسموح لهم بالأوامر الإدارية (أرقام user_id مفصولة بفاصلة)
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x}
+
+# إعدادات التصدير المجمع
+EXPORT_DIR = os.getenv("EXPORT_DIR", "exports")
+
+# الفترة الافتراضية لأمر /analytics بالأيام، وعدد الصفوف في كل جدول
+ANALYTICS_DAYS = int(os.getenv("ANALYTICS_DAYS", "28"))
+ANALYTICS_TOP = int(os.getenv("ANALYTICS_TOP", "10"))
+
+# عدد الـ threads المخصصة لعمليات Excel وأقصى عدد عمليات معلقة في الطابور
+EXCEL_WORKERS = int(os.getenv("EXCEL_WORKERS", "4"))
+EXCEL_QUEUE_SIZE = int(os.getenv("EXCEL_QUEUE_SIZE", "64"))
+
+# المنطقة الزمنية الافتراضية للمندوبين (فارغ = توقيت الخادم) وساعة بداية يوم التقرير
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE", "")
+DAY_CUTOFF = os.getenv("DAY_CUTOFF", "00:00")
+
+# بتوقيت كل مندوب: تذكير لو لم يسجل أي زيارة حتى REMINDER_TIME، وإرسال التقرير تلقائياً عند AUTO_SEND_TIME
+# (فارغ = تعطيل)، وكل كم ثانية تُفحص المواعيد المستحقة
+REMINDER_TIME = os.getenv("REMINDER_TIME", "13:00")
+AUTO_SEND_TIME = os.getenv("AUTO_SEND_TIME", "21:00")
+SCHEDULER_TICK = float(os.getenv("SCHEDULER_TICK", "30"))
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", "8"))
+
+# لو كان البوت متوقفاً وقت الإرسال التلقائي يُرسل التقرير عند التشغيل خلال هذه المدة بالثواني
+AUTO_SEND_CATCHUP = float(os.getenv("AUTO_SEND_CATCHUP", "3600"))
+
+# إغلاق تقارير الأيام المنتهية وأرشفتها في ملف zip لكل شهر ثم حذف القديم
+ROLLOVER_INTERVAL = float(os.getenv("ROLLOVER_INTERVAL", "600"))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "7"))
+RETENTION_MONTHS = int(os.getenv("RETENTION_MONTHS", "12"))  # 0 = الاحتفاظ بكل الأرشيف
+
+# التخزين الدائم للتقارير والأرشيف: none (القرص المحلي فقط) أو local (مجلد دائم) أو s3
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "none")
+STORAGE_DIR = os.getenv("STORAGE_DIR", "storage")
+STORAGE_WORKERS = int(os.getenv("STORAGE_WORKERS", "4"))
+STORAGE_RETRY_DELAY = float(os.getenv("STORAGE_RETRY_DELAY", "30"))
+S3_ENDPOINT = os.getenv("S3_ENDPOINT", "")  # مثل https://s3.eu-central-1.amazonaws.com أو http://minio:9000
+S3_BUCKET = os.getenv("S3_BUCKET", "")
+S3_REGION = os.getenv("S3_REGION", "us-east-1")
+S3_ACCESS_KEY = os.getenv("S3_ACCESS_KEY", "")
+S3_SECRET_KEY = os.getenv("S3_SECRET_KEY", "")
+S3_PREFIX = os.getenv("S3_PREFIX", "")
+S3_PART_SIZE = int(os.getenv("S3_PART_SIZE", str(8 * 1024 * 1024)))
+
+# عدد القيم المقترحة كأزرار عند إدخال اسم الدكتور والمكان والتخصص والمنتجات
+SUGGESTION_LIMIT = int(os.getenv("SUGGESTION_LIMIT", "6"))
+
+# عدد التقارير المرسومة التي تبقى بايتاتها في الذاكرة لإعادة الإرسال
+REPORT_CACHE_SIZE = int(os.getenv("REPORT_CACHE_SIZE", "256"))
+
+# خادم المقاييس المحلي (0 = معطل) وفترة قياس تأخر الـ event loop بالثواني
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+
+# --- المقاييس (Prometheus) ---
+class Metrics:
+    """عدادات وهيستوجرامات بصيغة Prometheus النصية، آمنة للاستخدام من الـ threads"""
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._counters = {}
+        # (الاسم، labels) -> [عدد كل bucket (غير تراكمي)، المجموع، العدد]
+        self._histograms = {}
+        self._gauges = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        index = bisect.bisect_left(self.BUCKETS, seconds)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0]
+            hist[0][index] += 1
+            hist[1] += seconds
+            hist[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def gauge(self, name, func):
+        """تسجيل قيمة تُقرأ لحظة الطلب (مثل طول الطابور)"""
+        self._gauges[name] = func
+
+    def _quantile(self, buckets, count, q):
+        """تقدير quantile من حدود الـ buckets (الحد الأعلى للـ bucket)"""
+        target = q * count
+        seen = 0
+        for bound, n in zip(self.BUCKETS + (float("inf"),), buckets):
+            seen += n
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def summary(self, name):
+        """[(labels، العدد، المتوسط، p95)] لهيستوجرام معين، لأمر /stats"""
+        with self._lock:
+            items = sorted((k[1], list(v[0]), v[1], v[2]) for k, v in self._histograms.items() if k[0] == name)
+        return [
+            (dict(labels), count, total / count, self._quantile(buckets, count, 0.95))
+            for labels, buckets, total, count in items
+        ]
+
+    def read_gauge(self, name, default=0):
+        func = self._gauges.get(name)
+        try:
+            return func() if func else default
+        except Exception:
+            return default
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+    def render(self):
+        """كل المقاييس بصيغة Prometheus text exposition"""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._histograms.items())
+        lines = []
+        for name, group in itertools.groupby(counters, key=lambda item: item[0][0]):
+            lines.append(f"# TYPE {name} counter")
+            for (_, labels), value in group:
+                lines.append(f"{name}{self._labels(labels)} {value}")
+        for name, group in itertools.groupby(histograms, key=lambda item: item[0][0]):
+            lines.append(f"# TYPE {name} histogram")
+            for (_, labels), (buckets, total, count) in group:
+                cumulative = 0
+                for bound, n in zip(self.BUCKETS + (float("inf"),), buckets):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', le)])} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(labels)} {total}")
+                lines.append(f"{name}_count{self._labels(labels)} {count}")
+        for name in sorted(self._gauges):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {self.read_gauge(name)}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.gauge("medmap_uptime_seconds", lambda: round(time.time() - metrics.started_at, 1))
+
+# --- قاعدة البيانات ---
+def open_db(path=DB_FILE):
+    """فتح اتصال SQLite بوضع WAL للسماح بالقراءة أثناء الكتابة"""
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
 # --- دوال إدارة بيانات المستخدمين ---
-def load_users_data():
-    """تحميل بيانات المستخدمين من الملف"""
-    if os.path.exists(USERS_DATA_FILE):
-        with open(USERS_DATA_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {}
+class UserStore:
+    """مخزن المستخدمين: SQLite للحفظ الدائم ونسخة في الذاكرة للقراءة الفورية"""
+
+    def __init__(self, db_file=DB_FILE, legacy_file=USERS_DATA_FILE):
+        self.db_file = db_file
+        self.legacy_file = legacy_file
+        self._conn = None
+        self._users = None
+        self._lock = threading.Lock()
+
+    def _ensure_loaded(self):
+        if self._users is not None:
+            return
+        with self._lock, metrics.timer("medmap_users_seconds", op="load"):
+            if self._users is not None:
+                return
+            conn = open_db(self.db_file)
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY,
+                    first_name TEXT NOT NULL,
+                    full_name TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    tz TEXT NOT NULL DEFAULT ''
+                )"""
+            )
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(users)")}
+            if "tz" not in columns:
+                with conn:
+                    conn.execute("ALTER TABLE users ADD COLUMN tz TEXT NOT NULL DEFAULT ''")
+            self._migrate_legacy(conn)
+            self._users = {
+                row["user_id"]: {
+                    'first_name': row["first_name"],
+                    'full_name': row["full_name"],
+                    'created_at': row["created_at"],
+                    'tz': row["tz"],
+                }
+                for row in conn.execute("SELECT * FROM users")
+            }
+            self._conn = conn
+
+    def _migrate_legacy(self, conn):
+        """نقل البيانات من users_data.json القديم مرة واحدة"""
+        # مع عدة عمال تنقله كل عملية عند أول استخدام، فقد تكون عملية أخرى نقلته بالفعل (INSERT OR IGNORE يمنع التكرار)
+        try:
+            with open(self.legacy_file, 'r', encoding='utf-8') as f:
+                legacy = json.load(f)
+        except FileNotFoundError:
+            return
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO users (user_id, first_name, full_name, created_at) "
+                "VALUES (?, ?, ?, ?)",
+                [
+                    (int(uid), u['first_name'], u['full_name'], u.get('created_at', ''))
+                    for uid, u in legacy.items()
+                ]
+            )
+        with contextlib.suppress(FileNotFoundError):
+            os.replace(self.legacy_file, self.legacy_file + ".migrated")
+        logger.info("تم نقل %d مستخدم من %s", len(legacy), self.legacy_file)
+
+    def get(self, user_id):
+        self._ensure_loaded()
+        return self._users.get(int(user_id))
+
+    def all(self):
+        self._ensure_loaded()
+        return dict(self._users)
+
+    def save(self, user_id, first_name, full_name):
+        self._ensure_loaded()
+        previous = self._users.get(int(user_id)) or {}
+        record = {
+            'first_name': first_name,
+            'full_name': full_name,
+            'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'tz': previous.get('tz', ''),
+        }
+        with self._lock:
+            with self._conn:
+                # المنطقة الزمنية تبقى كما هي عند تسجيل الاسم من جديد
+                self._conn.execute(
+                    """INSERT INTO users (user_id, first_name, full_name, created_at)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        first_name = excluded.first_name,
+                        full_name = excluded.full_name,
+                        created_at = excluded.created_at""",
+                    (int(user_id), first_name, full_name, record['created_at'])
+                )
+            self._users[int(user_id)] = record
+        return record
+
+    def set_timezone(self, user_id, tz):
+        """حفظ المنطقة الزمنية للمستخدم، وإرجاع False لو لم يسجل بعد"""
+        self._ensure_loaded()
+        with self._lock:
+            record = self._users.get(int(user_id))
+            if record is None:
+                return False
+            with self._conn:
+                self._conn.execute("UPDATE users SET tz = ? WHERE user_id = ?", (tz, int(user_id)))
+            self._users[int(user_id)] = {**record, 'tz': tz}
+        return True
+
+    def timezones(self):
+        """{user_id: tz} من قاعدة البيانات مباشرة، وليس من نسخة الذاكرة
+
+        مع عدة عمال يسجل المندوب أو يغير منطقته الزمنية في عامل آخر، فلا تراه نسخة هذه العملية.
+        """
+        self._ensure_loaded()
+        with self._lock, metrics.timer("medmap_users_seconds", op="timezones"):
+            return {row["user_id"]: row["tz"] for row in self._conn.execute("SELECT user_id, tz FROM users")}
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+            self._users = None
+
+user_store = UserStore()
 
 def save_user_data(user_id, first_name, full_name):
     """حفظ بيانات مستخدم جديد"""
-    users_data = load_users_data()
-    users_data[str(user_id)] = {
-        'first_name': first_name,
-        'full_name': full_name,
-        'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    }
-    with open(USERS_DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(users_data, f, ensure_ascii=False, indent=2)
+    with metrics.timer("medmap_users_seconds", op="save"):
+        user_store.save(user_id, first_name, full_name)
 
 def get_user_data(user_id):
     """جلب بيانات مستخدم محدد"""
-    users_data = load_users_data()
-    return users_data.get(str(user_id))
+    with metrics.timer("medmap_users_seconds", op="get"):
+        return user_store.get(user_id)
+
+# --- المناطق الزمنية ويوم التقرير ---
+def parse_cutoff(value):
+    """HH:MM -> timedelta (الوقت قبلها يُحسب على اليوم السابق)"""
+    hours, minutes = value.split(":")
+    return timedelta(hours=int(hours), minutes=int(minutes))
+
+DAY_CUTOFF_DELTA = parse_cutoff(DAY_CUTOFF)
+
+@functools.lru_cache(maxsize=None)
+def load_timezone(name):
+    """ZoneInfo بالاسم، أو None لتوقيت الخادم"""
+    return ZoneInfo(name) if name else None
+
+def user_timezone(user_id=None):
+    user = user_store.get(user_id) if user_id is not None else None
+    return load_timezone((user or {}).get('tz') or DEFAULT_TIMEZONE)
+
+def report_day(user_id=None, now=None):
+    """يوم التقرير الحالي للمستخدم حسب منطقته الزمنية وساعة القطع"""
+    now = now or datetime.now(user_timezone(user_id))
+    return (now - DAY_CUTOFF_DELTA).date()
+
+# --- حفظ حالة المحادثات ---
+class SQLitePersistence(BasePersistence):
+    """حفظ حالة المحادثات و user_data في SQLite حتى لا تضيع الزيارات غير المكتملة عند إعادة التشغيل"""
+
+    def __init__(self, db_file=DB_FILE, update_interval=PERSISTENCE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.db_file = db_file
+        self._conn = None
+        self._lock = threading.Lock()
+        self._user_data = None
+        self._conversations = None
+        self._dirty_users = set()
+        self._dropped_users = set()
+        self._dirty_conversations = set()
+        self._write_task = None
+
+    def _get_conn(self):
+        if self._conn is None:
+            conn = open_db(self.db_file)
+            conn.executescript(
+                """CREATE TABLE IF NOT EXISTS conversation_user_data (
+                    user_id INTEGER PRIMARY KEY,
+                    data TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS conversation_states (
+                    name TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    PRIMARY KEY (name, key)
+                );"""
+            )
+            self._conn = conn
+        return self._conn
+
+    def _load(self):
+        if self._user_data is not None:
+            return
+        with self._lock:
+            conn = self._get_conn()
+            self._user_data = {
+                row["user_id"]: json.loads(row["data"])
+                for row in conn.execute("SELECT * FROM conversation_user_data")
+            }
+            self._conversations = {}
+            for row in conn.execute("SELECT * FROM conversation_states"):
+                key = tuple(json.loads(row["key"]))
+                self._conversations.setdefault(row["name"], {})[key] = json.loads(row["state"])
+
+    async def get_user_data(self):
+        self._load()
+        return {user_id: dict(data) for user_id, data in self._user_data.items()}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        self._load()
+        return dict(self._conversations.get(name, {}))
+
+    async def update_user_data(self, user_id, data):
+        self._load()
+        if self._user_data.get(user_id) == data:
+            return
+        self._user_data[user_id] = dict(data)
+        self._dirty_users.add(user_id)
+        self._dropped_users.discard(user_id)
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id):
+        self._load()
+        self._user_data.pop(user_id, None)
+        self._dirty_users.discard(user_id)
+        self._dropped_users.add(user_id)
+        self._schedule_write()
+
+    async def update_conversation(self, name, key, new_state):
+        self._load()
+        conversations = self._conversations.setdefault(name, {})
+        if conversations.get(key) == new_state:
+            return
+        if new_state is None:
+            conversations.pop(key, None)
+        else:
+            conversations[key] = new_state
+        self._dirty_conversations.add((name, key))
+        self._schedule_write()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    def _schedule_write(self):
+        """تجميع كل التعديلات في نفس دورة الحفظ في كتابة واحدة"""
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._write_soon())
+
+    async def _write_soon(self):
+        await asyncio.sleep(0.05)
+        batch = self._take_batch()
+        await asyncio.get_running_loop().run_in_executor(None, self._write, batch)
+
+    def _take_batch(self):
+        """أخذ نسخة من التعديلات المعلقة وتفريغها (على الـ event loop)"""
+        users = [
+            (user_id, json.dumps(self._user_data[user_id], ensure_ascii=False, default=str))
+            for user_id in self._dirty_users if user_id in self._user_data
+        ]
+        dropped = [(user_id,) for user_id in self._dropped_users]
+        conversations = [
+            (name, json.dumps(list(key)), self._conversations.get(name, {}).get(key))
+            for name, key in self._dirty_conversations
+        ]
+        self._dirty_users.clear()
+        self._dropped_users.clear()
+        self._dirty_conversations.clear()
+        return users, dropped, conversations
+
+    def _write(self, batch):
+        users, dropped, conversations = batch
+        if not (users or dropped or conversations):
+            return
+        with self._lock:
+            conn = self._get_conn()
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO conversation_user_data VALUES (?, ?)", users
+                )
+                conn.executemany(
+                    "DELETE FROM conversation_user_data WHERE user_id = ?", dropped
+                )
+                conn.executemany(
+                    "DELETE FROM conversation_states WHERE name = ? AND key = ?",
+                    [(name, key) for name, key, state in conversations if state is None]
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO conversation_states VALUES (?, ?, ?)",
+                    [(name, key, json.dumps(state)) for name, key, state in conversations
+                     if state is not None]
+                )
+
+    async def flush(self):
+        """حفظ كل التعديلات المعلقة عند إيقاف البوت"""
+        if self._write_task is not None and not self._write_task.done():
+            await self._write_task
+        if self._user_data is not None:
+            self._write(self._take_batch())
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+# --- مخزن الزيارات ---
+# عدد صفوف كل قسم في القالب القياسي
+SECTION_SIZES = {"AM": 7, "PM": 13, "PHARMACY": 7}
+
+# عمود عداد الخانات المستخدمة لكل قسم في جدول reports
+COUNT_COLUMNS = {"AM": "am_count", "PM": "pm_count", "PHARMACY": "pharmacy_count"}
+
+# عند امتلاء قسم: grow = زيادة صفوف القسم، drop = تجاهل الزيارة كالسابق
+REPORT_OVERFLOW = os.getenv("REPORT_OVERFLOW", "grow")
+
+# مفاتيح الاسم والمكان في بيانات كل نوع زيارة
+VISIT_KEYS = {
+    "AM": ("Dr", "Hospital"),
+    "PM": ("Dr", "Area"),
+    "PHARMACY": ("Pharmacy", "Address"),
+}
+
+class VisitStore:
+    """تخزين التقارير والزيارات كصفوف في SQLite (المصدر الأساسي للبيانات)"""
+
+    def __init__(self, db_file=DB_FILE):
+        self.db_file = db_file
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _get_conn(self):
+        if self._conn is None:
+            conn = open_db(self.db_file)
+            conn.executescript(
+                """CREATE TABLE IF NOT EXISTS reports (
+                    user_id INTEGER NOT NULL,
+                    report_date TEXT NOT NULL,
+                    first_name TEXT NOT NULL,
+                    full_name TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    version INTEGER NOT NULL DEFAULT 0,
+                    am_count INTEGER NOT NULL DEFAULT 0,
+                    pm_count INTEGER NOT NULL DEFAULT 0,
+                    pharmacy_count INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (user_id, report_date)
+                );
+                CREATE TABLE IF NOT EXISTS visits (
+                    user_id INTEGER NOT NULL,
+                    report_date TEXT NOT NULL,
+                    section TEXT NOT NULL,
+                    slot INTEGER NOT NULL,
+                    name TEXT,
+                    place TEXT,
+                    specialty TEXT,
+                    products TEXT,
+                    comment TEXT,
+                    created_at TEXT NOT NULL,
+                    PRIMARY KEY (user_id, report_date, section, slot)
+                );"""
+            )
+            self._migrate_counters(conn)
+            self._migrate_lifecycle(conn)
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _migrate_counters(conn):
+        """إضافة عدادات الخانات لقواعد البيانات القديمة وحسابها من الزيارات"""
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(reports)")}
+        missing = [col for col in COUNT_COLUMNS.values() if col not in columns]
+        if not missing:
+            return
+        with conn:
+            for col in missing:
+                conn.execute(f"ALTER TABLE reports ADD COLUMN {col} INTEGER NOT NULL DEFAULT 0")
+            for section, col in COUNT_COLUMNS.items():
+                conn.execute(
+                    f"""UPDATE reports SET {col} = (
+                        SELECT COALESCE(MAX(slot) + 1, 0) FROM visits v
+                        WHERE v.user_id = reports.user_id
+                        AND v.report_date = reports.report_date
+                        AND v.section = ?
+                    )""",
+                    (section,)
+                )
+
+    @staticmethod
+    def _migrate_lifecycle(conn):
+        """أعمدة إغلاق اليوم والأرشفة، مع فهارس جزئية للتقارير التي لم تُغلق أو تُؤرشف بعد"""
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(reports)")}
+        with conn:
+            for col in ("finalized_at", "archived_at", "archive_bundle"):
+                if col not in columns:
+                    conn.execute(f"ALTER TABLE reports ADD COLUMN {col} TEXT")
+            # آخر نسخة أُرسلت من التقرير (يدوياً أو تلقائياً)
+            if "sent_version" not in columns:
+                conn.execute("ALTER TABLE reports ADD COLUMN sent_version INTEGER")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS reports_open ON reports (report_date) "
+                "WHERE finalized_at IS NULL"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS reports_unarchived ON reports (report_date) "
+                "WHERE archived_at IS NULL"
+            )
+
+    def create_report(self, user_id, report_date, first_name, full_name):
+        """إنشاء تقرير اليوم (إعادة الإنشاء تبدأ تقريراً فارغاً كما في الملف القديم)"""
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self._lock:
+            conn = self._get_conn()
+            with conn:
+                # التقرير المغلق لا يتغير (التحليلات تفهرسه مرة واحدة)
+                finalized = conn.execute(
+                    "SELECT 1 FROM reports WHERE user_id = ? AND report_date = ? AND finalized_at IS NOT NULL",
+                    (user_id, report_date)
+                ).fetchone()
+                if finalized:
+                    return
+                conn.execute(
+                    "DELETE FROM visits WHERE user_id = ? AND report_date = ?",
+                    (user_id, report_date)
+                )
+                conn.execute(
+                    """INSERT INTO reports (user_id, report_date, first_name, full_name, created_at)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (user_id, report_date) DO UPDATE SET
+                        first_name = excluded.first_name,
+                        full_name = excluded.full_name,
+                        created_at = excluded.created_at,
+                        version = version + 1,
+                        am_count = 0,
+                        pm_count = 0,
+                        pharmacy_count = 0""",
+                    (user_id, report_date, first_name, full_name, now)
+                )
+
+    def add_visit(self, user_id, report_date, visit_type, data):
+        """حفظ زيارة في الخانة التالية بالقسم، وإرجاع False لو التقرير غير موجود"""
+        return self.add_visits(user_id, report_date, [(visit_type, data)]) is not None
+
+    def add_visits(self, user_id, report_date, visits):
+        """حفظ عدة زيارات [(visit_type, data)] في transaction واحدة
+
+        يرجع الزيارات المحفوظة فعلاً (بدون المتجاهلة لامتلاء القسم)، أو None لو التقرير غير موجود
+        أو أُغلق بانتهاء يومه.
+        """
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self._lock:
+            conn = self._get_conn()
+            with conn:
+                report = conn.execute(
+                    "SELECT am_count, pm_count, pharmacy_count FROM reports "
+                    "WHERE user_id = ? AND report_date = ? AND finalized_at IS NULL",
+                    (user_id, report_date)
+                ).fetchone()
+                if report is None:
+                    return None
+                slots = {visit_type: report[col] for visit_type, col in COUNT_COLUMNS.items()}
+                rows = []
+                saved = []
+                for visit_type, data in visits:
+                    slot = slots[visit_type]
+                    if REPORT_OVERFLOW == "drop" and slot >= SECTION_SIZES[visit_type]:
+                        logger.warning("Section %s full for user %s, visit dropped", visit_type, user_id)
+                        continue
+                    slots[visit_type] = slot + 1
+                    saved.append((visit_type, data))
+                    name_key, place_key = VISIT_KEYS[visit_type]
+                    rows.append((
+                        user_id, report_date, visit_type, slot,
+                        data.get(name_key, ""),
+                        data.get(place_key, ""),
+                        data.get("Specialty", ""),
+                        data.get("Products", ""),
+                        data.get("Comment", ""),
+                        now,
+                    ))
+                if rows:
+                    conn.execute(
+                        "UPDATE reports SET version = version + 1, "
+                        "am_count = ?, pm_count = ?, pharmacy_count = ? "
+                        "WHERE user_id = ? AND report_date = ?",
+                        (slots["AM"], slots["PM"], slots["PHARMACY"], user_id, report_date)
+                    )
+                    conn.executemany("INSERT INTO visits VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        return saved
+
+    def get_report(self, user_id, report_date):
+        with self._lock:
+            return self._get_conn().execute(
+                "SELECT * FROM reports WHERE user_id = ? AND report_date = ?",
+                (user_id, report_date)
+            ).fetchone()
+
+    def get_visits(self, user_id, report_date):
+        with self._lock:
+            return self._get_conn().execute(
+                "SELECT * FROM visits WHERE user_id = ? AND report_date = ? "
+                "ORDER BY section, slot",
+                (user_id, report_date)
+            ).fetchall()
+
+    def import_report(self, user_id, report_date, first_name, full_name, visits):
+        """إضافة تقرير قديم بزياراته [(visit_type, data)] في transaction واحدة، وFalse لو كان موجوداً"""
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        slots = Counter(visit_type for visit_type, _ in visits)
+        with self._lock:
+            conn = self._get_conn()
+            with conn:
+                inserted = conn.execute(
+                    "INSERT OR IGNORE INTO reports "
+                    "(user_id, report_date, first_name, full_name, created_at, am_count, pm_count, pharmacy_count) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (user_id, report_date, first_name, full_name, now,
+                     slots["AM"], slots["PM"], slots["PHARMACY"])
+                ).rowcount
+                if not inserted:
+                    return False
+                used = Counter()
+                rows = []
+                for visit_type, data in visits:
+                    name_key, place_key = VISIT_KEYS[visit_type]
+                    rows.append((
+                        user_id, report_date, visit_type, used[visit_type],
+                        data.get(name_key, ""),
+                        data.get(place_key, ""),
+                        data.get("Specialty", ""),
+                        data.get("Products", ""),
+                        data.get("Comment", ""),
+                        now,
+                    ))
+                    used[visit_type] += 1
+                conn.executemany("INSERT INTO visits VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        return True
+
+    def iter_report_visits(self, date_from=None, date_to=None, user_ids=None):
+        """سجلات الزيارات مرتبة بالمستخدم والتاريخ، بقراءة متدفقة من اتصال مستقل"""
+        query = (
+            "SELECT r.user_id, r.report_date, r.first_name, r.full_name, "
+            "v.section, v.slot, v.name, v.place, v.specialty, v.products, v.comment "
+            "FROM reports r LEFT JOIN visits v "
+            "ON v.user_id = r.user_id AND v.report_date = r.report_date "
+            "WHERE 1 = 1"
+        )
+        params = []
+        if date_from:
+            query += " AND r.report_date >= ?"
+            params.append(date_from)
+        if date_to:
+            query += " AND r.report_date <= ?"
+            params.append(date_to)
+        if user_ids:
+            query += f" AND r.user_id IN ({', '.join('?' * len(user_ids))})"
+            params.extend(user_ids)
+        query += " ORDER BY r.user_id, r.report_date, v.section, v.slot"
+        
+        self._get_conn()  # التأكد من وجود الجداول
+        conn = open_db(self.db_file)
+        try:
+            yield from conn.execute(query, params)
+        finally:
+            conn.close()
+
+    def mark_sent(self, user_id, report_date, version):
+        with self._lock:
+            conn = self._get_conn()
+            with conn:
+                conn.execute(
+                    "UPDATE reports SET sent_version = MAX(COALESCE(sent_version, 0), ?) "
+                    "WHERE user_id = ? AND report_date = ?",
+                    (version, user_id, report_date)
+                )
+
+    def open_reports(self):
+        """التقارير التي لم تُغلق بعد (user_id, report_date)"""
+        with self._lock:
+            return self._get_conn().execute(
+                "SELECT user_id, report_date FROM reports WHERE finalized_at IS NULL"
+            ).fetchall()
+
+    def mark_finalized(self, keys):
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self._lock:
+            conn = self._get_conn()
+            with conn:
+                conn.executemany(
+                    "UPDATE reports SET finalized_at = ? WHERE user_id = ? AND report_date = ?",
+                    [(now, user_id, report_date) for user_id, report_date in keys]
+                )
+
+    def reports_to_archive(self, before):
+        """التقارير المغلقة الأقدم من before ولم تُؤرشف بعد"""
+        with self._lock:
+            return self._get_conn().execute(
+                "SELECT user_id, report_date, first_name FROM reports "
+                "WHERE archived_at IS NULL AND finalized_at IS NOT NULL AND report_date < ? "
+                "ORDER BY report_date",
+                (before,)
+            ).fetchall()
+
+    def unarchived_reports(self):
+        """التقارير التي قد يكون ملفها في مجلد التقارير (user_id, report_date, first_name)"""
+        with self._lock:
+            return self._get_conn().execute(
+                "SELECT user_id, report_date, first_name FROM reports WHERE archived_at IS NULL"
+            ).fetchall()
+
+    def mark_archived(self, entries):
+        """entries: [(user_id, report_date, bundle أو None لو لم يكن هناك ملف)]"""
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self._lock:
+            conn = self._get_conn()
+            with conn:
+                conn.executemany(
+                    "UPDATE reports SET archived_at = ?, archive_bundle = ? "
+                    "WHERE user_id = ? AND report_date = ?",
+                    [(now, bundle, user_id, report_date) for user_id, report_date, bundle in entries]
+                )
+
+    def forget_bundle(self, bundle):
+        """بعد حذف ملف أرشيف: البيانات تبقى في قاعدة البيانات ويمكن إعادة رسمها"""
+        with self._lock:
+            conn = self._get_conn()
+            with conn:
+                conn.execute(
+                    "UPDATE reports SET archive_bundle = NULL WHERE archive_bundle = ?", (bundle,)
+                )
+
+    def iter_visit_terms(self):
+        """قيم كل الزيارات المحفوظة لبناء فهرس الاقتراحات، بقراءة متدفقة من اتصال مستقل"""
+        self._get_conn()  # التأكد من وجود الجداول
+        conn = open_db(self.db_file)
+        try:
+            yield from conn.execute(
+                "SELECT user_id, section, name, place, specialty, products FROM visits"
+            )
+        finally:
+            conn.close()
+
+    def has_finalized_since(self, finalized_since, known):
+        """هل يوجد تقرير أُغلق منذ finalized_since وليس ضمن المفاتيح المعروفة (قراءة من الفهرس فقط)"""
+        with self._lock:
+            rows = self._get_conn().execute(
+                "SELECT user_id, report_date FROM reports WHERE finalized_at >= ?",
+                (finalized_since or "",)
+            )
+            return any((row["user_id"], row["report_date"]) not in known for row in rows)
+
+    def open_reports_token(self):
+        """بصمة التقارير المفتوحة: تتغير مع أي زيارة أو إنشاء أو إغلاق تقرير"""
+        with self._lock:
+            row = self._get_conn().execute(
+                "SELECT COUNT(*), COALESCE(SUM(version), 0), MAX(report_date) "
+                "FROM reports WHERE finalized_at IS NULL"
+            ).fetchone()
+            return tuple(row)
+
+    def iter_analytics_visits(self, finalized_since=None, open_reports=False):
+        """زيارات التقارير المغلقة منذ finalized_since (أو كلها)، أو زيارات التقارير المفتوحة فقط"""
+        query = (
+            "SELECT r.user_id, r.report_date, r.finalized_at, "
+            "v.section, v.name, v.place, v.specialty, v.products "
+            "FROM reports r JOIN visits v "
+            "ON v.user_id = r.user_id AND v.report_date = r.report_date "
+        )
+        if open_reports:
+            query += "WHERE r.finalized_at IS NULL"
+            params = ()
+        else:
+            query += "WHERE r.finalized_at >= ?"
+            params = (finalized_since or "",)
+        
+        self._get_conn()  # التأكد من وجود الجداول
+        conn = open_db(self.db_file)
+        try:
+            yield from conn.execute(query, params)
+        finally:
+            conn.close()
+
+    def list_report_users(self, date_from, date_to):
+        """المستخدمين الذين لديهم تقارير في الفترة مع آخر اسم كامل مسجل"""
+        with self._lock:
+            return [
+                (row["user_id"], row["full_name"])
+                for row in self._get_conn().execute(
+                    "SELECT user_id, full_name, MAX(report_date) FROM reports "
+                    "WHERE report_date BETWEEN ? AND ? "
+                    "GROUP BY user_id ORDER BY user_id",
+                    (date_from, date_to)
+                )
+            ]
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+visit_store = VisitStore()
+
+# --- الاقتراحات التلقائية ---
+# الحقل المقترح -> عمود الزيارة، لكل نوع زيارة
+SUGGESTION_FIELDS = {
+    "AM": {"doctor": "name", "hospital": "place", "specialty": "specialty", "products": "products"},
+    "PM": {"doctor": "name", "area": "place", "specialty": "specialty", "products": "products"},
+    "PHARMACY": {"pharmacy": "name", "address": "place", "products": "products"},
+}
+
+# توحيد أشكال الحروف العربية المتقاربة حتى لا تتفرق نفس القيمة بسبب الهمزات والتاء المربوطة
+ARABIC_FOLD = str.maketrans({"أ": "ا", "إ": "ا", "آ": "ا", "ة": "ه", "ى": "ي", "ـ": None})
+
+def normalize_term(text):
+    return " ".join(text.casefold().translate(ARABIC_FOLD).split())
+
+def trigrams(key, prefix=False):
+    """trigrams كل كلمة مع مسافتين قبلها؛ prefix=True لآخر كلمة في نص بحث لم يكتمل"""
+    words = key.split()
+    grams = set()
+    for i, word in enumerate(words):
+        padded = f"  {word}" if prefix and i == len(words) - 1 else f"  {word} "
+        grams.update(padded[j:j + 3] for j in range(len(padded) - 2))
+    return grams
+
+
+class TermIndex:
+    """قيم حقل واحد مع عدد مرات استخدامها وفهرس trigram للبحث بالبداية أو بالتشابه"""
+
+    TOP_SIZE = 20
+
+    def __init__(self):
+        self.terms = {}  # القيمة الموحدة -> [العدد، آخر كتابة لها]
+        self.grams = {}  # trigram -> القيم الموحدة التي تحتويه
+        self._top = []   # أكثر القيم استخداماً، مرتبة ومحدثة مع كل إضافة
+
+    def add(self, value):
+        key = normalize_term(value)
+        if not key:
+            return
+        entry = self.terms.get(key)
+        if entry is None:
+            entry = self.terms[key] = [0, value]
+            for gram in trigrams(key):
+                self.grams.setdefault(gram, set()).add(key)
+        entry[0] += 1
+        entry[1] = value.strip()
+        
+        # العدد يزيد فقط، فيكفي مقارنة القيمة بآخر عنصر في القائمة
+        top = self._top
+        if key in top or len(top) < self.TOP_SIZE or entry[0] > self.terms[top[-1]][0]:
+            if key not in top:
+                top.append(key)
+            top.sort(key=lambda k: -self.terms[k][0])
+            del top[self.TOP_SIZE:]
+
+    def top(self, limit):
+        return [self.terms[key][1] for key in self._top[:limit]]
+
+    def search(self, query, limit):
+        """المطابقة التامة ثم بداية كلمة، ثم الأكثر تشابهاً، ثم الأكثر استخداماً"""
+        q = normalize_term(query)
+        if not q:
+            return self.top(limit)
+        grams = trigrams(q, prefix=True)
+        shared = {}
+        for gram in grams:
+            for key in self.grams.get(gram, ()):
+                shared[key] = shared.get(key, 0) + 1
+        needed = max(1, len(grams) // 2)
+        ranked = heapq.nlargest(
+            limit,
+            (key for key, count in shared.items() if count >= needed),
+            key=lambda key: (key == q, f" {q}" in f" {key}", shared[key], self.terms[key][0]),
+        )
+        return [self.terms[key][1] for key in ranked]
+
+
+class Autocomplete:
+    """فهارس الاقتراحات لكل مندوب وللفريق كله: تُبنى مرة من قاعدة البيانات ثم تُحدّث مع كل زيارة"""
+
+    def __init__(self, limit=SUGGESTION_LIMIT):
+        self.limit = limit
+        self.loaded = False
+        # (user_id أو None للفريق، الحقل) -> TermIndex
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def _record(self, user_id, section, values):
+        for field, column in SUGGESTION_FIELDS.get(section, {}).items():
+            value = values[column]
+            if value:
+                for scope in (user_id, None):
+                    index = self._indexes.get((scope, field))
+                    if index is None:
+                        index = self._indexes[(scope, field)] = TermIndex()
+                    index.add(value)
+
+    def record(self, user_id, section, values):
+        """إضافة قيم زيارة محفوظة (values فيها name/place/specialty/products)
+
+        لا تفعل شيئاً قبل انتهاء load(): الزيارة محفوظة بالفعل وقد تقرأها load() فتُحسب مرتين.
+        """
+        if not self.loaded:
+            return
+        with self._lock:
+            self._record(user_id, section, values)
+
+    def load(self):
+        """بناء الفهارس من الزيارات المحفوظة مرة واحدة عند التشغيل"""
+        count = 0
+        for row in visit_store.iter_visit_terms():
+            with self._lock:
+                self._record(row["user_id"], row["section"], row)
+            count += 1
+        self.loaded = True
+        logger.info("Autocomplete index built from %d visits", count)
+
+    def suggest(self, user_id, field, query=None, limit=None):
+        """قيم المندوب نفسه أولاً ثم قيم باقي الفريق"""
+        limit = limit or self.limit
+        results, seen = [], set()
+        with metrics.timer("medmap_autocomplete_seconds"), self._lock:
+            for scope in (user_id, None):
+                index = self._indexes.get((scope, field))
+                if index is None:
+                    continue
+                for value in (index.search(query, limit) if query else index.top(limit)):
+                    key = normalize_term(value)
+                    if key not in seen:
+                        seen.add(key)
+                        results.append(value)
+                if len(results) >= limit:
+                    break
+        return results[:limit]
+
+autocomplete = Autocomplete()
+
+# --- الإدخال السريع ---
+# سطر لكل زيارة: القسم | الاسم | المكان | التخصص | المنتجات | تعليق (اختياري)
+# الصيدلية بدون تخصص، وسطر فيه اسم القسم وحده يجعله قسم الأسطر التالية
+QUICK_SEPARATOR = "|"
+QUICK_MAX_VISITS = 50
+
+QUICK_SECTIONS = {
+    "am": "AM", "a.m": "AM", "صباحي": "AM", "صباح": "AM",
+    "pm": "PM", "p.m": "PM", "مسائي": "PM", "مساء": "PM",
+    "ph": "PHARMACY", "pharmacy": "PHARMACY", "صيدليه": "PHARMACY",
+}
+
+# حقول السطر بعد القسم لكل نوع زيارة؛ آخرها (Comment) اختياري
+QUICK_FIELDS = {
+    "AM": ("Dr", "Hospital", "Specialty", "Products", "Comment"),
+    "PM": ("Dr", "Area", "Specialty", "Products", "Comment"),
+    "PHARMACY": ("Pharmacy", "Address", "Products", "Comment"),
+}
+
+def is_quick_entry(text):
+    return QUICK_SEPARATOR in text
+
+def parse_quick_visits(text):
+    """تحويل رسالة الإدخال السريع إلى [(visit_type, data)] وقائمة أخطاء برقم السطر"""
+    visits, errors = [], []
+    section = None
+    for number, line in enumerate(text.splitlines(), 1):
+        fields = [field.strip() for field in line.split(QUICK_SEPARATOR)]
+        if not any(fields):
+            continue
+        
+        alias = QUICK_SECTIONS.get(normalize_term(fields[0]))
+        if alias:
+            section = alias
+            fields = fields[1:]
+            if not fields:
+                continue  # سطر عنوان للقسم
+        elif section is None:
+            errors.append(f"سطر {number}: ابدأ بنوع الزيارة (AM / PM / PH)")
+            continue
+        
+        names = QUICK_FIELDS[section]
+        if not len(names) - 1 <= len(fields) <= len(names):
+            errors.append(f"سطر {number}: عدد الحقول {len(fields)} والمطلوب {len(names) - 1} أو {len(names)}")
+            continue
+        data = dict(zip(names, fields))
+        data.setdefault("Comment", "")
+        missing = [name for name in names[:-1] if not data[name]]
+        if missing:
+            errors.append(f"سطر {number}: حقل فارغ ({', '.join(missing)})")
+            continue
+        visits.append((section, data))
+    
+    if len(visits) > QUICK_MAX_VISITS:
+        errors.append(f"الحد الأقصى {QUICK_MAX_VISITS} زيارة في الرسالة الواحدة")
+    return visits, errors
+
+# --- تنسيقات التقرير ---
+class ReportStyles:
+    """كائنات التنسيق المشتركة بين كل التقارير بدلاً من إنشائها لكل ملف، يُنشأ كل منها عند أول استخدام"""
+
+    @staticmethod
+    def _fill(color):
+        from openpyxl.styles import PatternFill
+        return PatternFill("solid", fgColor=color)
+
+    @staticmethod
+    def _alignment(horizontal):
+        from openpyxl.styles import Alignment
+        return Alignment(horizontal=horizontal, vertical="center")
+
+    @staticmethod
+    def _font(**kwargs):
+        from openpyxl.styles import Font
+        return Font(**kwargs)
+
+    @functools.cached_property
+    def header_fill(self):
+        return self._fill("FFFF00")
+
+    @functools.cached_property
+    def blue_fill(self):
+        return self._fill("31859B")
+
+    @functools.cached_property
+    def orange_fill(self):
+        return self._fill("FABF8F")
+
+    @functools.cached_property
+    def section_fill(self):
+        return self._fill("C6E0B4")
+
+    @functools.cached_property
+    def center(self):
+        return self._alignment("center")
+
+    @functools.cached_property
+    def left_align(self):
+        return self._alignment("left")
+
+    @functools.cached_property
+    def bold(self):
+        return self._font(bold=True)
+
+    @functools.cached_property
+    def title_font(self):
+        return self._font(bold=True, size=14)
+
+    @functools.cached_property
+    def border(self):
+        from openpyxl.styles import Border, Side
+        thin = Side(style="thin")
+        return Border(left=thin, right=thin, top=thin, bottom=thin)
+
+styles = ReportStyles()
+
+# جداول التنسيق الداخلية في openpyxl التي تشير إليها الخلايا بالـ index
+STYLE_TABLES = (
+    "_fonts", "_fills", "_borders", "_alignments",
+    "_protections", "_number_formats", "_cell_styles",
+)
+
+def clone_workbook(template):
+    """نسخ ورقة القالب لـ Workbook جديد بنسخ الخلايا وفهارس التنسيق كما هي"""
+    from openpyxl import Workbook
+    from openpyxl.cell.cell import Cell, MergedCell
+    from openpyxl.utils.indexed_list import IndexedList
+    from openpyxl.worksheet.merge import MergedCellRange
+    
+    wb = Workbook()
+    for table in STYLE_TABLES:
+        setattr(wb, table, IndexedList(getattr(template, table)))
+    
+    src = template.active
+    ws = wb.active
+    ws.title = src.title
+    for (row, col), cell in src._cells.items():
+        if isinstance(cell, MergedCell):
+            new_cell = MergedCell(ws, row=row, column=col)
+        else:
+            new_cell = Cell(ws, row=row, column=col)
+            new_cell._value = cell._value
+            new_cell.data_type = cell.data_type
+        new_cell._style = copy.copy(cell._style)
+        ws._cells[(row, col)] = new_cell
+    
+    for merged in src.merged_cells.ranges:
+        ws.merged_cells.add(MergedCellRange(ws, merged.coord))
+    for key, dim in src.column_dimensions.items():
+        ws.column_dimensions[key].width = dim.width
+    return wb
+
+def atomic_write(filepath, write):
+    """الكتابة عبر write(f) في ملف مؤقت بنفس المجلد ثم استبدال الملف الأصلي دفعة واحدة،
+    فلا يبقى ملف مقطوع لو توقف البوت أثناء الحفظ"""
+    directory = os.path.dirname(filepath) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", suffix=".xlsx", dir=directory)
+    try:
+        with os.fdopen(fd, "w+b") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+def atomic_save(wb, filepath):
+    """حفظ الـ Workbook بأمان (انظر atomic_write)"""
+    with metrics.timer("medmap_workbook_save_seconds"):
+        atomic_write(filepath, wb.save)
+
+# --- التخزين الدائم للملفات ---
+class LocalStorage:
+    """نسخ الملفات لمجلد دائم (مثل volume على Railway)"""
+
+    def __init__(self, root=STORAGE_DIR):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def upload(self, key, path):
+        target = self._path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(path, "rb") as src:
+            atomic_write(target, lambda f: shutil.copyfileobj(src, f))
+
+    def download(self, key, path):
+        source = self._path(key)
+        if not os.path.exists(source):
+            return False
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(source, "rb") as src:
+            atomic_write(path, lambda f: shutil.copyfileobj(src, f))
+        return True
+
+    def delete(self, key):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._path(key))
+
+    def list(self, prefix):
+        """المفاتيح الموجودة مباشرة داخل prefix"""
+        directory = self._path(prefix)
+        if not os.path.isdir(directory):
+            return []
+        return [f"{prefix}/{name}" for name in sorted(os.listdir(directory)) if not name.startswith(".tmp-")]
+
+
+class S3Storage:
+    """تخزين متوافق مع S3 (AWS / MinIO / R2) بتوقيع SigV4 عبر httpx، والملفات الكبيرة تُرفع multipart"""
+
+    def __init__(self, endpoint=S3_ENDPOINT, bucket=S3_BUCKET, access_key=S3_ACCESS_KEY,
+                 secret_key=S3_SECRET_KEY, region=S3_REGION, prefix=S3_PREFIX,
+                 part_size=S3_PART_SIZE, part_workers=STORAGE_WORKERS, transport=None):
+        self.endpoint = endpoint.rstrip("/")
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.prefix = prefix
+        self.part_size = part_size
+        self.part_workers = part_workers
+        self._host = urlsplit(self.endpoint).netloc
+        # transport بديل يُستخدم للاختبار بدون شبكة (httpx.MockTransport)
+        self._client = httpx.Client(transport=transport, timeout=60)
+
+    def _sign(self, method, path, query, payload_hash):
+        """ترويسات SigV4 للطلب"""
+        amz_date = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        headers = {"host": self._host, "x-amz-content-sha256": payload_hash, "x-amz-date": amz_date}
+        signed_headers = ";".join(sorted(headers))
+        canonical = "\n".join([
+            method, path, query,
+            "".join(f"{name}:{headers[name]}\n" for name in sorted(headers)),
+            signed_headers, payload_hash,
+        ])
+        scope = f"{amz_date[:8]}/{self.region}/s3/aws4_request"
+        string_to_sign = "\n".join([
+            "AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical.encode()).hexdigest()
+        ])
+        key = ("AWS4" + self.secret_key).encode()
+        for part in (amz_date[:8], self.region, "s3", "aws4_request"):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        headers["authorization"] = (
+            f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+            f"SignedHeaders={signed_headers}, Signature={signature}"
+        )
+        return headers
+
+    def _request(self, method, key=None, params=None, content=b"", stream=False):
+        path = f"/{self.bucket}" + (f"/{quote(self.prefix + key, safe='/-_.~')}" if key is not None else "")
+        query = "&".join(
+            f"{quote(str(name), safe='-_.~')}={quote(str(value), safe='-_.~')}"
+            for name, value in sorted((params or {}).items())
+        )
+        headers = self._sign(method, path, query, hashlib.sha256(content).hexdigest())
+        url = self.endpoint + path + (f"?{query}" if query else "")
+        request = self._client.build_request(method, url, headers=headers, content=content)
+        return self._client.send(request, stream=stream)
+
+    @staticmethod
+    def _check(response):
+        # CompleteMultipartUpload قد يرجع 200 مع خطأ في الـ XML
+        if response.status_code >= 300 or b"<Error>" in response.content[:512]:
+            raise OSError(f"S3 {response.request.method} {response.request.url.path}: "
+                          f"{response.status_code} {response.text[:200]}")
+        return response
+
+    def upload(self, key, path):
+        size = os.path.getsize(path)
+        if size <= self.part_size:
+            with open(path, "rb") as f:
+                self._check(self._request("PUT", key, content=f.read()))
+            return
+        
+        response = self._check(self._request("POST", key, {"uploads": ""}))
+        upload_id = ElementTree.fromstring(response.content).findtext("{*}UploadId")
+        
+        def send_part(number):
+            with open(path, "rb") as f:
+                f.seek((number - 1) * self.part_size)
+                data = f.read(self.part_size)
+            part = self._check(self._request("PUT", key, {"partNumber": number, "uploadId": upload_id}, data))
+            return number, part.headers["etag"]
+        
+        try:
+            with ThreadPoolExecutor(max_workers=self.part_workers) as pool:
+                parts = list(pool.map(send_part, range(1, -(-size // self.part_size) + 1)))
+            body = "<CompleteMultipartUpload>" + "".join(
+                f"<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag></Part>"
+                for number, etag in parts
+            ) + "</CompleteMultipartUpload>"
+            self._check(self._request("POST", key, {"uploadId": upload_id}, body.encode()))
+        except BaseException:
+            with contextlib.suppress(Exception):
+                self._request("DELETE", key, {"uploadId": upload_id})
+            raise
+
+    def download(self, key, path):
+        response = self._request("GET", key, stream=True)
+        try:
+            if response.status_code == 404:
+                return False
+            if response.status_code >= 300:
+                response.read()
+                self._check(response)
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            atomic_write(path, lambda f: f.writelines(response.iter_bytes()))
+            return True
+        finally:
+            response.close()
+
+    def delete(self, key):
+        response = self._request("DELETE", key)
+        if response.status_code != 404:
+            self._check(response)
+
+    def list(self, prefix):
+        """المفاتيح الموجودة مباشرة داخل prefix"""
+        keys, token = [], None
+        while True:
+            params = {"list-type": 2, "prefix": f"{self.prefix}{prefix}/", "delimiter": "/"}
+            if token:
+                params["continuation-token"] = token
+            root = ElementTree.fromstring(self._check(self._request("GET", params=params)).content)
+            keys += [node.text.removeprefix(self.prefix) for node in root.findall("{*}Contents/{*}Key")]
+            token = root.findtext("{*}NextContinuationToken")
+            if not token:
+                return keys
+
+
+def make_storage(backend=STORAGE_BACKEND):
+    """إنشاء التخزين الدائم حسب STORAGE_BACKEND (None = القرص المحلي فقط)"""
+    if backend == "local":
+        return LocalStorage()
+    if backend == "s3":
+        return S3Storage()
+    return None
+
+
+class StorageSync:
+    """القرص المحلي هو الكاش، والتخزين الدائم يُحدّث في الخلفية بدون إبطاء الـ handlers"""
+
+    def __init__(self, backend=None, workers=STORAGE_WORKERS):
+        self.backend = backend
+        self.workers = workers
+        # المفتاح -> آخر عملية مطلوبة ("put" أو "delete"، المسار المحلي)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+
+    @staticmethod
+    def key(path):
+        return os.path.relpath(path).replace(os.sep, "/")
+
+    def _schedule(self, op, path):
+        if self.backend is None:
+            return
+        with self._lock:
+            self._pending[self.key(path)] = (op, path)
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def upload_later(self, path):
+        """رفع الملف في الخلفية (يمكن استدعاؤها من أي thread)"""
+        self._schedule("put", path)
+
+    def delete_later(self, path):
+        self._schedule("delete", path)
+
+    def fetch(self, path):
+        """قراءة عبر الكاش: تنزيل الملف من التخزين الدائم لو لم يكن موجوداً محلياً"""
+        if os.path.exists(path) or self.backend is None:
+            return os.path.exists(path)
+        with metrics.timer("medmap_storage_seconds", op="get"):
+            return self.backend.download(self.key(path), path)
+
+    def list(self, directory):
+        """أسماء الملفات في المجلد محلياً وفي التخزين الدائم"""
+        names = set(os.listdir(directory)) if os.path.isdir(directory) else set()
+        if self.backend is not None:
+            names.update(key.rsplit("/", 1)[-1] for key in self.backend.list(self.key(directory)))
+        return sorted(names)
+
+    def pending(self):
+        return len(self._pending)
+
+    def _apply(self, key, op, path):
+        with metrics.timer("medmap_storage_seconds", op=op):
+            if op == "delete":
+                self.backend.delete(key)
+            elif os.path.exists(path):
+                self.backend.upload(key, path)
+
+    async def drain(self):
+        """تنفيذ العمليات المعلقة الآن، وإرجاع الفاشلة للطابور (ما لم تطلب عملية أحدث لنفس الملف)"""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return 0
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="storage")
+        loop = asyncio.get_running_loop()
+        try:
+            results = await asyncio.gather(
+                *(loop.run_in_executor(self._executor, self._apply, key, op, path)
+                  for key, (op, path) in batch.items()),
+                return_exceptions=True
+            )
+        except asyncio.CancelledError:
+            # الإيقاف أثناء الرفع: الدفعة تعود للطابور لتُنفذ في المحاولة الأخيرة
+            with self._lock:
+                for key, item in batch.items():
+                    self._pending.setdefault(key, item)
+            raise
+        failed = 0
+        for (key, item), result in zip(batch.items(), results):
+            if isinstance(result, Exception):
+                failed += 1
+                metrics.inc("medmap_storage_errors_total", op=item[0])
+                logger.warning("Storage %s %s failed: %s", item[0], key, result)
+                with self._lock:
+                    self._pending.setdefault(key, item)
+        return failed
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if await self.drain():
+                await asyncio.sleep(STORAGE_RETRY_DELAY)
+                self._wakeup.set()
+
+    async def start(self):
+        if self.backend is None or self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        if self._pending:
+            self._wakeup.set()
+
+    async def stop(self):
+        """إيقاف المزامنة بعد محاولة أخيرة لرفع المعلق"""
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+            self._loop = None
+        if self.backend is not None:
+            await self.drain()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+storage_sync = StorageSync(make_storage())
+metrics.gauge("medmap_storage_pending", storage_sync.pending)
+
+class ReportLayout:
+    """مواقع صفوف أقسام التقرير، ويزيد صفوف القسم لو تجاوزت زياراته الحجم القياسي"""
+
+    def __init__(self, am=SECTION_SIZES["AM"], pm=SECTION_SIZES["PM"],
+                 pharmacy=SECTION_SIZES["PHARMACY"]):
+        self.key = (am, pm, pharmacy)
+        self.am_start = 8
+        self.am_end = self.am_start + am - 1
+        self.am_separator = self.am_end + 1
+        self.pm_start = self.am_separator + 1
+        self.pm_end = self.pm_start + pm - 1
+        self.pm_separator = self.pm_end + 1
+        self.pharmacy_header = self.pm_separator + 1
+        self.pharmacy_end = self.pharmacy_header + pharmacy
+        self.rows = {
+            "AM": range(self.am_start, self.am_end + 1),
+            "PM": range(self.pm_start, self.pm_end + 1),
+            "PHARMACY": range(self.pharmacy_header + 1, self.pharmacy_end + 1),
+        }
+
+    @classmethod
+    def for_counts(cls, counts):
+        """أصغر تخطيط يسع عدد الزيارات في كل قسم"""
+        return cls(*(
+            max(SECTION_SIZES[section], counts.get(section, 0))
+            for section in ("AM", "PM", "PHARMACY")
+        ))
+
+DEFAULT_LAYOUT = ReportLayout()
+
+# --- ذاكرة التقارير المرسومة ---
+class CachedReport:
+    """نسخة مرسومة من تقرير: البايتات ونسخة التقرير ومعرّف الملف على تيليجرام بعد أول رفع"""
+
+    def __init__(self, version, filepath, data):
+        self.version = version
+        self.filepath = filepath
+        self.filename = os.path.basename(filepath)
+        self.data = data
+        self.file_id = None
+
+
+class ReportCache:
+    """آخر نسخة مرسومة لكل (user_id, التاريخ) في الذاكرة، مع حذف الأقدم استخداماً عند الامتلاء"""
+
+    def __init__(self, max_entries=REPORT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        """النسخة المحفوظة لو كانت بنفس رقم النسخة المطلوب"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            self._entries[key] = entry  # نقلها لآخر الترتيب (الأحدث استخداماً)
+            return entry if entry.version == version else None
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                del self._entries[next(iter(self._entries))]
+        return entry
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+report_cache = ReportCache()
+metrics.gauge("medmap_report_cache_entries", lambda: len(report_cache))
 
 # --- كلاس ExcelHandler (معدل) ---
 class ExcelHandler:
+    # آخر (التاريخ، النسخة) تم رسمها في ملف لكل user_id: مفتاح واحد لكل مندوب حتى لا تتراكم الأيام
+    # في العمال الذين لا يشغلون الإغلاق اليومي (forget)
+    _rendered_versions = {}
+    # قالب لكل تخطيط (القياسي + أي قسم تم تكبيره)
+    _templates = {}
+    _template_lock = threading.Lock()
+
     @staticmethod
-    def get_today_filename(user_id, first_name):
-        """إنشاء اسم الملف بناءً على الاسم الأول و user_id"""
-        today = datetime.now()
-        day_name = today.strftime("%a")
-        date_str = today.strftime("%d-%b")
+    def get_report_filename(user_id, first_name, day):
+        """إنشاء اسم الملف بناءً على الاسم الأول و user_id وتاريخ التقرير"""
+        day_name = day.strftime("%a")
+        date_str = day.strftime("%d-%b")
         username = f"{first_name}{user_id}"
         return f"{username}_Report_{day_name}_{date_str}.xlsx"
+
+    @staticmethod
+    def get_today_filename(user_id, first_name):
+        """اسم ملف تقرير اليوم (حسب اليوم المحلي للمستخدم)"""
+        return ExcelHandler.get_report_filename(user_id, first_name, report_day(user_id))
+
+    @staticmethod
+    def get_report_date(user_id=None):
+        """مفتاح تاريخ تقرير اليوم في قاعدة البيانات (حسب اليوم المحلي للمستخدم)"""
+        return report_day(user_id).strftime("%Y-%m-%d")
     
     @staticmethod
-    def create_new_report(user_id, first_name, full_name):
-        """إنشاء تقرير جديد مع الاسم الكامل في الداخل"""
-        filename = ExcelHandler.get_today_filename(user_id, first_name)
+    def create_new_report(user_id, first_name, full_name, report_date=None):
+        """إنشاء تقرير جديد (الملف نفسه يُرسم عند الإرسال)"""
+        report_date = report_date or ExcelHandler.get_report_date(user_id)
+        day = datetime.strptime(report_date, "%Y-%m-%d")
+        filename = ExcelHandler.get_report_filename(user_id, first_name, day)
         filepath = os.path.join(REPORTS_DIR, filename)
+        visit_store.create_report(user_id, report_date, first_name, full_name)
+        return filepath, True
+
+    @staticmethod
+    def get_template(layout=DEFAULT_LAYOUT):
+        """قالب التقرير الفارغ، يُبنى مرة واحدة لكل تخطيط"""
+        template = ExcelHandler._templates.get(layout.key)
+        if template is None:
+            with ExcelHandler._template_lock:
+                template = ExcelHandler._templates.get(layout.key)
+                if template is None:
+                    template = ExcelHandler.build_template(layout)
+                    ExcelHandler._templates[layout.key] = template
+        return template
+
+    @staticmethod
+    def new_workbook(full_name, report_date, layout=DEFAULT_LAYOUT):
+        """نسخة من القالب مع الاسم الكامل والتاريخ"""
+        wb = clone_workbook(ExcelHandler.get_template(layout))
+        ws = wb.active
+        ws["B4"].value = full_name  # الاسم الكامل هنا
+        ws["B5"].value = datetime.strptime(report_date, "%Y-%m-%d").strftime("%d/%m/%Y")
+        return wb
+
+    @staticmethod
+    def build_template(layout=DEFAULT_LAYOUT):
+        """رسم قالب التقرير الفارغ خلية بخلية"""
+        from openpyxl import Workbook
         
         wb = Workbook()
         ws = wb.active
         ws.title = "Daily Report"
         
-        # التنسيقات
-        header_fill = PatternFill("solid", fgColor="FFFF00")
-        blue_fill = PatternFill("solid", fgColor="31859B")
-        orange_fill = PatternFill("solid", fgColor="FABF8F")
-        section_fill = PatternFill("solid", fgColor="C6E0B4")
-        center = Alignment(horizontal="center", vertical="center")
-        left_align = Alignment(horizontal="left", vertical="center")
-        bold = Font(bold=True)
-        border = Border(
-            left=Side(style="thin"),
-            right=Side(style="thin"),
-            top=Side(style="thin"),
-            bottom=Side(style="thin")
-        )
+        header_fill = styles.header_fill
+        blue_fill = styles.blue_fill
+        orange_fill = styles.orange_fill
+        section_fill = styles.section_fill
+        center = styles.center
+        left_align = styles.left_align
+        bold = styles.bold
+        border = styles.border
         
         # العنوان الرئيسي
         ws.merge_cells("A2:F2")
         ws["A2"].value = "Daily Report"
-        ws["A2"].font = Font(bold=True, size=14)
+        ws["A2"].font = styles.title_font
         ws["A2"].alignment = center
         ws["A2"].fill = header_fill
         
@@ -113,8 +1786,6 @@ class ExcelHandler:
         
         ws.merge_cells("B4:F4")
         ws.merge_cells("B5:F5")
-        ws["B4"].value = full_name  # الاسم الكامل هنا
-        ws["B5"].value = datetime.now().strftime("%d/%m/%Y")
         ws["B5"].alignment = left_align
         
         for col in ["A", "B"]:
@@ -132,53 +1803,57 @@ class ExcelHandler:
             cell.border = border
         
         # قسم A.M
-        ws.merge_cells("A8:A14")
-        ws["A8"].value = "A.M"
-        ws["A8"].alignment = center
-        ws["A8"].font = bold
-        ws["A8"].fill = section_fill
+        am = layout.am_start
+        ws.merge_cells(f"A{am}:A{layout.am_end}")
+        ws[f"A{am}"].value = "A.M"
+        ws[f"A{am}"].alignment = center
+        ws[f"A{am}"].font = bold
+        ws[f"A{am}"].fill = section_fill
         
-        for r in range(8, 15):
+        for r in layout.rows["AM"]:
             for c in range(2, 7):
                 ws.cell(row=r, column=c).border = border
         
         for c in range(1, 7):
-            ws.cell(row=15, column=c).fill = orange_fill
+            ws.cell(row=layout.am_separator, column=c).fill = orange_fill
         
         # قسم P.M
-        ws.merge_cells("A16:A28")
-        ws["A16"].value = "P.M"
-        ws["A16"].alignment = center
-        ws["A16"].font = bold
-        ws["A16"].fill = section_fill
+        pm = layout.pm_start
+        ws.merge_cells(f"A{pm}:A{layout.pm_end}")
+        ws[f"A{pm}"].value = "P.M"
+        ws[f"A{pm}"].alignment = center
+        ws[f"A{pm}"].font = bold
+        ws[f"A{pm}"].fill = section_fill
         
-        for r in range(16, 29):
+        for r in layout.rows["PM"]:
             for c in range(2, 7):
                 ws.cell(row=r, column=c).border = border
         
         for c in range(1, 7):
-            ws.cell(row=29, column=c).fill = orange_fill
+            ws.cell(row=layout.pm_separator, column=c).fill = orange_fill
         
         # قسم PHARMACY
-        ws.merge_cells("A30:A37")
-        ws["A30"].value = "PHARMACY"
-        ws["A30"].alignment = center
-        ws["A30"].font = bold
-        ws["A30"].fill = header_fill
+        ph = layout.pharmacy_header
+        ws.merge_cells(f"A{ph}:A{layout.pharmacy_end}")
+        ws[f"A{ph}"].value = "PHARMACY"
+        ws[f"A{ph}"].alignment = center
+        ws[f"A{ph}"].font = bold
+        ws[f"A{ph}"].fill = header_fill
         
         ph_headers = ["Pharmacy Name", "Address", "Products", "Comments"]
         ph_cols = [2, 3, 4, 6]
         for col, h in zip(ph_cols, ph_headers):
-            cell = ws.cell(row=30, column=col, value=h)
+            cell = ws.cell(row=ph, column=col, value=h)
             cell.font = bold
             cell.fill = header_fill
             cell.border = border
             cell.alignment = center
         
-        for r in range(30, 38):
+        # عمود المنتجات مدمج D:E مرة واحدة هنا فقط
+        for r in range(ph, layout.pharmacy_end + 1):
             ws.merge_cells(f"D{r}:E{r}")
         
-        for r in range(31, 38):
+        for r in layout.rows["PHARMACY"]:
             for c in range(2, 7):
                 ws.cell(row=r, column=c).border = border
         
@@ -187,71 +1862,1085 @@ class ExcelHandler:
         for i, w in enumerate(widths, start=1):
             ws.column_dimensions[chr(64 + i)].width = w
         
-        wb.save(filepath)
-        return filepath, True
+        return wb
     
     @staticmethod
-    def add_visit(user_id, first_name, visit_type, data):
-        """إضافة زيارة للتقرير"""
-        filename = ExcelHandler.get_today_filename(user_id, first_name)
-        filepath = os.path.join(REPORTS_DIR, filename)
+    def add_visit(user_id, first_name, visit_type, data, report_date=None):
+        """إضافة زيارة للتقرير"""
+        filepath, _ = ExcelHandler.add_visits(user_id, first_name, [(visit_type, data)], report_date)
+        return filepath
+
+    @staticmethod
+    def add_visits(user_id, first_name, visits, report_date=None):
+        """إضافة عدة زيارات [(visit_type, data)] للتقرير دفعة واحدة
+
+        يرجع (مسار الملف، الزيارات المحفوظة فعلاً)، أو (None، []) لو التقرير غير موجود.
+        """
+        report_date = report_date or ExcelHandler.get_report_date(user_id)
+        day = datetime.strptime(report_date, "%Y-%m-%d")
+        filename = ExcelHandler.get_report_filename(user_id, first_name, day)
+        filepath = os.path.join(REPORTS_DIR, filename)
+        
+        with metrics.timer("medmap_visit_write_seconds"):
+            saved = visit_store.add_visits(user_id, report_date, visits)
+        if saved is None:
+            return None, []  # التقرير غير موجود
+        
+        # الاقتراحات من الزيارات المحفوظة فقط، لا المتجاهلة لامتلاء القسم
+        for visit_type, data in saved:
+            name_key, place_key = VISIT_KEYS[visit_type]
+            autocomplete.record(user_id, visit_type, {
+                "name": data.get(name_key, ""),
+                "place": data.get(place_key, ""),
+                "specialty": data.get("Specialty", ""),
+                "products": data.get("Products", ""),
+            })
+        return filepath, saved
+
+    @staticmethod
+    def render_report(user_id, report_date=None):
+        """رسم ملف Excel من الزيارات المحفوظة وإرجاع مساره"""
+        entry = ExcelHandler.render_cached(user_id, report_date)
+        return entry.filepath if entry else None
+
+    @staticmethod
+    def render_cached(user_id, report_date=None):
+        """رسم التقرير أو إعادة استخدام آخر نسخة لو لم يتغير، وإرجاعها كـ CachedReport"""
+        report_date = report_date or ExcelHandler.get_report_date(user_id)
+        report = visit_store.get_report(user_id, report_date)
+        if report is None:
+            return None
+        
+        day = datetime.strptime(report_date, "%Y-%m-%d")
+        filename = ExcelHandler.get_report_filename(user_id, report["first_name"], day)
+        filepath = os.path.join(REPORTS_DIR, filename)
+        
+        key = (user_id, report_date)
+        version = report["version"]
+        entry = report_cache.get(key, version)
+        if entry is not None and entry.filepath == filepath and os.path.exists(filepath):
+            metrics.inc("medmap_report_render_total", result="cached")
+            return entry
+        if ExcelHandler._rendered_versions.get(user_id) == (report_date, version) and os.path.exists(filepath):
+            # الملف على القرص ما زال حديثاً لكن بايتاته خرجت من الذاكرة
+            metrics.inc("medmap_report_render_total", result="disk")
+            with open(filepath, "rb") as f:
+                return report_cache.put(key, CachedReport(version, filepath, f.read()))
+        
+        metrics.inc("medmap_report_render_total", result="rendered")
+        layout = ReportLayout.for_counts(
+            {section: report[col] for section, col in COUNT_COLUMNS.items()}
+        )
+        with metrics.timer("medmap_workbook_load_seconds"):
+            wb = ExcelHandler.new_workbook(report["full_name"], report_date, layout)
+        ws = wb.active
+        for visit in visit_store.get_visits(user_id, report_date):
+            ExcelHandler._write_visit(ws, visit, layout)
+        buffer = io.BytesIO()
+        with metrics.timer("medmap_workbook_save_seconds"):
+            wb.save(buffer)
+        data = buffer.getvalue()
+        atomic_write(filepath, lambda f: f.write(data))
+        storage_sync.upload_later(filepath)
+        ExcelHandler._rendered_versions[user_id] = (report_date, version)
+        return report_cache.put(key, CachedReport(version, filepath, data))
+
+    @staticmethod
+    def forget(user_id, report_date):
+        """إزالة تقرير يوم منتهٍ من الذاكرة"""
+        key = (user_id, report_date)
+        if ExcelHandler._rendered_versions.get(user_id, (None,))[0] == report_date:
+            ExcelHandler._rendered_versions.pop(user_id, None)
+        report_cache.discard(key)
+
+    @staticmethod
+    def visit_cells(visit, layout=DEFAULT_LAYOUT):
+        """رقم الصف وقيم الأعمدة لزيارة محفوظة"""
+        row = layout.rows[visit["section"]][visit["slot"]]
+        if visit["section"] == "PHARMACY":
+            # عمود المنتجات مدمج D:E في قالب الصيدلية
+            values = {2: visit["name"], 3: visit["place"], 4: visit["products"], 6: visit["comment"]}
+        else:
+            values = {
+                2: visit["name"], 3: visit["place"], 4: visit["specialty"],
+                5: visit["products"], 6: visit["comment"],
+            }
+        return row, values
+
+    @staticmethod
+    def _write_visit(ws, visit, layout=DEFAULT_LAYOUT):
+        """كتابة زيارة محفوظة في الصف الخاص بها"""
+        row, values = ExcelHandler.visit_cells(visit, layout)
+        for col, value in values.items():
+            ws.cell(row=row, column=col).value = value
+        for c in range(2, 7):
+            ws.cell(row=row, column=c).border = styles.border
+
+# --- الرسم المتدفق للتقارير (write-only) ---
+class StreamingReportRenderer:
+    """رسم التقارير بوضع write-only بذاكرة ثابتة مهما زاد عدد التقارير"""
+
+    def __init__(self):
+        self._layouts = {}
+
+    def _layout_data(self, layout):
+        """خلايا القالب ودمجه وعرض أعمدته لكل تخطيط (تُحسب مرة واحدة)"""
+        data = self._layouts.get(layout.key)
+        if data is None:
+            template = ExcelHandler.get_template(layout)
+            tpl_ws = template.active
+            data = {
+                "template": template,
+                "rows": [
+                    [tpl_ws._cells.get((row, col)) for col in range(1, tpl_ws.max_column + 1)]
+                    for row in range(1, tpl_ws.max_row + 1)
+                ],
+                "merges": [merged.coord for merged in tpl_ws.merged_cells.ranges],
+                "widths": {key: dim.width for key, dim in tpl_ws.column_dimensions.items()},
+            }
+            self._layouts[layout.key] = data
+        return data
+
+    def new_workbook(self, layout=DEFAULT_LAYOUT):
+        """Workbook بوضع write-only يشارك جداول التنسيق مع القالب"""
+        from openpyxl import Workbook
+        from openpyxl.utils.indexed_list import IndexedList
+        
+        template = self._layout_data(layout)["template"]
+        wb = Workbook(write_only=True)
+        for table in STYLE_TABLES:
+            setattr(wb, table, IndexedList(getattr(template, table)))
+        return wb
+
+    def write_sheet(self, wb, title, full_name, report_date, visits, layout=DEFAULT_LAYOUT):
+        """كتابة ورقة تقرير كاملة صفاً بصف بنفس تنسيق القالب"""
+        from openpyxl.cell import WriteOnlyCell
+        
+        data = self._layout_data(layout)
+        ws = wb.create_sheet(title)
+        for key, width in data["widths"].items():
+            ws.column_dimensions[key].width = width
+        for coord in data["merges"]:
+            ws.merged_cells.add(coord)
+        
+        values = {
+            (4, 2): full_name,
+            (5, 2): datetime.strptime(report_date, "%Y-%m-%d").strftime("%d/%m/%Y"),
+        }
+        for visit in visits:
+            row, cells = ExcelHandler.visit_cells(visit, layout)
+            for col, value in cells.items():
+                values[(row, col)] = value
+        
+        for row, tpl_cells in enumerate(data["rows"], start=1):
+            out = []
+            for col, tpl_cell in enumerate(tpl_cells, start=1):
+                value = values.get((row, col))
+                if tpl_cell is None:
+                    out.append(value)
+                    continue
+                cell = WriteOnlyCell(ws, value=value if value is not None else tpl_cell.value)
+                cell._style = copy.copy(tpl_cell._style)
+                out.append(cell)
+            ws.append(out)
+        return ws
+
+    def render_file(self, filepath, full_name, report_date, visits):
+        counts = {}
+        for visit in visits:
+            counts[visit["section"]] = max(counts.get(visit["section"], 0), visit["slot"] + 1)
+        layout = ReportLayout.for_counts(counts)
+        wb = self.new_workbook(layout)
+        self.write_sheet(wb, "Daily Report", full_name, report_date, visits, layout)
+        atomic_save(wb, filepath)
+        return filepath
+
+    def render_all(self, records, out_dir=REPORTS_DIR):
+        """رسم تقرير لكل (user_id, التاريخ) من سجلات مرتبة، وإرجاع المسارات واحداً تلو الآخر"""
+        grouped = itertools.groupby(records, key=lambda r: (r["user_id"], r["report_date"]))
+        for (user_id, report_date), rows in grouped:
+            first = next(rows)
+            visits = [first] if first["section"] else []
+            visits.extend(rows)
+            day = datetime.strptime(report_date, "%Y-%m-%d")
+            filename = ExcelHandler.get_report_filename(user_id, first["first_name"], day)
+            yield self.render_file(
+                os.path.join(out_dir, filename), first["full_name"], report_date, visits
+            )
+
+# --- التصدير المجمع لعدة مندوبين ---
+SECTION_ORDER = {"AM": 0, "PM": 1, "PHARMACY": 2}
+SECTION_LABELS = {"AM": "A.M", "PM": "P.M", "PHARMACY": "PHARMACY"}
+EXPORT_COLUMNS = [
+    "Date", "Section", "Doctor / Pharmacy", "Hospital / Area / Address",
+    "Specialist", "Products", "Comment",
+]
+
+def iter_rep_rows(date_from, date_to):
+    """(user_id، الأيام، صفوف الورقة) لكل مندوب بالترتيب، من قراءة متدفقة واحدة لكل المندوبين"""
+    records = visit_store.iter_report_visits(date_from, date_to)
+    for user_id, group in itertools.groupby(records, key=lambda record: record["user_id"]):
+        days = set()
+        rows = []
+        for record in group:
+            days.add(record["report_date"])
+            if record["section"]:
+                rows.append((
+                    record["report_date"], record["section"], record["slot"],
+                    record["name"], record["place"], record["specialty"],
+                    record["products"], record["comment"],
+                ))
+        rows.sort(key=lambda row: (row[0], SECTION_ORDER[row[1]], row[2]))
+        yield user_id, sorted(days), rows
+
+def export_sheet_title(full_name, user_id, used):
+    """اسم ورقة صالح لـ Excel (31 حرف بدون رموز ممنوعة) وغير مكرر"""
+    name = "".join(ch for ch in full_name if ch not in '[]:*?/\\')
+    title = f"{name[:20]} {user_id}".strip()
+    while title in used:
+        title = f"{title[:28]}_{len(used)}"
+    used.add(title)
+    return title
+
+def styled_row(ws, values, font=None, fill=None):
+    """صف write-only بتنسيق موحد"""
+    from openpyxl.cell import WriteOnlyCell
+    
+    cells = []
+    for value in values:
+        cell = WriteOnlyCell(ws, value=value)
+        if cells:
+            # نسخ تنسيق أول خلية بدلاً من تسجيله في الملف لكل خلية (كل تسجيل يحسب hash للتنسيق)
+            cell._style = copy.copy(cells[0]._style)
+        else:
+            cell.border = styles.border
+            if font:
+                cell.font = font
+            if fill:
+                cell.fill = fill
+        cells.append(cell)
+    return cells
+
+def export_consolidated(date_from, date_to, out_path=None):
+    """ملف Excel واحد لكل المندوبين في فترة: ورقة ملخص + ورقة لكل مندوب"""
+    reps = visit_store.list_report_users(date_from, date_to)
+    if not reps:
+        return None
+    if out_path is None:
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        out_path = os.path.join(EXPORT_DIR, f"MedMap_Export_{date_from}_{date_to}.xlsx")
+    
+    import pandas as pd
+    from openpyxl import Workbook
+    
+    wb = Workbook(write_only=True)
+    summary_ws = wb.create_sheet("Summary")
+    by_day_ws = wb.create_sheet("By Day")
+    names = dict(reps)
+    used_titles = {"Summary", "By Day"}
+    summaries = []
+    day_counts = Counter()
+    
+    # قراءة وكتابة كل مندوب أولاً بأول في نفس العملية: القراءة نفسها أرخص بكثير من تشغيل processes
+    for user_id, days, rows in iter_rep_rows(date_from, date_to):
+        ws = wb.create_sheet(export_sheet_title(names[user_id], user_id, used_titles))
+        for col, width in zip("ABCDEFG", [12, 10, 25, 22, 18, 25, 30]):
+            ws.column_dimensions[col].width = width
+        ws.append(styled_row(ws, EXPORT_COLUMNS, styles.bold, styles.header_fill))
+        for row in rows:
+            ws.append(styled_row(ws, [row[0], SECTION_LABELS[row[1]], *row[3:]]))
+        
+        counts = Counter(row[1] for row in rows)
+        day_counts.update((row[0], row[1]) for row in rows)
+        summaries.append({
+            "user_id": user_id,
+            "full_name": names[user_id],
+            "days": len(days),
+            **{section: counts[section] for section in SECTION_ORDER},
+        })
+    
+    summary = pd.DataFrame(summaries)
+    summary["Total"] = summary[list(SECTION_ORDER)].sum(axis=1)
+    summary_ws.column_dimensions["B"].width = 25
+    summary_ws.append(styled_row(
+        summary_ws,
+        ["User ID", "Name", "Days", "A.M", "P.M", "PHARMACY", "Total"],
+        styles.bold, styles.header_fill
+    ))
+    for record in summary.itertuples(index=False):
+        summary_ws.append(styled_row(summary_ws, list(record)))
+    totals = summary[["days", *SECTION_ORDER, "Total"]].sum()
+    summary_ws.append(styled_row(
+        summary_ws, ["", "Total", *[int(v) for v in totals]], styles.bold, styles.orange_fill
+    ))
+    
+    by_day_ws.append(styled_row(
+        by_day_ws, ["Date", "A.M", "P.M", "PHARMACY", "Total"], styles.bold, styles.header_fill
+    ))
+    for report_date in sorted({day for day, _ in day_counts}):
+        values = [day_counts[report_date, section] for section in SECTION_ORDER]
+        by_day_ws.append(styled_row(by_day_ws, [report_date, *values, sum(values)]))
+    
+    atomic_save(wb, out_path)
+    return out_path
+
+def parse_date_range(args):
+    """قراءة فترة التصدير: بدون قيم = اليوم، قيمة واحدة = يوم محدد، قيمتين = من/إلى"""
+    today = ExcelHandler.get_report_date()
+    date_from = args[0] if args else today
+    date_to = args[1] if len(args) > 1 else date_from
+    for value in (date_from, date_to):
+        datetime.strptime(value, "%Y-%m-%d")
+    if date_from > date_to:
+        raise ValueError("date_from after date_to")
+    return date_from, date_to
+
+# --- التحليلات ---
+ANALYTICS_COLUMNS = ["user_id", "report_date", "section", "name", "place", "specialty", "products"]
+
+# فواصل أسماء المنتجات المكتوبة في خانة واحدة
+PRODUCT_SEPARATORS = r"[,،;+/]"
+
+class VisitAnalytics:
+    """فهرس أعمدة (pandas) للزيارات التاريخية: تكرار زيارة كل دكتور، ذكر المنتجات، وتغطية الأقسام أسبوعياً
+
+    التقارير المغلقة لا تتغير، فتُضاف للفهرس مرة واحدة فقط (من آخر وقت إغلاق مفهرس)،
+    وتقارير الأيام المفتوحة قليلة فتُبنى من جديد فقط عند تغير نسختها.
+    """
+
+    def __init__(self, store=visit_store):
+        self.store = store
+        self._closed = None  # يُبنى عند أول استخدام حتى لا تُحمّل pandas مع بدء البوت
+        self._indexed = set()
+        self._since = None
+        self._open = (None, None)  # (بصمة التقارير المفتوحة، الجداول المبنية منها)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _build(rows):
+        """جدول الزيارات وجدول ذكر المنتجات (منتج لكل صف) من سجلات iter_analytics_visits"""
+        import pandas as pd
+        
+        visits = pd.DataFrame(rows, columns=ANALYTICS_COLUMNS)
+        visits["date"] = pd.to_datetime(visits["report_date"], format="%Y-%m-%d")
+        visits["week"] = visits["date"] - pd.to_timedelta(visits["date"].dt.weekday, unit="D")
+        visits["key"] = visits["name"].fillna("").map(normalize_term)
+        
+        products = visits[["user_id", "date"]].copy()
+        products["product"] = visits["products"].fillna("").str.split(PRODUCT_SEPARATORS)
+        products = products.explode("product")
+        products["product"] = products["product"].str.strip()
+        products = products[products["product"] != ""]
+        products["key"] = products["product"].map(normalize_term)
+        return visits, products.reset_index(drop=True)
+
+    @staticmethod
+    def _row(row):
+        return [row[column] for column in ANALYTICS_COLUMNS]
+
+    def refresh(self):
+        """إضافة زيارات التقارير التي أُغلقت بعد آخر تحديث فقط"""
+        import pandas as pd
+        
+        with self._lock, metrics.timer("medmap_analytics_seconds", op="refresh"):
+            if self._closed is None:
+                self._closed = self._build([])
+            if not self.store.has_finalized_since(self._since, self._indexed):
+                return 0
+            rows, keys, since = [], set(), self._since
+            for row in self.store.iter_analytics_visits(self._since):
+                key = (row["user_id"], row["report_date"])
+                if key in self._indexed:
+                    continue  # آخر دفعة إغلاق تُقرأ مرة أخرى لأن المقارنة بـ >=
+                keys.add(key)
+                rows.append(self._row(row))
+                since = max(since or "", row["finalized_at"])
+            if rows:
+                self._closed = tuple(
+                    pd.concat([old, new], ignore_index=True)
+                    for old, new in zip(self._closed, self._build(rows))
+                )
+                self._indexed |= keys
+                self._since = since
+            return len(rows)
+
+    def _open_frames(self):
+        """جداول التقارير المفتوحة، تُعاد قراءتها فقط لو أُضيفت زيارة أو تغيرت التقارير المفتوحة"""
+        token = self.store.open_reports_token()
+        cached_token, frames = self._open
+        if token != cached_token:
+            frames = self._build([self._row(row) for row in self.store.iter_analytics_visits(open_reports=True)])
+            self._open = (token, frames)
+        return frames
+
+    def _select(self, date_from, date_to, user_id=None):
+        """زيارات ومنتجات الفترة من الفهرس ومن التقارير المفتوحة"""
+        import pandas as pd
+        
+        self.refresh()
+        start, end = pd.Timestamp(date_from), pd.Timestamp(date_to)
+        parts = [self._closed, self._open_frames()]
+        selected = []
+        for index in (0, 1):
+            frames = []
+            for part in parts:
+                frame = part[index]
+                mask = (frame["date"] >= start) & (frame["date"] <= end)
+                if user_id is not None:
+                    mask &= frame["user_id"] == user_id
+                frames.append(frame[mask])
+            selected.append(pd.concat(frames, ignore_index=True))
+        return selected
+
+    @staticmethod
+    def _ranked(frame, label, top):
+        """عدد المرات لكل قيمة موحدة مع آخر كتابة لها، مرتبة من الأكثر"""
+        import pandas as pd
+        
+        grouped = frame.groupby("key", sort=False)
+        ranked = pd.DataFrame({
+            "count": grouped.size(),
+            "days": grouped["date"].nunique(),
+            "last": grouped["date"].max(),
+        }).sort_values(["count", "last"], ascending=False).head(top)
+        # آخر كتابة للقيمة تُعرض بدلاً من الشكل الموحد
+        latest = frame[frame["key"].isin(ranked.index)].sort_values("date").groupby("key")[label].last()
+        ranked.insert(0, label, latest.reindex(ranked.index))
+        ranked["last"] = ranked["last"].dt.strftime("%Y-%m-%d")
+        return ranked.reset_index(drop=True)
+
+    def report(self, date_from, date_to, user_id=None, top=ANALYTICS_TOP):
+        """الجداول الثلاثة للفترة: doctors و products و coverage (أسبوع × قسم)"""
+        visits, products = self._select(date_from, date_to, user_id)
+        with metrics.timer("medmap_analytics_seconds", op="query"):
+            doctors = visits[visits["section"] != "PHARMACY"]
+            coverage = (
+                visits.groupby(["week", "section"]).size()
+                .unstack(fill_value=0)
+                .reindex(columns=list(SECTION_ORDER), fill_value=0)
+            )
+            coverage["doctors"] = doctors.groupby("week")["key"].nunique()
+            coverage["pharmacies"] = visits[visits["section"] == "PHARMACY"].groupby("week")["key"].nunique()
+            coverage = coverage.fillna(0).astype(int).sort_index()
+            coverage.index = coverage.index.strftime("%Y-%m-%d")
+            return {
+                "visits": len(visits),
+                "reps": visits["user_id"].nunique(),
+                "doctors": self._ranked(doctors, "name", top),
+                "products": self._ranked(products, "product", top),
+                "coverage": coverage,
+            }
+
+visit_analytics = VisitAnalytics()
+
+def format_analytics(result, date_from, date_to):
+    """نص رسالة /analytics ومخرجات سطر الأوامر"""
+    lines = [
+        f"📊 تحليلات الزيارات {date_from} ← {date_to}",
+        f"الزيارات: {result['visits']} | المندوبين: {result['reps']}",
+        "",
+        "👨‍⚕️ أكثر الأطباء زيارة (زيارات | أيام | آخر زيارة):",
+    ]
+    lines += [
+        f"• {row.name}: {row.count} | {row.days} | {row.last}"
+        for row in result["doctors"].itertuples()
+    ] or ["—"]
+    lines += ["", "💊 أكثر المنتجات ذكراً:"]
+    lines += [f"• {row.product}: {row.count}" for row in result["products"].itertuples()] or ["—"]
+    lines += ["", "📅 التغطية الأسبوعية (A.M | P.M | صيدليات | أطباء مختلفون | صيدليات مختلفة):"]
+    lines += [
+        f"• {week}: {row.AM} | {row.PM} | {row.PHARMACY} | {row.doctors} | {row.pharmacies}"
+        for week, row in result["coverage"].iterrows()
+    ] or ["—"]
+    return "\n".join(lines)
+
+def analytics_range(args):
+    """فترة /analytics: بدون قيم = آخر ANALYTICS_DAYS يوم، وإلا مثل parse_date_range"""
+    if args:
+        return parse_date_range(args)
+    today = ExcelHandler.get_report_date()
+    start = datetime.strptime(today, "%Y-%m-%d") - timedelta(days=ANALYTICS_DAYS - 1)
+    return start.strftime("%Y-%m-%d"), today
+
+# --- طبقة الكتابة غير المتزامنة للتقارير ---
+class ReportWriter:
+    """تشغيل عمليات ExcelHandler في مجموعة threads محدودة بعيداً عن الـ event loop"""
+
+    def __init__(self, max_workers=EXCEL_WORKERS, max_pending=EXCEL_QUEUE_SIZE):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self._executor = None
+        # (user_id, التاريخ) -> [lock, عدد العمليات المنتظرة]
+        self._report_locks = {}
+        # الطابور محدود: عند امتلائه ينتظر الـ handler دوره بدلاً من تكديس المهام
+        self._slots = asyncio.Semaphore(max_pending)
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix="excel"
+            )
+        return self._executor
+
+    async def run(self, func, *args, **kwargs):
+        """تنفيذ دالة متزامنة في الـ pool وانتظار نتيجتها"""
+        queued = time.perf_counter()
+        async with self._slots:
+            metrics.observe("medmap_writer_wait_seconds", time.perf_counter() - queued)
+            self.pending += 1
+            try:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(
+                    self._get_executor(),
+                    functools.partial(func, *args, **kwargs)
+                )
+            finally:
+                self.pending -= 1
+
+    async def run_for_report(self, key, func, *args):
+        """تنفيذ عمليات نفس التقرير بالترتيب، وتقارير المستخدمين المختلفين بالتوازي"""
+        entry = self._report_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await self.run(func, *args)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._report_locks[key]
+
+    async def create_new_report(self, user_id, first_name, full_name, report_date=None):
+        report_date = report_date or ExcelHandler.get_report_date(user_id)
+        return await self.run_for_report(
+            (user_id, report_date),
+            ExcelHandler.create_new_report, user_id, first_name, full_name, report_date
+        )
+
+    async def add_visit(self, user_id, first_name, visit_type, data, report_date=None):
+        report_date = report_date or ExcelHandler.get_report_date(user_id)
+        return await self.run_for_report(
+            (user_id, report_date),
+            ExcelHandler.add_visit, user_id, first_name, visit_type, data, report_date
+        )
+
+    async def add_visits(self, user_id, first_name, visits, report_date=None):
+        report_date = report_date or ExcelHandler.get_report_date(user_id)
+        return await self.run_for_report(
+            (user_id, report_date),
+            ExcelHandler.add_visits, user_id, first_name, visits, report_date
+        )
+
+    async def render_report(self, user_id, report_date=None):
+        """رسم ملف التقرير من قاعدة البيانات"""
+        report_date = report_date or ExcelHandler.get_report_date(user_id)
+        return await self.run_for_report(
+            (user_id, report_date), ExcelHandler.render_report, user_id, report_date
+        )
+
+    async def render_cached(self, user_id, report_date=None):
+        """رسم التقرير مع بايتاته ومعرّف آخر رفع (CachedReport)"""
+        report_date = report_date or ExcelHandler.get_report_date(user_id)
+        return await self.run_for_report(
+            (user_id, report_date), ExcelHandler.render_cached, user_id, report_date
+        )
+
+    def shutdown(self):
+        """انتظار انتهاء العمليات الجارية ثم إغلاق الـ pool"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+report_writer = ReportWriter()
+metrics.gauge("medmap_writer_pending", lambda: report_writer.pending)
+metrics.gauge("medmap_writer_reports_locked", lambda: len(report_writer._report_locks))
+
+# --- إغلاق الأيام والأرشفة ---
+# ملفات التقارير قبل قاعدة البيانات: {الاسم الأول}{user_id}_Report_{اليوم}_{التاريخ}.xlsx
+LEGACY_REPORT_NAME = re.compile(r"^(?P<first_name>.*?)(?P<user_id>\d+)_Report_[A-Za-z]{3}_\d{2}-[A-Za-z]{3}\.xlsx$")
+
+def read_legacy_report(path):
+    """(التاريخ، الاسم الكامل، [(visit_type, data)]) من ملف تقرير قديم بالتخطيط القياسي، أو None لو لم يُفهم"""
+    from openpyxl import load_workbook
+    
+    try:
+        wb = load_workbook(path, read_only=True)
+    except Exception:
+        return None
+    try:
+        ws = wb.active
+        rows = ws.iter_rows(min_row=1, max_row=DEFAULT_LAYOUT.pharmacy_end, max_col=6, values_only=True)
+        cells = {number: list(values) for number, values in enumerate(rows, 1)}
+    finally:
+        wb.close()
+    header = cells.get(DEFAULT_LAYOUT.pharmacy_header, [None])
+    if header[0] != "PHARMACY":
+        return None  # قسم تم تكبيره أو ملف ليس تقريراً
+    try:
+        report_date = datetime.strptime(str(cells[5][1]), "%d/%m/%Y").strftime("%Y-%m-%d")
+    except (KeyError, ValueError):
+        report_date = datetime.fromtimestamp(os.path.getmtime(path)).strftime("%Y-%m-%d")
+    
+    def text(value):
+        return "" if value is None else str(value)
+    
+    visits = []
+    for visit_type, rows in DEFAULT_LAYOUT.rows.items():
+        name_key, place_key = VISIT_KEYS[visit_type]
+        for row in rows:
+            values = cells.get(row, [None] * 6) + [None] * 6
+            if not values[1]:
+                continue
+            data = {name_key: text(values[1]), place_key: text(values[2]), "Comment": text(values[5])}
+            if visit_type == "PHARMACY":
+                data["Products"] = text(values[3])  # D:E مدموجة في قسم الصيدليات
+            else:
+                data.update(Specialty=text(values[3]), Products=text(values[4]))
+            visits.append((visit_type, data))
+    return report_date, text(cells.get(4, [None, None])[1]), visits
+
+class ReportArchiver:
+    """إغلاق تقارير الأيام المنتهية، وضمها لملف zip لكل شهر، وحذف الأرشيف الأقدم من مدة الاحتفاظ"""
+
+    def __init__(self, reports_dir=REPORTS_DIR, archive_dir=ARCHIVE_DIR,
+                 archive_after_days=ARCHIVE_AFTER_DAYS, retention_months=RETENTION_MONTHS):
+        self.reports_dir = reports_dir
+        self.archive_dir = archive_dir
+        self.archive_after_days = archive_after_days
+        self.retention_months = retention_months
+
+    def finalize(self):
+        """رسم النسخة النهائية لكل تقرير انتهى يومه بتوقيت صاحبه
+
+        المناطق الزمنية تُقرأ من قاعدة البيانات لأن الإغلاق يعمل في العامل الأول فقط،
+        ومندوبو العمال الآخرين لا يظهرون في نسخة الذاكرة لديه.
+        """
+        timezones = user_store.timezones()
+        today = {}
+        done = []
+        for row in visit_store.open_reports():
+            user_id, report_date = row["user_id"], row["report_date"]
+            tz = timezones.get(user_id) or DEFAULT_TIMEZONE
+            if tz not in today:
+                today[tz] = report_day(now=datetime.now(load_timezone(tz))).strftime("%Y-%m-%d")
+            if report_date >= today[tz]:
+                continue
+            ExcelHandler.render_report(user_id, report_date)
+            ExcelHandler.forget(user_id, report_date)
+            done.append((user_id, report_date))
+        if done:
+            visit_store.mark_finalized(done)
+        return len(done)
+
+    def import_legacy(self):
+        """نقل ملفات التقارير القديمة (من قبل قاعدة البيانات) إلى جدولي reports وvisits مرة واحدة
+
+        الملف الذي لا يخص تقريراً في قاعدة البيانات ولا يمكن استيراده (بدون user_id في الاسم، أو تقرير
+        موجود باسم أول مختلف) يُنقل لأرشيف شهره بدلاً من بقائه في المجلد للأبد. يرجع (مستورد، مؤرشف).
+        """
+        if not os.path.isdir(self.reports_dir):
+            return 0, 0
+        known = {
+            ExcelHandler.get_report_filename(row["user_id"], row["first_name"],
+                                             datetime.strptime(row["report_date"], "%Y-%m-%d"))
+            for row in visit_store.unarchived_reports()
+        }
+        imported, orphans = 0, {}
+        for filename in sorted(os.listdir(self.reports_dir)):
+            # .tmp-* ملفات atomic_write أثناء الكتابة، ليست تقارير
+            if not filename.endswith(".xlsx") or filename.startswith(".tmp-") or filename in known:
+                continue
+            path = os.path.join(self.reports_dir, filename)
+            legacy = read_legacy_report(path)
+            if legacy is None:
+                report_date = datetime.fromtimestamp(os.path.getmtime(path)).strftime("%Y-%m-%d")
+            else:
+                report_date, full_name, visits = legacy
+                match = LEGACY_REPORT_NAME.match(filename)
+                if match:
+                    user_id = int(match["user_id"])
+                    first_name = (user_store.get(user_id) or {}).get("first_name") or match["first_name"]
+                    if visit_store.import_report(user_id, report_date, first_name, full_name or first_name, visits):
+                        imported += 1
+                        continue
+            orphans.setdefault(f"{report_date[:7]}.zip", []).append((path, f"{report_date}/{filename}"))
+        for bundle, files in orphans.items():
+            os.makedirs(self.archive_dir, exist_ok=True)
+            self._append(os.path.join(self.archive_dir, bundle), files)
+            for path, _ in files:
+                with contextlib.suppress(OSError):
+                    os.remove(path)
+        archived = sum(len(files) for files in orphans.values())
+        if imported or archived:
+            logger.info("تم نقل %d تقرير قديم لقاعدة البيانات وأرشفة %d ملف بدون تقرير", imported, archived)
+        return imported, archived
+
+    def archive(self, today=None):
+        """نقل ملفات التقارير المغلقة الأقدم من archive_after_days إلى ملف الشهر"""
+        today = today or report_day()
+        before = (today - timedelta(days=self.archive_after_days)).strftime("%Y-%m-%d")
+        rows = visit_store.reports_to_archive(before)
+        archived = 0
+        for month, group in itertools.groupby(rows, key=lambda row: row["report_date"][:7]):
+            bundle = f"{month}.zip"
+            entries, files = [], []
+            for row in group:
+                day = datetime.strptime(row["report_date"], "%Y-%m-%d")
+                filename = ExcelHandler.get_report_filename(row["user_id"], row["first_name"], day)
+                path = os.path.join(self.reports_dir, filename)
+                if os.path.exists(path):
+                    files.append((path, f"{row['report_date']}/{filename}"))
+                    entries.append((row["user_id"], row["report_date"], bundle))
+                else:
+                    entries.append((row["user_id"], row["report_date"], None))
+            if files:
+                os.makedirs(self.archive_dir, exist_ok=True)
+                self._append(os.path.join(self.archive_dir, bundle), files)
+                for path, _ in files:
+                    with contextlib.suppress(OSError):
+                        os.remove(path)
+                    storage_sync.delete_later(path)
+            # قاعدة البيانات هي فهرس الأرشيف: أي ملف zip يحتوي تقرير كل يوم
+            visit_store.mark_archived(entries)
+            archived += len(files)
+        return archived
+
+    @staticmethod
+    def _append(bundle_path, files):
+        """الإضافة على نسخة من ملف الشهر ثم استبداله، فلا يفسد الأرشيف لو توقف البوت أثناء الكتابة"""
+        # بعد إعادة النشر قد يكون ملف الشهر في التخزين الدائم فقط
+        storage_sync.fetch(bundle_path)
         
-        if not os.path.exists(filepath):
-            return None  # الملف غير موجود
-        
-        wb = load_workbook(filepath)
-        ws = wb.active
-        border = Border(
-            left=Side(style="thin"),
-            right=Side(style="thin"),
-            top=Side(style="thin"),
-            bottom=Side(style="thin")
-        )
-        
-        if visit_type == "AM":
-            for row in range(8, 15):
-                if not ws.cell(row=row, column=2).value:
-                    ws.cell(row=row, column=2).value = data.get("Dr", "")
-                    ws.cell(row=row, column=3).value = data.get("Hospital", "")
-                    ws.cell(row=row, column=4).value = data.get("Specialty", "")
-                    ws.cell(row=row, column=5).value = data.get("Products", "")
-                    ws.cell(row=row, column=6).value = data.get("Comment", "")
-                    for c in range(2, 7):
-                        ws.cell(row=row, column=c).border = border
-                    break
+        def write(f):
+            if os.path.exists(bundle_path):
+                with open(bundle_path, "rb") as src:
+                    shutil.copyfileobj(src, f)
+            with zipfile.ZipFile(f, "a", compression=zipfile.ZIP_DEFLATED) as zf:
+                existing = set(zf.namelist())
+                for path, arcname in files:
+                    if arcname not in existing:
+                        zf.write(path, arcname)
+        atomic_write(bundle_path, write)
+        storage_sync.upload_later(bundle_path)
+
+    def prune(self, today=None):
+        """حذف ملفات الأرشيف الأقدم من retention_months (البيانات تبقى في قاعدة البيانات)"""
+        if not self.retention_months:
+            return 0
+        today = today or report_day()
+        months = today.year * 12 + today.month - 1 - self.retention_months
+        oldest = f"{months // 12:04d}-{months % 12 + 1:02d}"
+        removed = 0
+        for name in storage_sync.list(self.archive_dir):
+            month, ext = os.path.splitext(name)
+            if ext != ".zip" or len(month) != 7 or month >= oldest:
+                continue
+            path = os.path.join(self.archive_dir, name)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            storage_sync.delete_later(path)
+            visit_store.forget_bundle(name)
+            removed += 1
+        return removed
+
+    def run_once(self):
+        """دورة كاملة: إغلاق ثم أرشفة ثم حذف، وإرجاع عدد كل منها"""
+        return self.finalize(), self.archive(), self.prune()
+
+report_archiver = ReportArchiver()
+
+# --- التذكير والإرسال التلقائي ---
+class ReportScheduler:
+    """تذكير المندوب الذي لم يسجل زيارات حتى REMINDER_TIME، وإرسال تقريره تلقائياً عند AUTO_SEND_TIME
+
+    كل المواعيد (بتوقيت كل مندوب) في heap واحد يفحصه job واحد كل SCHEDULER_TICK ثانية،
+    بدلاً من job لكل مندوب. تغيير المنطقة الزمنية يعيد جدولة المندوب، والمواعيد القديمة
+    تُتجاهل عند خروجها من الـ heap (رقم الجدولة لا يطابق).
+    """
+
+    def __init__(self, times=None, shard=0, shards=BOT_WORKERS, concurrency=SCHEDULER_CONCURRENCY,
+                 catchup=AUTO_SEND_CATCHUP):
+        if times is None:
+            times = {"remind": REMINDER_TIME, "autosend": AUTO_SEND_TIME}
+        self.times = {kind: parse_cutoff(value) for kind, value in times.items() if value}
+        self.shard = shard
+        self.shards = shards
+        self.concurrency = concurrency
+        self.catchup = catchup
+        self.loaded = False
+        self._heap = []  # (الوقت، ترتيب، النوع، user_id، رقم الجدولة)
+        self._generations = {}
+        self._order = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def next_time(self, user_id, kind, after):
+        """أول موعد من نوع kind بتوقيت المندوب بعد after (timestamp)"""
+        tz = user_timezone(user_id)
+        day = datetime.fromtimestamp(after, tz).date()
+        while True:
+            local = datetime.combine(day, datetime.min.time()) + self.times[kind]
+            at = local.replace(tzinfo=tz).timestamp() if tz else local.timestamp()
+            if at > after:
+                return at
+            day += timedelta(days=1)
+
+    def schedule_user(self, user_id, now=None):
+        """(إعادة) جدولة مواعيد المندوب، مثلاً بعد التسجيل أو تغيير المنطقة الزمنية"""
+        if not self.loaded or shard_for(user_id, self.shards) != self.shard:
+            return  # load() سيجدول كل المندوبين
+        self._push_user(user_id, now or time.time())
+
+    def add_user(self, user_id):
+        """جدولة مندوب جديد فقط (إنشاء تقرير آخر لا يغير مواعيده)"""
+        if user_id not in self._generations:
+            self.schedule_user(user_id)
+
+    def _push_user(self, user_id, now, catchup=0):
+        generation = self._generations.get(user_id, 0) + 1
+        self._generations[user_id] = generation
+        for kind in self.times:
+            after = now - catchup if kind == "autosend" else now
+            heapq.heappush(self._heap, (self.next_time(user_id, kind, after), next(self._order), kind, user_id, generation))
+
+    def load(self, now=None):
+        """جدولة كل المندوبين المسجلين مرة واحدة عند أول فحص"""
+        now = now or time.time()
+        for user_id in user_store.all():
+            if shard_for(user_id, self.shards) == self.shard:
+                self._push_user(user_id, now, self.catchup)
+        self.loaded = True
+        logger.info("Scheduler: %d events for %d reps", len(self._heap), len(self._generations))
+
+    def due(self, now=None):
+        """إخراج المواعيد المستحقة [(kind, user_id, at)] وجدولة الموعد التالي لكل منها"""
+        now = now or time.time()
+        events = []
+        while self._heap and self._heap[0][0] <= now:
+            at, _, kind, user_id, generation = heapq.heappop(self._heap)
+            if generation != self._generations.get(user_id):
+                continue
+            events.append((kind, user_id, at))
+            heapq.heappush(self._heap, (self.next_time(user_id, kind, now), next(self._order), kind, user_id, generation))
+        return events
+
+    async def tick(self, context: ContextTypes.DEFAULT_TYPE):
+        """الـ job الوحيد: تنفيذ المواعيد المستحقة في الخلفية حتى لا يتأخر الفحص التالي"""
+        if not self.loaded:
+            self.load()
+        events = self.due()
+        if events:
+            context.application.create_task(self.run_events(context.bot, events), name="scheduled-reports")
+
+    async def run_events(self, bot, events):
+        slots = asyncio.Semaphore(self.concurrency)
         
-        elif visit_type == "PM":
-            for row in range(16, 29):
-                if not ws.cell(row=row, column=2).value:
-                    ws.cell(row=row, column=2).value = data.get("Dr", "")
-                    ws.cell(row=row, column=3).value = data.get("Area", "")
-                    ws.cell(row=row, column=4).value = data.get("Specialty", "")
-                    ws.cell(row=row, column=5).value = data.get("Products", "")
-                    ws.cell(row=row, column=6).value = data.get("Comment", "")
-                    for c in range(2, 7):
-                        ws.cell(row=row, column=c).border = border
-                    break
+        async def run(kind, user_id, at):
+            async with slots:
+                report_date = report_day(user_id, datetime.fromtimestamp(at, user_timezone(user_id)))
+                try:
+                    if kind == "remind":
+                        result = await self.remind(bot, user_id, report_date.isoformat())
+                    else:
+                        result = await self.autosend(bot, user_id, report_date.isoformat())
+                except Exception:
+                    logger.exception("Scheduled %s for %s failed", kind, user_id)
+                    result = "failed"
+                metrics.inc("medmap_scheduled_total", kind=kind, result=result)
         
-        elif visit_type == "PHARMACY":
-            for row in range(31, 38):
-                if not ws.cell(row=row, column=2).value:
-                    ws.cell(row=row, column=2).value = data.get("Pharmacy", "")
-                    ws.cell(row=row, column=3).value = data.get("Address", "")
-                    ws.merge_cells(f"D{row}:E{row}")
-                    ws.cell(row=row, column=4).value = data.get("Products", "")
-                    ws.cell(row=row, column=6).value = data.get("Comment", "")
-                    for c in range(2, 7):
-                        ws.cell(row=row, column=c).border = border
-                    break
+        await asyncio.gather(*(run(*event) for event in events))
+
+    @staticmethod
+    def has_visits(report):
+        return report is not None and any(report[col] for col in COUNT_COLUMNS.values())
+
+    async def remind(self, bot, user_id, report_date):
+        report = await report_writer.run(visit_store.get_report, user_id, report_date)
+        if self.has_visits(report):
+            return "skipped"
+        if report is None:
+            text = "⏰ تذكير: لم تنشئ تقرير اليوم بعد.\nاستخدم /start ثم 📊 إنشاء تقرير جديد وسجّل زياراتك."
+        else:
+            text = "⏰ تذكير: لم تسجل أي زيارة اليوم بعد.\nاستخدم /start ثم ✅ تسجيل زيارة جديدة أو ⚡ إدخال سريع."
+        await bot.send_message(chat_id=user_id, text=text)
+        return "sent"
+
+    async def autosend(self, bot, user_id, report_date):
+        report = await report_writer.run(visit_store.get_report, user_id, report_date)
+        if not self.has_visits(report) or report["sent_version"] == report["version"]:
+            return "skipped"  # لا توجد زيارات، أو آخر نسخة أُرسلت بالفعل
+        await deliver_report(bot, user_id, user_id, report_date, title="📊 *تقرير اليوم (إرسال تلقائي)*")
+        return "sent"
+
+report_scheduler = ReportScheduler()
+metrics.gauge("medmap_scheduler_events", lambda: len(report_scheduler))
+
+# --- تنظيم الرسائل الصادرة ---
+class TokenBucket:
+    """رصيد يمتلئ بمعدل ثابت حتى سعة معينة؛ كل رسالة تستهلك وحدة أو تنتظر امتلاءها"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def full(self):
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+    async def acquire(self):
+        while True:
+            self._refill(time.monotonic())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class TelegramRateLimiter(BaseRateLimiter):
+    """حدود إرسال لكل محادثة وللبوت كله قبل كل رسالة، وإعادة المحاولة بعد RetryAfter
+
+    RetryAfter يوقف كل الإرسال (وليس المحادثة وحدها) لأن تيليجرام يطبقه على البوت.
+    rate_limit_args (رقم) يغير عدد مرات إعادة المحاولة لطلب واحد.
+    """
+
+    # طلبات لا تُحسب ضمن حدود الرسائل
+    UNLIMITED = {"getUpdates", "getMe", "setWebhook", "deleteWebhook", "getFile", "deleteMessage"}
+    MAX_CHATS = 10000
+
+    def __init__(self, chat_rate=RATE_CHAT_PER_SECOND, chat_burst=RATE_CHAT_BURST,
+                 global_rate=RATE_GLOBAL_PER_SECOND, global_burst=RATE_GLOBAL_BURST,
+                 max_retries=RATE_MAX_RETRIES, backoff=RATE_RETRY_BACKOFF):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        # في أي ثانية: الرصيد + المعدل، فالرصيد الصغير يبقي الدفعات تحت حد تيليجرام (~30 رسالة/ثانية)
+        self._global = TokenBucket(global_rate, global_burst) if global_rate else None
+        self._chats = {}
+        self._paused_until = 0.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_CHATS:
+                # المحادثات الممتلئة رصيدها مثل محادثة جديدة، فلا داعي للاحتفاظ بها
+                self._chats = {key: b for key, b in self._chats.items() if not b.full()}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _wait_turn(self, chat_id):
+        while (delay := self._paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+        if chat_id is not None and self.chat_rate:
+            await self._chat_bucket(chat_id).acquire()
+        if self._global is not None:
+            await self._global.acquire()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint in self.UNLIMITED:
+            return await callback(*args, **kwargs)
         
-        wb.save(filepath)
-        return filepath
+        max_retries = self.max_retries if rate_limit_args is None else rate_limit_args
+        chat_id = data.get("chat_id")
+        for attempt in itertools.count(1):
+            queued = time.perf_counter()
+            await self._wait_turn(chat_id)
+            metrics.observe("medmap_send_wait_seconds", time.perf_counter() - queued)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as exc:
+                metrics.inc("medmap_retry_after_total", endpoint=endpoint)
+                if attempt > max_retries:
+                    raise
+                delay = exc.retry_after
+                if isinstance(delay, timedelta):
+                    delay = delay.total_seconds()
+                delay += self.backoff * 2 ** (attempt - 1)
+                logger.warning("Flood limit on %s, retrying in %.1fs (attempt %d)", endpoint, delay, attempt)
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+
+# مع عدة عمليات عمال يُقسم الحد العام بينها (كل محادثة تُخدم دائماً من نفس العامل)
+rate_limiter = TelegramRateLimiter(global_rate=RATE_GLOBAL_PER_SECOND / max(1, BOT_WORKERS))
+metrics.gauge("medmap_send_chats_tracked", lambda: len(rate_limiter._chats))
+
+async def with_placeholder(message, text, sending, delay=PLACEHOLDER_DELAY):
+    """تنفيذ الإرسال مع رسالة انتظار تظهر فقط لو تأخر أكثر من delay، ثم حذفها"""
+    task = asyncio.ensure_future(sending)
+    done, _ = await asyncio.wait({task}, timeout=delay)
+    placeholder = None
+    if not done:
+        with contextlib.suppress(TelegramError):
+            placeholder = await message.reply_text(text)
+    try:
+        return await task
+    finally:
+        if placeholder is not None:
+            with contextlib.suppress(TelegramError):
+                await placeholder.delete()
+
+def send_error_text(error):
+    """رسالة مفهومة للمندوب بدلاً من نص الخطأ الخام"""
+    if isinstance(error, RetryAfter):
+        return "⏳ تيليجرام مشغول الآن، أعد المحاولة بعد قليل."
+    if isinstance(error, NetworkError):
+        return "📡 تعذر الاتصال بتيليجرام، أعد المحاولة بعد قليل."
+    return "❌ حدث خطأ أثناء الإرسال، أعد المحاولة أو تواصل مع المشرف."
 
 # --- وظائف البوت ---
+SEARCH_SUFFIXES = ("?", "؟")
+
+def suggestion_keyboard(user_id, field, query=None):
+    """أزرار بأكثر القيم استخداماً (أو نتائج البحث)، أو إخفاء الكيبورد لو لا توجد قيم"""
+    values = autocomplete.suggest(user_id, field, query)
+    if not values:
+        return ReplyKeyboardRemove()
+    return ReplyKeyboardMarkup([[value] for value in values], resize_keyboard=True, one_time_keyboard=True)
+
+async def offer_matches(update: Update, field):
+    """رسالة تنتهي بـ ؟ تعني بحثاً: تُعرض أقرب القيم كأزرار ولا تُحفظ كإجابة"""
+    text = update.message.text.strip()
+    if not text.endswith(SEARCH_SUFFIXES):
+        return False
+    reply_markup = suggestion_keyboard(update.effective_user.id, field, text.rstrip("?؟ "))
+    if isinstance(reply_markup, ReplyKeyboardRemove):
+        await update.message.reply_text("🔎 لا توجد نتائج، اكتب القيمة كاملة:", reply_markup=reply_markup)
+    else:
+        await update.message.reply_text("🔎 اختر من النتائج أو اكتب القيمة كاملة:", reply_markup=reply_markup)
+    return True
+
+def timed_handler(callback):
+    """قياس زمن وأخطاء كل handler باسم الدالة"""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        with metrics.timer("medmap_handler_seconds", handler=name):
+            try:
+                return await callback(update, context)
+            except Exception:
+                metrics.inc("medmap_handler_errors_total", handler=name)
+                raise
+    return wrapper
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
         ["📊 إنشاء تقرير جديد"],
         ["✅ تسجيل زيارة جديدة"],
+        ["⚡ إدخال سريع"],
         ["📤 إرسال التقرير"]
     ]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
@@ -283,8 +2972,20 @@ async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("اختر نوع الزيارة:", reply_markup=reply_markup)
         return VISIT_TYPE
     
+    elif choice == "⚡ إدخال سريع":
+        await update.message.reply_text(
+            QUICK_HELP,
+            reply_markup=ReplyKeyboardMarkup([["🔙 رجوع"]], resize_keyboard=True),
+            parse_mode='Markdown'
+        )
+        return QUICK_ENTRY
+    
     elif choice == "📤 إرسال التقرير":
         return await send_report(update, context)
+    
+    elif is_quick_entry(choice):
+        # لصق الزيارات مباشرة من القائمة الرئيسية بدون الضغط على الزر
+        return await quick_entry(update, context)
 
 async def first_name_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """استقبال الاسم الأول"""
@@ -303,11 +3004,12 @@ async def last_name_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['full_name'] = full_name
     context.user_data['user_id'] = user_id
     
-    # حفظ البيانات بشكل دائم في ملف JSON
-    save_user_data(user_id, first_name, full_name)
+    # حفظ البيانات بشكل دائم في قاعدة البيانات
+    await report_writer.run(save_user_data, user_id, first_name, full_name)
+    report_scheduler.add_user(user_id)
     
     # إنشاء التقرير
-    filepath, is_new = ExcelHandler.create_new_report(user_id, first_name, full_name)
+    filepath, is_new = await report_writer.create_new_report(user_id, first_name, full_name)
     filename = os.path.basename(filepath)
     
     if is_new:
@@ -326,6 +3028,60 @@ async def last_name_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     return await start(update, context)
 
+QUICK_HELP = (
+    "⚡ *الإدخال السريع*\n\n"
+    "أرسل زيارة أو أكثر، سطر لكل زيارة والحقول مفصولة بـ `|`:\n\n"
+    "`AM | د. أحمد | مستشفى السلام | باطنة | Panadol, Augmentin | تعليق`\n"
+    "`PM | د. سارة | المعادي | أطفال | Augmentin`\n"
+    "`PH | صيدلية الشفاء | شارع 9 | Panadol`\n\n"
+    "التعليق اختياري، وسطر فيه `AM` أو `PM` أو `PH` وحده يجعله نوع الأسطر التي بعده."
+)
+
+async def quick_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """حفظ كل الزيارات المكتوبة في رسالة واحدة، أو لا شيء لو فيها سطر خاطئ"""
+    text = update.message.text
+    if text == "🔙 رجوع":
+        return await start(update, context)
+    
+    visits, errors = parse_quick_visits(text)
+    if errors or not visits:
+        await update.message.reply_text(
+            "⚠️ لم يتم حفظ أي زيارة، صحح الأسطر التالية وأعد الإرسال:\n\n"
+            + "\n".join(errors or ["لا توجد زيارات في الرسالة"])
+        )
+        return QUICK_ENTRY
+    
+    user_id = update.effective_user.id
+    user_data = get_user_data(user_id)
+    filepath, saved = None, []
+    if user_data:
+        filepath, saved = await report_writer.add_visits(user_id, user_data['first_name'], visits)
+    if not filepath:
+        await update.message.reply_text(
+            "⚠️ *خطأ: لم يتم العثور على التقرير!*\n\n"
+            "قم بإنشاء تقرير جديد أولاً.",
+            reply_markup=ReplyKeyboardRemove(),
+            parse_mode='Markdown'
+        )
+        return await start(update, context)
+    
+    metrics.inc("medmap_quick_visits_total", len(saved))
+    counts = Counter(visit_type for visit_type, _ in saved)
+    summary = " | ".join(f"{SECTION_LABELS[t]}: {counts[t]}" for t in QUICK_FIELDS if counts[t])
+    # مع REPORT_OVERFLOW=drop لا يُحفظ ما يزيد عن خانات القسم
+    dropped = Counter(visit_type for visit_type, _ in visits) - counts
+    if dropped:
+        summary += "\n⚠️ لم يتم حفظ " + " | ".join(
+            f"{SECTION_LABELS[t]}: {dropped[t]}" for t in QUICK_FIELDS if dropped[t]
+        ) + " (القسم ممتلئ)"
+    total = f"{len(saved)} من {len(visits)}" if dropped else len(saved)
+    await update.message.reply_text(
+        f"✅ *تم تسجيل {total} زيارة*\n{summary}\n\n"
+        f"📄 تم الحفظ في: `{os.path.basename(filepath)}`",
+        parse_mode='Markdown'
+    )
+    return QUICK_ENTRY
+
 async def visit_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
     choice = update.message.text
     
@@ -341,34 +3097,54 @@ async def visit_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif choice == "💊 Pharmacy Visit":
         context.user_data['visit_type'] = "PHARMACY"
         await update.message.reply_text(
-            "🏪 أدخل اسم الصيدلية:",
-            reply_markup=ReplyKeyboardRemove()
+            "🏪 أدخل اسم الصيدلية (أو جزءاً منه متبوعاً بـ ؟ للبحث):",
+            reply_markup=suggestion_keyboard(update.effective_user.id, "pharmacy")
         )
         return PHARMACY_NAME
     
     await update.message.reply_text(
-        "👤 أدخل اسم الدكتور:",
-        reply_markup=ReplyKeyboardRemove()
+        "👤 أدخل اسم الدكتور (أو جزءاً منه متبوعاً بـ ؟ للبحث):",
+        reply_markup=suggestion_keyboard(update.effective_user.id, "doctor")
     )
     return DOCTOR_NAME
 
+def location_field(context):
+    return "hospital" if context.user_data['visit_type'] == "AM" else "area"
+
 async def doctor_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await offer_matches(update, "doctor"):
+        return DOCTOR_NAME
     context.user_data['doctor_name'] = update.message.text
     location_label = context.user_data['location_label']
-    await update.message.reply_text(f"🏥 أدخل {location_label}:")
+    await update.message.reply_text(
+        f"🏥 أدخل {location_label}:",
+        reply_markup=suggestion_keyboard(update.effective_user.id, location_field(context))
+    )
     return LOCATION
 
 async def location(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await offer_matches(update, location_field(context)):
+        return LOCATION
     context.user_data['location'] = update.message.text
-    await update.message.reply_text("🩺 أدخل تخصص الدكتور:")
+    await update.message.reply_text(
+        "🩺 أدخل تخصص الدكتور:",
+        reply_markup=suggestion_keyboard(update.effective_user.id, "specialty")
+    )
     return SPECIALTY
 
 async def specialty(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await offer_matches(update, "specialty"):
+        return SPECIALTY
     context.user_data['specialty'] = update.message.text
-    await update.message.reply_text("💊 أدخل أسماء المنتجات (افصل بينها بفاصلة):")
+    await update.message.reply_text(
+        "💊 أدخل أسماء المنتجات (افصل بينها بفاصلة):",
+        reply_markup=suggestion_keyboard(update.effective_user.id, "products")
+    )
     return PRODUCTS
 
 async def products(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await offer_matches(update, "products"):
+        return PRODUCTS
     context.user_data['products'] = update.message.text
     keyboard = [["⏭️ تخطي"]]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
@@ -408,7 +3184,7 @@ async def comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     first_name = user_data['first_name']
     
-    filepath = ExcelHandler.add_visit(user_id, first_name, visit_type, data)
+    filepath = await report_writer.add_visit(user_id, first_name, visit_type, data)
     
     if filepath:
         await update.message.reply_text(
@@ -428,16 +3204,28 @@ async def comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return await start(update, context)
 
 async def pharmacy_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await offer_matches(update, "pharmacy"):
+        return PHARMACY_NAME
     context.user_data['pharmacy_name'] = update.message.text
-    await update.message.reply_text("📍 أدخل عنوان الصيدلية:")
+    await update.message.reply_text(
+        "📍 أدخل عنوان الصيدلية:",
+        reply_markup=suggestion_keyboard(update.effective_user.id, "address")
+    )
     return PHARMACY_ADDRESS
 
 async def pharmacy_address(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await offer_matches(update, "address"):
+        return PHARMACY_ADDRESS
     context.user_data['pharmacy_address'] = update.message.text
-    await update.message.reply_text("💊 أدخل أسماء المنتجات:")
+    await update.message.reply_text(
+        "💊 أدخل أسماء المنتجات:",
+        reply_markup=suggestion_keyboard(update.effective_user.id, "products")
+    )
     return PHARMACY_PRODUCTS
 
 async def pharmacy_products(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await offer_matches(update, "products"):
+        return PHARMACY_PRODUCTS
     context.user_data['pharmacy_products'] = update.message.text
     keyboard = [["⏭️ تخطي"]]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
@@ -473,7 +3261,7 @@ async def pharmacy_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     first_name = user_data['first_name']
     
-    filepath = ExcelHandler.add_visit(user_id, first_name, "PHARMACY", data)
+    filepath = await report_writer.add_visit(user_id, first_name, "PHARMACY", data)
     
     if filepath:
         await update.message.reply_text(
@@ -492,6 +3280,44 @@ async def pharmacy_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     return await start(update, context)
 
+async def send_cached_report(bot, chat_id, report, caption):
+    """إرسال نفس نسخة التقرير بمعرّف الملف على تيليجرام بدلاً من رفعها مرة أخرى"""
+    if report.file_id:
+        try:
+            await bot.send_document(chat_id=chat_id, document=report.file_id, caption=caption, parse_mode='Markdown')
+            metrics.inc("medmap_report_send_total", mode="file_id")
+            return
+        except BadRequest:
+            logger.warning("Cached file_id rejected, uploading %s again", report.filename)
+            report.file_id = None
+    
+    sent = await bot.send_document(
+        chat_id=chat_id,
+        document=report.data,
+        filename=report.filename,
+        caption=caption,
+        parse_mode='Markdown'
+    )
+    metrics.inc("medmap_report_send_total", mode="upload")
+    if sent.document:
+        report.file_id = sent.document.file_id
+
+async def deliver_report(bot, chat_id, user_id, report_date=None, title="📊 *تقرير اليوم*"):
+    """رسم التقرير (أو إعادة استخدام آخر نسخة) وإرساله وتسجيل النسخة المرسلة؛ False لو لا يوجد تقرير
+
+    يستخدمه زر الإرسال والإرسال التلقائي.
+    """
+    report_date = report_date or ExcelHandler.get_report_date(user_id)
+    report = await report_writer.render_cached(user_id, report_date)
+    if not report:
+        return False
+    
+    day = datetime.strptime(report_date, "%Y-%m-%d")
+    with metrics.timer("medmap_reply_document_seconds", kind="report"):
+        await send_cached_report(bot, chat_id, report, caption=f"{title}\n\n📅 {day.strftime('%d %B %Y')}")
+    await report_writer.run(visit_store.mark_sent, user_id, report_date, report.version)
+    return True
+
 async def send_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
@@ -506,35 +3332,144 @@ async def send_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return await start(update, context)
     
-    first_name = user_data['first_name']
-    
-    filename = ExcelHandler.get_today_filename(user_id, first_name)
-    filepath = os.path.join(REPORTS_DIR, filename)
+    # رسم الملف من الزيارات المحفوظة (أو إعادة استخدامه لو لم يتغير) ثم إرساله
+    try:
+        delivered = await with_placeholder(
+            update.message,
+            "⏳ جاري إرسال التقرير...",
+            deliver_report(context.bot, update.effective_chat.id, user_id)
+        )
+    except Exception as e:
+        logger.exception("Sending report to %s failed", user_id)
+        await update.message.reply_text(send_error_text(e))
+        return await start(update, context)
     
-    if not os.path.exists(filepath):
+    if delivered:
+        await update.message.reply_text("✅ تم إرسال التقرير بنجاح!")
+    else:
         await update.message.reply_text(
             "⚠️ *لا يوجد تقرير لليوم!*\n\nقم بإنشاء تقرير جديد أولاً.",
             parse_mode='Markdown'
         )
-        return await start(update, context)
-    
-    waiting_msg = await update.message.reply_text("⏳ جاري إرسال التقرير...")
+    return await start(update, context)
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """أمر المشرفين: /export [من] [إلى] لتصدير تقارير كل المندوبين في ملف واحد"""
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("⛔ هذا الأمر متاح للمشرفين فقط.")
+        return
     
     try:
-        with open(filepath, 'rb') as file:
+        date_from, date_to = parse_date_range(context.args)
+    except ValueError:
+        await update.message.reply_text(
+            "⚠️ الصيغة: `/export 2026-01-01 2026-01-31`",
+            parse_mode='Markdown'
+        )
+        return
+    
+    async def export_and_send():
+        filepath = await report_writer.run(export_consolidated, date_from, date_to)
+        if not filepath:
+            await update.message.reply_text("ℹ️ لا توجد تقارير في هذه الفترة.")
+            return
+        with open(filepath, 'rb') as file, metrics.timer("medmap_reply_document_seconds", kind="export"):
             await update.message.reply_document(
                 document=file,
-                filename=filename,
-                caption=f"📊 *تقرير اليوم*\n\n📅 {datetime.now().strftime('%d %B %Y')}",
+                filename=os.path.basename(filepath),
+                caption=f"📊 *تقرير مجمع*\n\n📅 {date_from} ← {date_to}",
                 parse_mode='Markdown'
             )
-        await waiting_msg.delete()
-        await update.message.reply_text("✅ تم إرسال التقرير بنجاح!")
+    
+    try:
+        await with_placeholder(update.message, "⏳ جاري تجهيز التقرير المجمع...", export_and_send())
     except Exception as e:
-        await waiting_msg.delete()
-        await update.message.reply_text(f"❌ خطأ: {str(e)}")
+        logger.exception("Export failed")
+        await update.message.reply_text(send_error_text(e))
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """أمر المشرفين: /stats لعرض ملخص سريع للمقاييس"""
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("⛔ هذا الأمر متاح للمشرفين فقط.")
+        return
     
-    return await start(update, context)
+    def ms(seconds):
+        return "∞" if seconds == float("inf") else f"{seconds * 1000:.0f}ms"
+    
+    lag = metrics.summary("medmap_event_loop_lag_seconds")
+    lines = [
+        "📈 إحصائيات البوت",
+        f"⏱ مدة التشغيل: {int(metrics.read_gauge('medmap_uptime_seconds')) // 60} دقيقة",
+        f"🧵 عمليات Excel المعلقة: {report_writer.pending} / {report_writer.max_pending}",
+        f"📥 طابور التحديثات: {metrics.read_gauge('medmap_update_queue_depth')}",
+        f"🐢 تأخر الـ event loop: {ms(metrics.read_gauge('medmap_event_loop_lag_last_seconds'))}"
+        + (f" (p95 {ms(lag[0][3])})" if lag else ""),
+        "",
+        "الخطوة: العدد | المتوسط | p95",
+    ]
+    for name in ("medmap_handler_seconds", "medmap_users_seconds", "medmap_workbook_load_seconds",
+                 "medmap_workbook_save_seconds", "medmap_reply_document_seconds"):
+        for labels, count, mean, p95 in metrics.summary(name):
+            short = name.removeprefix("medmap_").removesuffix("_seconds")
+            label = labels.get("handler") or " ".join([short, *labels.values()])
+            lines.append(f"• {label}: {count} | {ms(mean)} | {ms(p95)}")
+    await update.message.reply_text("\n".join(lines))
+
+async def analytics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/analytics [من] [إلى]: تكرار الأطباء والمنتجات والتغطية؛ المشرف يرى الفريق والمندوب يرى زياراته"""
+    user_id = update.effective_user.id
+    try:
+        date_from, date_to = analytics_range(context.args)
+    except ValueError:
+        await update.message.reply_text(
+            "⚠️ الصيغة: `/analytics 2026-01-01 2026-01-31`",
+            parse_mode='Markdown'
+        )
+        return
+    
+    scope = None if user_id in ADMIN_IDS else user_id
+    result = await report_writer.run(visit_analytics.report, date_from, date_to, scope)
+    await update.message.reply_text(format_analytics(result, date_from, date_to)[:4096])
+
+async def timezone_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/timezone [المنطقة] لعرض أو تغيير المنطقة الزمنية التي يُحسب بها يوم التقرير"""
+    user_id = update.effective_user.id
+    if context.args:
+        name = context.args[0]
+        try:
+            load_timezone(name)
+        except (ZoneInfoNotFoundError, ValueError):
+            await update.message.reply_text(
+                "⚠️ منطقة زمنية غير معروفة. مثال: `/timezone Africa/Cairo`",
+                parse_mode='Markdown'
+            )
+            return
+        if not await report_writer.run(user_store.set_timezone, user_id, name):
+            await update.message.reply_text("⚠️ أنشئ تقريراً أولاً ثم حدد المنطقة الزمنية.")
+            return
+        report_scheduler.schedule_user(user_id)
+    
+    name = (get_user_data(user_id) or {}).get('tz') or DEFAULT_TIMEZONE or "توقيت الخادم"
+    await update.message.reply_text(
+        f"🕒 المنطقة الزمنية: {name}\n📅 يوم التقرير الحالي: {ExcelHandler.get_report_date(user_id)}"
+    )
+
+async def rollover_job(context: ContextTypes.DEFAULT_TYPE):
+    """مهمة دورية: إغلاق تقارير الأيام المنتهية وأرشفتها وحذف الأرشيف القديم"""
+    try:
+        finalized, archived, pruned = await report_writer.run(report_archiver.run_once)
+    except Exception:
+        logger.exception("Rollover failed")
+        return
+    if finalized or archived or pruned:
+        logger.info("Rollover: finalized %d, archived %d, pruned %d bundles", finalized, archived, pruned)
+
+async def legacy_import_job(context: ContextTypes.DEFAULT_TYPE):
+    """مهمة عند التشغيل: استيراد ملفات التقارير القديمة حتى يجد المندوب تقرير اليوم بعد التحديث"""
+    try:
+        await report_writer.run(report_archiver.import_legacy)
+    except Exception:
+        logger.exception("Legacy report import failed")
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
@@ -549,46 +3484,553 @@ async def reset_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE)
     context.user_data.clear()
     return await start(update, context)
 
-# --- وظيفة التشغيل الرئيسية ---
-def main():
-    """تشغيل البوت باستخدام التوكن من متغيرات البيئة"""
-    
-    if not BOT_TOKEN:
-        print("❌ خطأ: لم يتم العثور على BOT_TOKEN في متغيرات البيئة!")
-        return
+async def post_init(application: Application):
+    """تشغيل مراقبة الـ event loop وخادم المقاييس بعد تهيئة البوت"""
+    metrics.gauge("medmap_update_queue_depth", application.update_queue.qsize)
+    await loop_monitor.start()
+    await storage_sync.start()
+    # بناء فهرس الاقتراحات في الخلفية حتى لا يتأخر تشغيل البوت
+    application.create_task(report_writer.run(autocomplete.load), name="autocomplete-load")
+    application.create_task(report_writer.run(prewarm), name="prewarm")
+    if METRICS_PORT:
+        await metrics_server.start()
+
+def prewarm():
+    """تحميل openpyxl وبناء قالب التقرير في الخلفية بعد بدء البوت، حتى لا ينتظرهما أول تقرير
+
+    pandas لا تُجهز هنا لأنها تُستخدم فقط في /analytics والتصدير المجمع.
+    """
+    with metrics.timer("medmap_prewarm_seconds"):
+        ExcelHandler.get_template()
+
+async def post_shutdown(application: Application):
+    """إغلاق طبقة الكتابة وقاعدة البيانات بعد توقف البوت"""
+    await metrics_server.stop()
+    await loop_monitor.stop()
+    report_writer.shutdown()
+    await storage_sync.stop()
+    visit_store.close()
+    user_store.close()
+
+# --- مراقبة الأداء ---
+class LoopLagMonitor:
+    """قياس تأخر الـ event loop: لو تأخر الاستيقاظ عن موعده فهناك عملية تحجب باقي المستخدمين"""
+
+    def __init__(self, interval=LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.last = 0.0
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.last = max(0.0, loop.time() - started - self.interval)
+            metrics.observe("medmap_event_loop_lag_seconds", self.last)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+
+class MetricsServer:
+    """خادم HTTP محلي صغير يعرض GET /metrics بصيغة Prometheus"""
+
+    def __init__(self, host=METRICS_HOST, port=METRICS_PORT):
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info("Metrics on http://%s:%s/metrics", self.host, self.port)
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            while await asyncio.wait_for(reader.readline(), timeout=5) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", metrics.render().encode()
+            else:
+                status, body = "404 Not Found", b"not found"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+loop_monitor = LoopLagMonitor()
+metrics_server = MetricsServer()
+metrics.gauge("medmap_event_loop_lag_last_seconds", lambda: loop_monitor.last)
+
+# --- معالجة التحديثات والـ Webhook ---
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """معالجة تحديثات المستخدمين المختلفين بالتوازي مع الحفاظ على ترتيب رسائل نفس المستخدم"""
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        # user_id -> [lock, عدد التحديثات المنتظرة]
+        self._user_locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await coroutine
+            return
+        entry = self._user_locks.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[user.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+class WebhookApp:
+    """تطبيق ASGI بسيط يستقبل تحديثات تيليجرام ويضعها في طابور البوت"""
+
+    def __init__(self, application, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+        self.application = application
+        self.path = path
+        self.secret = secret
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        method, path = scope["method"], scope["path"]
+        
+        if path == "/health" and method == "GET":
+            await self._respond(send, 200, b"ok")
+            return
+        if path != self.path or method != "POST":
+            await self._respond(send, 404, b"not found")
+            return
+        
+        headers = dict(scope.get("headers", []))
+        token = headers.get(b"x-telegram-bot-api-secret-token", b"")
+        # بدون secret يمكن لأي شخص يعرف العنوان إرسال تحديث باسم أي مستخدم (حتى المشرف)
+        if not self.secret or not hmac.compare_digest(token, self.secret.encode()):
+            await self._respond(send, 403, b"forbidden")
+            return
+        
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        try:
+            await self.submit(json.loads(body))
+        except (ValueError, TypeError, KeyError, AttributeError):
+            logger.warning("Invalid webhook payload")
+            await self._respond(send, 400, b"bad request")
+            return
+        await self._respond(send, 200, b"ok")
+
+    async def submit(self, payload):
+        """وضع التحديث في طابور البوت"""
+        await self.application.update_queue.put(Update.de_json(payload, self.application.bot))
+
+    @staticmethod
+    async def _respond(send, status, body):
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"text/plain"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+def webhook_server(app):
+    import uvicorn
     
-    application = Application.builder().token(BOT_TOKEN).build()
+    return uvicorn.Server(uvicorn.Config(
+        app,
+        host=WEBHOOK_HOST,
+        port=WEBHOOK_PORT,
+        lifespan="off",
+        log_level="warning",
+    ))
+
+async def run_webhook(application):
+    """تشغيل البوت بوضع webhook على خادم uvicorn مدمج"""
+    server = webhook_server(WebhookApp(application))
+    async with application:
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+        await application.start()
+        # post_init و post_shutdown لا يُستدعيان تلقائياً خارج run_polling/run_webhook
+        await post_init(application)
+        try:
+            await server.serve()
+        finally:
+            await application.stop()
+            await post_shutdown(application)
+
+# --- التوزيع على عدة عمليات ---
+def shard_for(user_id, shards):
+    """رقم العامل المسؤول عن المندوب (ثابت بين العمليات وإعادات التشغيل)"""
+    return zlib.crc32(str(user_id).encode()) % shards
+
+def update_user_id(payload):
+    """user_id صاحب التحديث من الـ JSON الخام بدون تحويله لكائن Update"""
+    for field in ("message", "edited_message", "callback_query", "inline_query"):
+        sender = (payload.get(field) or {}).get("from")
+        if sender:
+            return sender["id"]
+    return 0
+
+async def serve_shard(application, inbox):
+    """تشغيل البوت داخل العامل واستقبال تحديثاته من الموزع"""
+    async with application:
+        await application.start()
+        await post_init(application)
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                payload = await loop.run_in_executor(None, inbox.get)
+                if payload is None:
+                    break
+                await application.update_queue.put(Update.de_json(payload, application.bot))
+        finally:
+            await application.stop()
+            await post_shutdown(application)
+
+def run_worker(shard, token, inbox):
+    """نقطة دخول عملية العامل"""
+    # الإيقاف يأتي من الموزع عبر الطابور حتى تُحفظ البيانات المعلقة
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if METRICS_PORT:
+        metrics_server.port = METRICS_PORT + shard
+    application = build_application(token, shard=shard)
+    asyncio.run(serve_shard(application, inbox))
+
+
+class ShardDispatcher:
+    """توجيه التحديثات لعمليات العمال حسب user_id: تقرير كل مندوب وحالة محادثته عند عامل واحد دائماً"""
+
+    def __init__(self, workers=BOT_WORKERS, token=BOT_TOKEN):
+        self.workers = workers
+        self.token = token
+        self._context = multiprocessing.get_context("spawn")
+        self.inboxes = [self._context.Queue() for _ in range(workers)]
+        self.processes = [None] * workers
+
+    def _spawn(self, shard):
+        process = self._context.Process(
+            target=run_worker,
+            args=(shard, self.token, self.inboxes[shard]),
+            name=f"medmap-worker-{shard}",
+            daemon=False,
+        )
+        process.start()
+        self.processes[shard] = process
+
+    def start(self):
+        for shard in range(self.workers):
+            self._spawn(shard)
+
+    def dispatch(self, payload):
+        shard = shard_for(update_user_id(payload), self.workers)
+        self.inboxes[shard].put(payload)
+        metrics.inc("medmap_dispatched_total", shard=shard)
+
+    def check_workers(self):
+        """إعادة تشغيل أي عامل توقف (تحديثاته المنتظرة تبقى في طابوره)"""
+        for shard, process in enumerate(self.processes):
+            if process is not None and not process.is_alive():
+                logger.warning("Worker %d exited with %s, restarting", shard, process.exitcode)
+                self._spawn(shard)
+
+    def stop(self, timeout=30):
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for process in self.processes:
+            if process is None:
+                continue
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+
+class ShardedWebhookApp(WebhookApp):
+    """نفس تطبيق الـ webhook لكن يمرر التحديث للموزع بدلاً من طابور البوت"""
+
+    def __init__(self, dispatcher, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+        super().__init__(None, path, secret)
+        self.dispatcher = dispatcher
+
+    async def submit(self, payload):
+        self.dispatcher.dispatch(payload)
+
+
+async def watch_workers(dispatcher, interval=5):
+    while True:
+        await asyncio.sleep(interval)
+        dispatcher.check_workers()
+
+async def dispatch_polling(dispatcher, bot):
+    """long polling في الموزع وتمرير كل تحديث لعامله"""
+    watchdog = asyncio.create_task(watch_workers(dispatcher))
+    offset = None
+    try:
+        async with bot:
+            await bot.delete_webhook()
+            while True:
+                try:
+                    updates = await bot.get_updates(
+                        offset=offset, timeout=30, allowed_updates=ALLOWED_UPDATES
+                    )
+                except NetworkError as e:
+                    logger.warning("getUpdates failed: %s", e)
+                    await asyncio.sleep(1)
+                    continue
+                for update in updates:
+                    dispatcher.dispatch(update.to_dict())
+                    offset = update.update_id + 1
+    finally:
+        watchdog.cancel()
+
+async def dispatch_webhook(dispatcher, bot):
+    """خادم الـ webhook في الموزع"""
+    server = webhook_server(ShardedWebhookApp(dispatcher))
+    watchdog = asyncio.create_task(watch_workers(dispatcher))
+    try:
+        async with bot:
+            await bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=ALLOWED_UPDATES,
+            )
+            await server.serve()
+    finally:
+        watchdog.cancel()
+
+def run_sharded():
+    """تشغيل الموزع وعمليات العمال"""
+    dispatcher = ShardDispatcher()
+    dispatcher.start()
+    bot = Bot(BOT_TOKEN, base_url=f"{TELEGRAM_API_URL}/bot", base_file_url=f"{TELEGRAM_API_URL}/file/bot")
+    # SIGTERM (إيقاف المنصة) يُعامل مثل Ctrl+C حتى يتوقف العمال بشكل سليم
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        if BOT_MODE == "webhook":
+            asyncio.run(dispatch_webhook(dispatcher, bot))
+        else:
+            asyncio.run(dispatch_polling(dispatcher, bot))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        dispatcher.stop()
+
+# --- وظيفة التشغيل الرئيسية ---
+def build_application(token=BOT_TOKEN, request=None, shard=0, limiter=rate_limiter):
+    """تجهيز البوت وكل الـ handlers (request بديل يُستخدم للاختبار بدون شبكة، limiter=None بدون حدود إرسال)"""
+    builder = (
+        Application.builder()
+        .token(token)
+        .base_url(f"{TELEGRAM_API_URL}/bot")
+        .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        .persistence(SQLitePersistence())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if limiter is not None:
+        builder = builder.rate_limiter(limiter)
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    application = builder.build()
     
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
+        entry_points=[CommandHandler("start", timed_handler(start))],
         states={
-            MAIN_MENU: [MessageHandler(filters.TEXT & ~filters.COMMAND, main_menu)],
-            FIRST_NAME_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, first_name_input)],
-            LAST_NAME_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, last_name_input)],
-            VISIT_TYPE: [MessageHandler(filters.TEXT & ~filters.COMMAND, visit_type)],
-            DOCTOR_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, doctor_name)],
-            LOCATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, location)],
-            SPECIALTY: [MessageHandler(filters.TEXT & ~filters.COMMAND, specialty)],
-            PRODUCTS: [MessageHandler(filters.TEXT & ~filters.COMMAND, products)],
-            COMMENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, comment)],
-            PHARMACY_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, pharmacy_name)],
-            PHARMACY_ADDRESS: [MessageHandler(filters.TEXT & ~filters.COMMAND, pharmacy_address)],
-            PHARMACY_PRODUCTS: [MessageHandler(filters.TEXT & ~filters.COMMAND, pharmacy_products)],
-            PHARMACY_COMMENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, pharmacy_comment)],
+            MAIN_MENU: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(main_menu))],
+            FIRST_NAME_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(first_name_input))],
+            LAST_NAME_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(last_name_input))],
+            VISIT_TYPE: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(visit_type))],
+            DOCTOR_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(doctor_name))],
+            LOCATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(location))],
+            SPECIALTY: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(specialty))],
+            PRODUCTS: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(products))],
+            COMMENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(comment))],
+            PHARMACY_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(pharmacy_name))],
+            PHARMACY_ADDRESS: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(pharmacy_address))],
+            PHARMACY_PRODUCTS: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(pharmacy_products))],
+            PHARMACY_COMMENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(pharmacy_comment))],
+            QUICK_ENTRY: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(quick_entry))],
         },
         fallbacks=[
-            CommandHandler("cancel", cancel),
-            CommandHandler("start", start),  # السماح بـ /start في أي وقت
+            CommandHandler("cancel", timed_handler(cancel)),
+            CommandHandler("start", timed_handler(start)),  # السماح بـ /start في أي وقت
         ],
         allow_reentry=True,  # السماح بإعادة الدخول للمحادثة
+        name="visit_conversation",
+        persistent=True,  # استكمال الزيارة من نفس الخطوة بعد إعادة التشغيل
     )
     
     # إضافة handler للرسائل خارج المحادثة
     application.add_handler(conv_handler)
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, reset_conversation))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("timezone", timezone_command))
+    application.add_handler(CommandHandler("analytics", analytics_command))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(reset_conversation)))
+    
+    # مع عدة عمال: الأرشفة تعمل في العامل الأول فقط
+    if shard == 0:
+        application.job_queue.run_once(legacy_import_job, when=0, name="legacy-import")
+        application.job_queue.run_repeating(
+            rollover_job, interval=ROLLOVER_INTERVAL, first=60, name="rollover"
+        )
+    # التذكير والإرسال التلقائي: كل عامل يجدول مندوبيه فقط
+    if report_scheduler.times:
+        report_scheduler.shard = shard
+        application.job_queue.run_repeating(
+            report_scheduler.tick, interval=SCHEDULER_TICK, first=5, name="report-scheduler"
+        )
+    return application
+
+def main():
+    """تشغيل البوت باستخدام التوكن من متغيرات البيئة"""
+    
+    if not BOT_TOKEN:
+        print("❌ خطأ: لم يتم العثور على BOT_TOKEN في متغيرات البيئة!")
+        return
+    
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        print("❌ خطأ: وضع webhook يحتاج WEBHOOK_URL!")
+        return
+    
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        print("❌ خطأ: وضع webhook يحتاج WEBHOOK_SECRET (حروف وأرقام و _ و -، حتى 256 حرف)!")
+        return
+    
+    if BOT_WORKERS > 1:
+        print(f"🤖 البوت يعمل الآن ({BOT_WORKERS} عمليات)...")
+        run_sharded()
+        return
+    
+    application = build_application()
+    
+    if BOT_MODE == "webhook":
+        print(f"🤖 البوت يعمل الآن (webhook على المنفذ {WEBHOOK_PORT})...")
+        asyncio.run(run_webhook(application))
+    else:
+        print("🤖 البوت يعمل الآن...")
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
+
+def render_reports(args):
+    """إعادة رسم تقارير فترة كاملة بوضع write-only"""
+    os.makedirs(args.out, exist_ok=True)
+    renderer = StreamingReportRenderer()
+    records = visit_store.iter_report_visits(args.date_from, args.date_to, args.user)
+    count = 0
+    for filepath in renderer.render_all(records, args.out):
+        count += 1
+        logger.info("Rendered %s", filepath)
+    print(f"✅ تم رسم {count} تقرير في {args.out}")
+
+def export_reports(args):
+    """تصدير مجمع من سطر الأوامر"""
+    try:
+        date_from, date_to = parse_date_range([args.date_from, args.date_to])
+    except ValueError:
+        print("❌ التاريخ يجب أن يكون بصيغة YYYY-MM-DD")
+        return
+    filepath = export_consolidated(date_from, date_to, args.out)
+    if filepath:
+        print(f"✅ تم التصدير: {filepath}")
+    else:
+        print("ℹ️ لا توجد تقارير في هذه الفترة.")
+
+def rollover_reports(args):
+    """دورة إغلاق وأرشفة واحدة من سطر الأوامر"""
+    report_archiver.import_legacy()
+    finalized, archived, pruned = report_archiver.run_once()
+    asyncio.run(storage_sync.stop())
+    print(f"✅ تم إغلاق {finalized} تقرير، أرشفة {archived} ملف، حذف {pruned} أرشيف قديم")
+
+def analytics_report(args):
+    """التحليلات من سطر الأوامر"""
+    default_from, default_to = analytics_range([])
+    try:
+        date_from, date_to = parse_date_range([args.date_from or default_from, args.date_to or default_to])
+    except ValueError:
+        print("❌ التاريخ يجب أن يكون بصيغة YYYY-MM-DD")
+        return
+    result = visit_analytics.report(date_from, date_to, args.user, args.top)
+    print(format_analytics(result, date_from, date_to))
+
+def run_cli(argv=None):
+    """نقطة الدخول: تشغيل البوت أو أوامر الصيانة من سطر الأوامر"""
+    parser = argparse.ArgumentParser(description="MedMap Telegram bot")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("run", help="تشغيل البوت (الافتراضي)")
+    
+    render = commands.add_parser("render", help="إعادة رسم تقارير Excel لفترة محددة")
+    render.add_argument("--from", dest="date_from", help="YYYY-MM-DD")
+    render.add_argument("--to", dest="date_to", help="YYYY-MM-DD")
+    render.add_argument("--user", type=int, action="append", help="user_id (يمكن تكراره)")
+    render.add_argument("--out", default=REPORTS_DIR, help="مجلد الحفظ")
+    render.set_defaults(func=render_reports)
     
-    print("🤖 البوت يعمل الآن...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    export = commands.add_parser("export", help="ملف Excel مجمع لكل المندوبين في فترة")
+    export.add_argument("--from", dest="date_from", required=True, help="YYYY-MM-DD")
+    export.add_argument("--to", dest="date_to", required=True, help="YYYY-MM-DD")
+    export.add_argument("--out", help="مسار الملف (الافتراضي داخل EXPORT_DIR)")
+    export.set_defaults(func=export_reports)
+    
+    analytics = commands.add_parser("analytics", help="تكرار زيارة الأطباء وذكر المنتجات والتغطية الأسبوعية")
+    analytics.add_argument("--from", dest="date_from", help="YYYY-MM-DD (الافتراضي آخر ANALYTICS_DAYS يوم)")
+    analytics.add_argument("--to", dest="date_to", help="YYYY-MM-DD")
+    analytics.add_argument("--user", type=int, help="user_id لمندوب واحد")
+    analytics.add_argument("--top", type=int, default=ANALYTICS_TOP)
+    analytics.set_defaults(func=analytics_report)
+    
+    rollover = commands.add_parser("rollover", help="إغلاق الأيام المنتهية وأرشفتها وحذف الأرشيف القديم")
+    rollover.set_defaults(func=rollover_reports)
+    
+    args = parser.parse_args(argv)
+    if args.command in (None, "run"):
+        main()
+    else:
+        args.func(args)
 
 if __name__ == "__main__":
-    main()
+    run_cli()